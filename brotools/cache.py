@@ -0,0 +1,277 @@
+"""Functions for caching the parsed, filtered records of a merged bro log
+on disk, so that later runs over the same logs can bulk read the records
+back, instead of decompressing, merging and parsing the logs again.
+
+Each cache file holds a single collection of records in a fixed layout.
+The file starts with a line identifying the format, followed by a line
+with the key of the source files the records were read from.  The rest of
+the file is a series of numpy arrays (written with `numpy.save`), one
+timestamp array, one array of line numbers, and then, for each string
+column, a dictionary encoded column (the distinct strings in the column
+UTF-8 encoded and concatenated together, the offsets of each string,
+whether each string was unicode, and the code of each record's value).
+"""
+
+import os
+import hashlib
+import logging
+import numpy
+from itertools import izip
+from .records import BroRecord, StringTable
+
+# Written at the start of each cache file.  This should be changed any
+# time the layout of the file, or what is cached in it, changes, so that
+# existing caches are treated as stale.
+MAGIC = "BRORECORDS 1"
+
+# The string valued attributes of a record that are stored in the cache,
+# in the order they're written.  The last column, "source", is the
+# part of each record's name after the line number.
+STRING_COLUMNS = ("id_orig_h", "id_resp_h", "method", "host", "uri",
+                  "referrer", "user_agent", "status_code", "content_type",
+                  "location", "cookies", "source")
+
+# The code stored for a value that is None (ie a missing optional column)
+NONE_CODE = -1
+
+
+def source_key(files):
+    """Returns a key identifying the contents of a collection of files,
+    for checking whether records cached from the files are still valid.
+
+    Args:
+        files -- a list of paths to files on disk
+
+    Return:
+        A hex string, made from the name, size, modification time and a
+        hash of the contents of each file
+    """
+    key_hash = hashlib.sha1()
+    for path in files:
+        stat = os.stat(path)
+        key_hash.update("{0}\t{1}\t{2!r}\n".format(os.path.basename(path),
+                                                  stat.st_size,
+                                                  stat.st_mtime))
+        with open(path, 'rb') as h:
+            for chunk in iter(lambda: h.read(1048576), ""):
+                key_hash.update(chunk)
+    return key_hash.hexdigest()
+
+
+def _split_name(name):
+    """Splits the name of a record, as set by `bro_records` (ie
+    "<line number>:<log name>") into its line number and log name.  Names
+    that don't look like this are returned whole, with a line number of -1.
+    """
+    if name is None:
+        return NONE_CODE, None
+    num, sep, source = name.partition(":")
+    if sep and num.isdigit():
+        return int(num), source
+    return NONE_CODE, name
+
+
+def _join_name(num, source):
+    if num == NONE_CODE:
+        return source
+    return "{0}:{1}".format(num, source)
+
+
+class RecordCacheWriter(object):
+    """Collects records in memory, in the layout used by the cache, and
+    writes them to disk when closed.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self._ts = []
+        self._nums = []
+        self._tables = [StringTable() for _ in STRING_COLUMNS]
+        self._codes = [[] for _ in STRING_COLUMNS]
+
+    def __len__(self):
+        return len(self._ts)
+
+    def append(self, record):
+        """Adds a single BroRecord to the cache.
+
+        Args:
+            record -- a BroRecord instance
+        """
+        num, source = _split_name(record.name)
+        self._ts.append(record.ts)
+        self._nums.append(num)
+        values = [getattr(record, c) for c in STRING_COLUMNS[:-1]]
+        values.append(source)
+        for value, table, codes in izip(values, self._tables, self._codes):
+            codes.append(NONE_CODE if value is None else table.code(value))
+
+    def close(self):
+        """Writes the collected records to disk.  The cache is written to a
+        temporary file first, and then moved into place, so that a partly
+        written cache is never read.
+        """
+        tmp_path = "{0}.tmp".format(self.path)
+        with open(tmp_path, 'wb') as h:
+            h.write("{0}\n{1}\n".format(MAGIC, self.key))
+            numpy.save(h, numpy.array(self._ts, dtype=numpy.float64))
+            numpy.save(h, numpy.array(self._nums, dtype=numpy.int64))
+            for table, codes in izip(self._tables, self._codes):
+                save_string_column(h, table, codes)
+        os.rename(tmp_path, self.path)
+
+
+def cached_records(records, path, key):
+    """A generator function that yields each of the given records, and
+    writes them all to a cache at the given path once they have all been
+    yielded.  If the records aren't all read, the cache isn't written.
+
+    Args:
+        records -- an iterable of BroRecord objects
+        path    -- the path to write the cache to
+        key     -- a key describing the source of the records, as returned
+                   by `source_key`
+
+    Return:
+        An iterator returning BroRecord objects
+    """
+    writer = RecordCacheWriter(path, key)
+    for r in records:
+        writer.append(r)
+        yield r
+    writer.close()
+    logging.getLogger("brorecords").info(
+        "{0}: Cached {1} records".format(path, len(writer)))
+
+
+def save_string_column(h, table, codes):
+    """Writes a dictionary encoded column of strings to a file, as a series
+    of numpy arrays.
+
+    Args:
+        h     -- a file handle, opened for writing in binary mode
+        table -- a StringTable, holding each distinct string in the column
+        codes -- a list of integers, the code for each value in the column,
+                 or NONE_CODE for values that are None
+    """
+    encoded = [v.encode("utf-8") if type(v) is unicode else v
+               for v in table.values]
+    lengths = numpy.array([len(v) for v in encoded], dtype=numpy.int64)
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    is_unicode = numpy.array([type(v) is unicode for v in table.values],
+                             dtype=bool)
+    blob = numpy.frombuffer("".join(encoded) or "\0", dtype=numpy.uint8)
+    numpy.save(h, blob)
+    numpy.save(h, offsets)
+    numpy.save(h, is_unicode)
+    numpy.save(h, numpy.array(codes, dtype=numpy.int32))
+
+
+def load_string_column(h):
+    """Reads a dictionary encoded column of strings, written by
+    `save_string_column`, out of a file.
+
+    Args:
+        h -- a file handle, opened for reading in binary mode
+
+    Return:
+        Two values, a list of each distinct string in the column, and a
+        numpy array of the code of each value in the column, where each
+        code is the index of the value in the list of strings, or NONE_CODE.
+    """
+    blob = numpy.load(h, allow_pickle=False).tostring()
+    offsets = numpy.load(h, allow_pickle=False).tolist()
+    is_unicode = numpy.load(h, allow_pickle=False).tolist()
+    codes = numpy.load(h, allow_pickle=False)
+    values = [blob[start:end] for start, end in izip(offsets, offsets[1:])]
+    if any(is_unicode):
+        values = [v.decode("utf-8") if u else v
+                  for v, u in izip(values, is_unicode)]
+    return values, codes
+
+
+# The number of records built at a time when reading records back out of a
+# cache, so that only the compact, encoded columns are held in memory for
+# the whole cache.
+CHUNK_SIZE = 65536
+
+
+def _read_column(h):
+    """Reads a single dictionary encoded column out of a cache file, and
+    returns a list of the column's distinct values, and a numpy array of
+    the index of each record's value in that list."""
+    values, codes = load_string_column(h)
+    if len(codes) and codes.min() == NONE_CODE:
+        values.append(None)
+    return values, codes
+
+
+class CachedRecords(object):
+    """The records read out of a cache file.  The records are only built
+    as they are iterated over, a chunk at a time, from the encoded columns
+    read from the cache.
+    """
+
+    def __init__(self, ts, nums, columns):
+        """
+        Args:
+            ts      -- a numpy array of the timestamp of each record
+            nums    -- a numpy array of the line number of each record
+            columns -- a list of the encoded columns in `STRING_COLUMNS`,
+                       each as returned by `_read_column`
+        """
+        self._ts = ts
+        self._nums = nums
+        self._columns = columns
+
+    def __len__(self):
+        return len(self._ts)
+
+    def __iter__(self):
+        new = BroRecord.__new__
+        lines = [None] * CHUNK_SIZE
+        for start in xrange(0, len(self._ts), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            ts = self._ts[start:end].tolist()
+            nums = self._nums[start:end].tolist()
+            columns = [[values[c] for c in codes[start:end].tolist()]
+                       for values, codes in self._columns]
+            sources = columns.pop()
+            names = [_join_name(n, s) for n, s in izip(nums, sources)]
+            for state in izip(ts, *(columns + [lines, names])):
+                r = new(BroRecord)
+                r.__setstate__(state)
+                yield r
+
+
+def read_records(path, key):
+    """Reads the records out of a cache file.
+
+    Args:
+        path -- the path to a cache file, written by `RecordCacheWriter`
+        key  -- the key of the files the records should have been read from,
+                as returned by `source_key`
+
+    Return:
+        A CachedRecords object, which can be iterated over to get each
+        BroRecord in the cache, or None if there is no cache at the given
+        path, or if the cache was made from different files (or an earlier
+        version of the files).
+    """
+    log = logging.getLogger("brorecords")
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as h:
+        if h.readline()[:-1] != MAGIC:
+            log.info("{0}: Ignoring cache in an old format".format(path))
+            return None
+        if h.readline()[:-1] != key:
+            log.info("{0}: Ignoring stale cache".format(path))
+            return None
+        ts = numpy.load(h, allow_pickle=False)
+        nums = numpy.load(h, allow_pickle=False)
+        columns = [_read_column(h) for _ in STRING_COLUMNS]
+    return CachedRecords(ts, nums, columns)
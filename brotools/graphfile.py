@@ -0,0 +1,859 @@
+"""Functions and classes for reading and writing collections of
+BroRecordGraphs to disk.
+
+Graph files are written in a versioned container format.  The file starts
+with a short magic string, followed by a series of blocks.  Each block
+starts with a fixed size header (flags, the number of bytes stored in the
+block, and the number of graphs in the block), followed by the block's
+payload, which is optionally zlib compressed.  Once decompressed, a
+payload is a series of records, each a four byte length, followed by a
+graph pickled with the highest pickle protocol.  The last block in a
+complete file is a footer, holding the number of graphs in the file and
+the range of time they cover, and the file ends with the offset of the
+footer, so that the footer can be read without reading the rest of the
+file.
+
+Files written before this format was used are a series of graphs
+pickled one after another, and are also read by `read_graphs`.
+
+Each graph file can also have an index, in a sidecar file with ".idx"
+appended to the graph file's name.  The index records where each graph is
+stored in the graph file (the offset of its block, and its position in the
+block), along with the graph's client, time range, size and hosts, so that
+`query_graphs` can read only the graphs matching a query out of the file.
+"""
+
+import os
+import struct
+import collections
+import zlib
+import logging
+import numpy
+from .cache import NONE_CODE, save_string_column, load_string_column
+from .records import StringTable
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Written at the start of every graph file, with the version of the format
+# as the last byte
+MAGIC = "BROGRAPH\x01"
+
+# Written at the very end of every complete graph file, after the offset
+# of the footer block
+TRAILER_MAGIC = "BROGEND\x01"
+
+# Flags set in the header of each block
+BLOCK_COMPRESSED = 1
+BLOCK_FOOTER = 2
+
+BLOCK_HEADER = struct.Struct("<BII")
+RECORD_LENGTH = struct.Struct("<I")
+FOOTER = struct.Struct("<Qdd")
+TRAILER = struct.Struct("<Q8s")
+
+# The number of (uncompressed) bytes of pickled graphs collected before
+# they're written to disk as a block
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Written at the start of every index file.  This should be changed any
+# time the layout of the index changes, so that older indexes are rebuilt.
+INDEX_MAGIC = "BROGRAPHIDX 1"
+
+
+def index_path(path):
+    """Returns the path of the index for the graph file at the given path.
+    """
+    return path + ".idx"
+
+
+def move_graph_file(src, dest):
+    """Moves a graph file, along with its index if it has one, to a new
+    path.
+
+    Args:
+        src  -- the current path of the graph file
+        dest -- the path to move the graph file to
+    """
+    os.rename(src, dest)
+    if os.path.isfile(index_path(src)):
+        os.rename(index_path(src), index_path(dest))
+
+
+def remove_graph_file(path):
+    """Deletes a graph file, along with its index if it has one.
+
+    Args:
+        path -- the path of the graph file to delete
+    """
+    os.remove(path)
+    if os.path.isfile(index_path(path)):
+        os.remove(index_path(path))
+
+
+def is_graph_file(path):
+    """Returns whether the file at the given path is in the graph container
+    format (as opposed to being a legacy file of concatenated pickles).
+
+    Args:
+        path -- the path to a file on disk
+
+    Return:
+        True if the file starts with the container format's magic string,
+        and otherwise False.
+    """
+    with open(path, 'rb') as h:
+        return h.read(len(MAGIC)) == MAGIC
+
+
+def _read_blocks(h):
+    """A generator function that reads the blocks out of a graph file,
+    starting from the current position of the given handle, and stopping
+    at the footer or the end of the file, whichever comes first.  A block
+    that was only partially written (ie the writing process stopped
+    before the file was closed) is treated as the end of the file.
+
+    Args:
+        h -- a file handle, opened in binary mode
+
+    Return:
+        An iterator returning tuples of three values, the offset of the
+        block in the file, the block's flags, and the block's decompressed
+        payload.
+    """
+    for offset, header, payload in _read_raw_blocks(h):
+        flags = BLOCK_HEADER.unpack(header)[0]
+        if flags & BLOCK_COMPRESSED:
+            payload = zlib.decompress(payload)
+        yield offset, flags, payload
+
+
+def _read_raw_blocks(h):
+    """Reads the blocks out of a graph file, like `_read_blocks`, but
+    returns each block as it is stored on disk.
+
+    Args:
+        h -- a file handle, opened in binary mode
+
+    Return:
+        An iterator returning tuples of three values, the offset of the
+        block in the file, the block's packed header, and the block's
+        payload, as stored (ie still compressed, if it was compressed).
+    """
+    while True:
+        offset = h.tell()
+        header = h.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        flags, stored_length, _ = BLOCK_HEADER.unpack(header)
+        payload = h.read(stored_length)
+        if len(payload) < stored_length:
+            return
+        yield offset, header, payload
+        if flags & BLOCK_FOOTER:
+            return
+
+
+def _records(payload):
+    """A generator function that yields the pickled graphs in the
+    decompressed payload of a block."""
+    pos = 0
+    end = len(payload)
+    while pos < end:
+        length, = RECORD_LENGTH.unpack_from(payload, pos)
+        pos += RECORD_LENGTH.size
+        yield payload[pos:pos + length]
+        pos += length
+
+
+def _legacy_graphs(h):
+    """A generator function that unpickles each graph out of a file written
+    as a series of pickles.  Graphs that can't be unpickled are skipped."""
+    log = logging.getLogger("brorecords")
+    while True:
+        try:
+            yield pickle.load(h)
+        except EOFError:
+            break
+        except:
+            log.info(" * Pickle error, skipping: {0}".format(h.name))
+            pass
+
+
+def read_graphs(path):
+    """A generator function that yields each BroRecordGraph stored in a
+    graph file.  Both graph container files, and legacy files of
+    concatenated pickles are read.
+
+    Args:
+        path -- the path to a graph file on disk
+
+    Return:
+        An iterator returning BroRecordGraph objects
+    """
+    for _, _, graph in _read_graph_locations(path):
+        yield graph
+
+
+def _read_graph_locations(path):
+    """A generator function that yields each BroRecordGraph stored in a
+    graph file, along with where the graph is stored in the file.
+
+    Args:
+        path -- the path to a graph file on disk
+
+    Return:
+        An iterator returning tuples of three values, the offset of the
+        block the graph is stored in, the position of the graph in the
+        block, and the graph.  For legacy files, the offset and position
+        are both None.
+    """
+    with open(path, 'rb') as h:
+        if h.read(len(MAGIC)) != MAGIC:
+            h.seek(0)
+            for graph in _legacy_graphs(h):
+                yield None, None, graph
+            return
+
+        for offset, flags, payload in _read_blocks(h):
+            if flags & BLOCK_FOOTER:
+                break
+            for slot, record in enumerate(_records(payload)):
+                yield offset, slot, pickle.loads(record)
+
+
+def _summary_from_footer(payload):
+    count, earliest_ts, latest_ts = FOOTER.unpack(payload)
+    return {
+        "count": count,
+        "earliest_ts": earliest_ts if count else None,
+        "latest_ts": latest_ts if count else None,
+    }
+
+
+def _footer_offset(h):
+    """Returns the offset of the footer block of a graph file, or None if
+    the file doesn't end with a trailer (ie it wasn't completely written).
+    """
+    h.seek(0, os.SEEK_END)
+    if h.tell() < len(MAGIC) + TRAILER.size:
+        return None
+    h.seek(-TRAILER.size, os.SEEK_END)
+    offset, trailer_magic = TRAILER.unpack(h.read(TRAILER.size))
+    if trailer_magic != TRAILER_MAGIC:
+        return None
+    return offset
+
+
+def read_summary(path):
+    """Returns a summary of the graphs in a graph container file, read out
+    of the file's footer.
+
+    Args:
+        path -- the path to a graph container file on disk
+
+    Return:
+        None if the file isn't a complete graph container file, and
+        otherwise a dict with three keys, "count", the number of graphs in
+        the file, and "earliest_ts" and "latest_ts", the earliest and latest
+        time of any record in any graph in the file (both of which are None
+        if the file has no graphs).
+    """
+    with open(path, 'rb') as h:
+        if h.read(len(MAGIC)) != MAGIC:
+            return None
+        offset = _footer_offset(h)
+        if offset is None:
+            return None
+        h.seek(offset)
+        for _, flags, payload in _read_blocks(h):
+            if flags & BLOCK_FOOTER:
+                return _summary_from_footer(payload)
+    return None
+
+
+def _code(table, value):
+    return NONE_CODE if value is None else table.code(value)
+
+
+def _as_list(values):
+    """Returns a column of a GraphIndex, which is a numpy array if the index
+    was read from disk, as a list of python values."""
+    return values.tolist() if hasattr(values, "tolist") else list(values)
+
+
+class GraphIndex(object):
+    """An index of the graphs in a graph container file, describing where
+    each graph is stored in the file, along with the client, time range,
+    number of nodes and hosts of each graph.  Strings (ips, user agents and
+    hosts) are dictionary encoded, so that queries are evaluated once per
+    distinct string, instead of once per graph.
+    """
+
+    def __init__(self):
+        self.offsets = []
+        self.slots = []
+        self.earliest_ts = []
+        self.latest_ts = []
+        self.node_counts = []
+        self.ips = StringTable()
+        self.ip_codes = []
+        self.user_agents = StringTable()
+        self.user_agent_codes = []
+        self.hosts = StringTable()
+        self.host_codes = []
+        self.host_offsets = [0]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, offset, slot, graph):
+        """Adds a graph to the index.
+
+        Args:
+            offset -- the offset of the block the graph is stored in
+            slot   -- the position of the graph in its block
+            graph  -- a BroRecordGraph
+        """
+        self.offsets.append(offset)
+        self.slots.append(slot)
+        self.earliest_ts.append(graph.earliest_ts)
+        self.latest_ts.append(graph.latest_ts)
+        self.node_counts.append(len(graph))
+        self.ip_codes.append(_code(self.ips, graph.ip))
+        self.user_agent_codes.append(_code(self.user_agents,
+                                           graph.user_agent))
+        self.host_codes += [self.hosts.code(h) for h in graph.hosts()]
+        self.host_offsets.append(len(self.host_codes))
+
+    def locations_and_hosts(self):
+        """A generator function that yields where each graph in the index is
+        stored, along with the hosts the graph requested.
+
+        Return:
+            An iterator returning tuples of three values, the offset of the
+            block a graph is stored in, the position of the graph in its
+            block, and a list of the hosts in the graph
+        """
+        hosts = self.hosts.values
+        host_codes = _as_list(self.host_codes)
+        host_offsets = _as_list(self.host_offsets)
+        offsets = _as_list(self.offsets)
+        slots = _as_list(self.slots)
+        for i, (offset, slot) in enumerate(zip(offsets, slots)):
+            codes = host_codes[host_offsets[i]:host_offsets[i + 1]]
+            yield offset, slot, [hosts[c] for c in codes]
+
+    def extend(self, other, shift=0):
+        """Adds every graph in another index to this index.
+
+        Args:
+            other -- a GraphIndex
+
+        Keyword Args:
+            shift -- the number of bytes to add to the block offsets in the
+                     other index, ie how far the other index's graphs have
+                     moved from where the other index records them
+        """
+        ip_codes = [_code(self.ips, v) for v in other.ips.values]
+        ua_codes = [_code(self.user_agents, v)
+                    for v in other.user_agents.values]
+        host_codes = [self.hosts.code(v) for v in other.hosts.values]
+        host_shift = len(self.host_codes)
+
+        self.offsets += [o + shift for o in _as_list(other.offsets)]
+        self.slots += _as_list(other.slots)
+        self.earliest_ts += _as_list(other.earliest_ts)
+        self.latest_ts += _as_list(other.latest_ts)
+        self.node_counts += _as_list(other.node_counts)
+        self.ip_codes += [NONE_CODE if c == NONE_CODE else ip_codes[c]
+                          for c in _as_list(other.ip_codes)]
+        self.user_agent_codes += [NONE_CODE if c == NONE_CODE else ua_codes[c]
+                                  for c in _as_list(other.user_agent_codes)]
+        self.host_codes += [host_codes[c] for c in _as_list(other.host_codes)]
+        self.host_offsets += [o + host_shift
+                              for o in _as_list(other.host_offsets)[1:]]
+
+    @classmethod
+    def build(cls, path):
+        """Builds an index by reading every graph in a graph container file.
+
+        Args:
+            path -- the path to a graph container file
+
+        Return:
+            A GraphIndex instance
+        """
+        index = cls()
+        for offset, slot, graph in _read_graph_locations(path):
+            index.add(offset, slot, graph)
+        return index
+
+    @classmethod
+    def load(cls, path):
+        """Reads the index of a graph file out of the file's sidecar index.
+
+        Args:
+            path -- the path to a graph container file (not the index)
+
+        Return:
+            A GraphIndex instance, or None if the graph file has no index,
+            or if the graph file has changed since the index was written.
+        """
+        try:
+            h = open(index_path(path), 'rb')
+        except IOError:
+            return None
+        with h:
+            if h.readline()[:-1] != INDEX_MAGIC:
+                return None
+            if h.readline()[:-1] != str(os.path.getsize(path)):
+                return None
+            index = cls()
+            index.offsets = numpy.load(h, allow_pickle=False)
+            index.slots = numpy.load(h, allow_pickle=False)
+            index.earliest_ts = numpy.load(h, allow_pickle=False)
+            index.latest_ts = numpy.load(h, allow_pickle=False)
+            index.node_counts = numpy.load(h, allow_pickle=False)
+            index.host_offsets = numpy.load(h, allow_pickle=False)
+            index.ips, index.ip_codes = cls._load_column(h)
+            index.user_agents, index.user_agent_codes = cls._load_column(h)
+            index.hosts, index.host_codes = cls._load_column(h)
+        return index
+
+    @staticmethod
+    def _load_column(h):
+        values, codes = load_string_column(h)
+        table = StringTable()
+        for value in values:
+            table.code(value)
+        return table, codes
+
+    def save(self, path):
+        """Writes the index to the sidecar index of the graph file at the
+        given path.  The graph file should not be changed afterwards, or
+        the index will be treated as stale.
+
+        Args:
+            path -- the path to the graph container file (not the index)
+        """
+        tmp_path = index_path(path) + ".tmp"
+        with open(tmp_path, 'wb') as h:
+            h.write("{0}\n{1}\n".format(INDEX_MAGIC, os.path.getsize(path)))
+            numpy.save(h, numpy.asarray(self.offsets, dtype=numpy.int64))
+            numpy.save(h, numpy.asarray(self.slots, dtype=numpy.int32))
+            numpy.save(h, numpy.asarray(self.earliest_ts,
+                                        dtype=numpy.float64))
+            numpy.save(h, numpy.asarray(self.latest_ts, dtype=numpy.float64))
+            numpy.save(h, numpy.asarray(self.node_counts, dtype=numpy.int32))
+            numpy.save(h, numpy.asarray(self.host_offsets,
+                                        dtype=numpy.int64))
+            save_string_column(h, self.ips, self.ip_codes)
+            save_string_column(h, self.user_agents, self.user_agent_codes)
+            save_string_column(h, self.hosts, self.host_codes)
+        os.rename(tmp_path, index_path(path))
+
+    def matches(self, ip=None, user_agent=None, start=None, end=None,
+                hosts=None, host_filter=None):
+        """Returns which graphs in the index match a query.  Each given
+        criteria must match for a graph to match.
+
+        Keyword Args:
+            ip          -- if provided, only graphs for this ip match
+            user_agent  -- if provided, only graphs for this user agent match
+            start       -- if provided, only graphs with a record at or
+                           after this timestamp match
+            end         -- if provided, only graphs with a record at or
+                           before this timestamp match
+            hosts       -- if provided, a collection of hosts, and only graphs
+                           with a request to at least one of them match
+            host_filter -- if provided, a function that takes a host and
+                           returns a boolean, and only graphs with a request
+                           to at least one host the function returns True
+                           for match
+
+        Return:
+            A numpy array of booleans, one for each graph in the index
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+        if ip is not None:
+            mask &= (numpy.asarray(self.ip_codes) ==
+                     self.ips._codes.get(ip, -2))
+        if user_agent is not None:
+            mask &= (numpy.asarray(self.user_agent_codes) ==
+                     self.user_agents._codes.get(user_agent, -2))
+        if start is not None:
+            mask &= numpy.asarray(self.latest_ts) >= start
+        if end is not None:
+            mask &= numpy.asarray(self.earliest_ts) <= end
+
+        for host_criteria in (hosts, host_filter):
+            if host_criteria is None:
+                continue
+            if callable(host_criteria):
+                matching_hosts = self.hosts.matches(host_criteria)
+            else:
+                host_set = set(host_criteria)
+                matching_hosts = self.hosts.matches(lambda h: h in host_set)
+            host_codes = numpy.asarray(self.host_codes, dtype=numpy.int64)
+            host_offsets = numpy.asarray(self.host_offsets, dtype=numpy.int64)
+            # Count the number of matching hosts in each graph, by summing
+            # the matches over each graph's run of host codes.  The matches
+            # are padded with a zero, so that graphs at the end of the index
+            # with no hosts still start at a valid position.
+            host_matches = numpy.zeros(len(host_codes) + 1, dtype=numpy.int64)
+            host_matches[:-1] = matching_hosts[host_codes]
+            counts = numpy.add.reduceat(host_matches, host_offsets[:-1])
+            counts[host_offsets[:-1] == host_offsets[1:]] = 0
+            mask &= counts > 0
+        return mask
+
+
+def _graph_matches(graph, ip=None, user_agent=None, start=None, end=None,
+                   hosts=None, host_filter=None):
+    """Checks a graph against the same criteria as `GraphIndex.matches`,
+    for files that have no index."""
+    if ip is not None and graph.ip != ip:
+        return False
+    if user_agent is not None and graph.user_agent != user_agent:
+        return False
+    if start is not None and graph.latest_ts < start:
+        return False
+    if end is not None and graph.earliest_ts > end:
+        return False
+    if hosts is not None and not set(hosts).intersection(graph.hosts()):
+        return False
+    if host_filter is not None and not any(host_filter(h)
+                                           for h in graph.hosts()):
+        return False
+    return True
+
+
+def query_graphs(path, **query):
+    """A generator function that yields each BroRecordGraph in a graph file
+    that matches a query.  If the file has an up to date index, only the
+    matching graphs are read out of the file.  Otherwise, every graph in the
+    file is read and checked.
+
+    Args:
+        path -- the path to a graph file on disk
+
+    Keyword Args:
+        The same criteria as `GraphIndex.matches`
+
+    Return:
+        An iterator returning BroRecordGraph objects
+    """
+    index = GraphIndex.load(path)
+    if index is None:
+        for graph in read_graphs(path):
+            if _graph_matches(graph, **query):
+                yield graph
+        return
+
+    mask = index.matches(**query)
+    offsets = numpy.asarray(index.offsets)[mask].tolist()
+    slots = numpy.asarray(index.slots)[mask].tolist()
+    for graph in read_graphs_at(path, zip(offsets, slots)):
+        yield graph
+
+
+def read_graphs_at(path, locations):
+    """A generator function that yields the BroRecordGraphs stored at the
+    given locations in a graph container file, as recorded in the file's
+    index.
+
+    Args:
+        path      -- the path to a graph container file on disk
+        locations -- a list of pairs of values, the offset of the block a
+                     graph is stored in, and the position of the graph in
+                     the block, sorted by offset
+
+    Return:
+        An iterator returning BroRecordGraph objects
+    """
+    with open(path, 'rb') as h:
+        block_offset = None
+        records = None
+        for offset, slot in locations:
+            # Graphs in the same block are next to each other in the index,
+            # so each matching block only needs to be read once
+            if offset != block_offset:
+                h.seek(offset)
+                _, _, payload = next(_read_blocks(h))
+                records = list(_records(payload))
+                block_offset = offset
+            yield pickle.loads(records[slot])
+
+
+class GraphFileWriter(object):
+    """Writes BroRecordGraphs to a graph container file.  Graphs are
+    collected in memory until there are enough for a block, and the footer
+    is written when the writer is closed.  Writers can be used as context
+    managers, which close the writer on exit.
+    """
+
+    def __init__(self, path, compress=True, append=False,
+                 block_size=DEFAULT_BLOCK_SIZE, index=True):
+        """Opens a graph file for writing.
+
+        Args:
+            path -- the path to write graphs to
+
+        Keyword Args:
+            compress   -- whether to zlib compress each block of graphs
+            append     -- if True, and a graph file already exists at the
+                          given path, graphs are added to the end of the
+                          existing file, instead of replacing it.  Legacy
+                          files of concatenated pickles are converted to
+                          the container format first.
+            block_size -- the number of bytes of pickled graphs to collect
+                          before writing them to disk as a block
+            index      -- whether to write an index of the graphs in the
+                          file, next to the file, when the writer is closed
+        """
+        self.path = path
+        self.compress = compress
+        self.block_size = block_size
+        self.count = 0
+        self.earliest_ts = None
+        self.latest_ts = None
+        self.index = GraphIndex() if index else None
+        self._records = []
+        self._records_size = 0
+
+        if append and os.path.isfile(path) and os.path.getsize(path):
+            if not is_graph_file(path):
+                # Legacy files are converted into a temporary file, which
+                # is then moved into place, so that the legacy graphs
+                # aren't lost if the conversion doesn't finish
+                tmp_path = "{0}.tmp".format(path)
+                with GraphFileWriter(tmp_path, compress=compress,
+                                     block_size=block_size,
+                                     index=index) as converted:
+                    for graph in read_graphs(path):
+                        converted.write(graph)
+                move_graph_file(tmp_path, path)
+            self._handle = open(path, 'r+b')
+            self._reopen()
+        else:
+            self._handle = open(path, 'wb')
+            self._handle.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _reopen(self):
+        """Prepares an existing graph file to have more graphs added to
+        it, by reading the summary of the graphs already in the file, and
+        then removing the file's footer."""
+        h = self._handle
+
+        # If the file already has an up to date index, the index can be
+        # extended, instead of being rebuilt from every graph in the file
+        existing_index = None
+        if self.index is not None:
+            existing_index = GraphIndex.load(self.path)
+            if existing_index is not None:
+                self.index = self._extendable(existing_index)
+
+        # Files that were closed end with a trailer pointing to their footer,
+        # so the summary can be read without reading every block
+        summary = None
+        footer_offset = _footer_offset(h)
+        if footer_offset is not None:
+            h.seek(footer_offset)
+            for _, flags, payload in _read_blocks(h):
+                if flags & BLOCK_FOOTER:
+                    summary = _summary_from_footer(payload)
+                break
+
+        # Files that were never closed have no footer, so the summary is
+        # rebuilt from the graphs in the file.  Similarly, the index is
+        # rebuilt if the file has no index.
+        rebuild_index = self.index is not None and existing_index is None
+        if summary is None or rebuild_index:
+            h.seek(len(MAGIC))
+            end = len(MAGIC)
+            for offset, flags, payload in _read_blocks(h):
+                if flags & BLOCK_FOOTER:
+                    break
+                for slot, record in enumerate(_records(payload)):
+                    graph = pickle.loads(record)
+                    if summary is None:
+                        self._update_summary(graph)
+                    if rebuild_index:
+                        self.index.add(offset, slot, graph)
+                end = h.tell()
+
+        if summary is not None:
+            self.count = summary["count"]
+            self.earliest_ts = summary["earliest_ts"]
+            self.latest_ts = summary["latest_ts"]
+            end = footer_offset
+        h.seek(end)
+        h.truncate()
+
+    @staticmethod
+    def _extendable(loaded_index):
+        """Converts an index read from disk back into one that can have
+        graphs added to it."""
+        index = GraphIndex()
+        index.extend(loaded_index)
+        return index
+
+    def _update_summary(self, graph):
+        self.count += 1
+        if self.earliest_ts is None or graph.earliest_ts < self.earliest_ts:
+            self.earliest_ts = graph.earliest_ts
+        if self.latest_ts is None or graph.latest_ts > self.latest_ts:
+            self.latest_ts = graph.latest_ts
+
+    def _write_block(self, flags, payload, num_records):
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= BLOCK_COMPRESSED
+        self._handle.write(BLOCK_HEADER.pack(flags, len(payload),
+                                             num_records))
+        self._handle.write(payload)
+
+    def flush(self):
+        """Writes any graphs collected in memory to disk, as a block."""
+        if not self._records:
+            return
+        self._write_block(0, "".join(self._records), len(self._records) // 2)
+        self._records = []
+        self._records_size = 0
+        self._handle.flush()
+
+    def write(self, graph):
+        """Adds a single graph to the file.
+
+        Args:
+            graph -- a BroRecordGraph
+        """
+        record = pickle.dumps(graph, pickle.HIGHEST_PROTOCOL)
+        if self.index is not None:
+            # Nothing is written to the file until a block is complete, so
+            # the current end of the file is where this graph's block
+            # will start
+            self.index.add(self._handle.tell(), len(self._records) // 2,
+                           graph)
+        self._records.append(RECORD_LENGTH.pack(len(record)))
+        self._records.append(record)
+        self._records_size += RECORD_LENGTH.size + len(record)
+        self._update_summary(graph)
+        if self._records_size >= self.block_size:
+            self.flush()
+
+    def write_file(self, path):
+        """Adds every graph in another graph container file to this file.
+        The other file's blocks are copied as they are, so its graphs don't
+        need to be decompressed or unpickled.  If the other file wasn't
+        completely written (ie it has no footer), its graphs are instead
+        read and written one at a time.
+
+        Args:
+            path -- the path to a graph container file
+        """
+        summary = read_summary(path)
+        if summary is None:
+            for graph in read_graphs(path):
+                self.write(graph)
+            return
+
+        self.flush()
+        shift = self._handle.tell() - len(MAGIC)
+        with open(path, 'rb') as h:
+            h.seek(len(MAGIC))
+            for _, header, payload in _read_raw_blocks(h):
+                if BLOCK_HEADER.unpack(header)[0] & BLOCK_FOOTER:
+                    break
+                self._handle.write(header)
+                self._handle.write(payload)
+
+        if summary["count"]:
+            self.count += summary["count"]
+            if self.earliest_ts is None:
+                self.earliest_ts = summary["earliest_ts"]
+                self.latest_ts = summary["latest_ts"]
+            else:
+                self.earliest_ts = min(self.earliest_ts,
+                                       summary["earliest_ts"])
+                self.latest_ts = max(self.latest_ts, summary["latest_ts"])
+
+        if self.index is not None:
+            other_index = GraphIndex.load(path)
+            if other_index is None:
+                other_index = GraphIndex.build(path)
+            self.index.extend(other_index, shift=shift)
+
+    def close(self):
+        """Writes any remaining graphs, and the file's footer, to disk and
+        closes the file."""
+        if self._handle.closed:
+            return
+        self.flush()
+        footer_offset = self._handle.tell()
+        self._write_block(BLOCK_FOOTER,
+                          FOOTER.pack(self.count, self.earliest_ts or 0.0,
+                                      self.latest_ts or 0.0), 0)
+        self._handle.write(TRAILER.pack(footer_offset, TRAILER_MAGIC))
+        self._handle.close()
+        if self.index is not None:
+            self.index.save(self.path)
+
+
+class GraphFileWriters(object):
+    """Writes graphs to many graph files at once, keeping only a limited
+    number of the files open.  When the limit is reached, the least
+    recently written to file is closed, and reopened (in append mode) if
+    more graphs are written to it later.
+    """
+
+    def __init__(self, max_open=32, **writer_args):
+        """Creates an empty collection of writers.
+
+        Keyword Args:
+            max_open    -- the maximum number of files to keep open at once
+            writer_args -- any other arguments are passed to each
+                           GraphFileWriter that is opened
+        """
+        self.max_open = max_open
+        self.paths = set()
+        self._writer_args = writer_args
+        self._writers = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, path, graph):
+        """Adds a single graph to the graph file at the given path.
+
+        Args:
+            path  -- the path to a graph file
+            graph -- a BroRecordGraph
+        """
+        try:
+            writer = self._writers.pop(path)
+        except KeyError:
+            if len(self._writers) >= self.max_open:
+                self._writers.popitem(last=False)[1].close()
+            writer = GraphFileWriter(path, append=True, **self._writer_args)
+        self._writers[path] = writer
+        self.paths.add(path)
+        writer.write(graph)
+
+    def close(self):
+        """Closes every open graph file."""
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
@@ -2,11 +2,18 @@
 of BroRecords as a DAG, with each node's successor being the page that
 lead to a given page, and its children being the pages visted next."""
 
-import networkx as nx
+import os
 import logging
 import re
+import bisect
 import hashlib
+import heapq
+import itertools
+import tempfile
+import zlib
+from array import array
 from .records import bro_records
+from .graphfile import GraphIndex, read_graphs, read_graphs_at
 from .chains import BroRecordChain
 
 try:
@@ -16,6 +23,13 @@ except ImportError:
 
 FILE_TS_PATTERN = re.compile('[0-9]{10}')
 
+# Policies for picking which node in a graph is the referrer of a record,
+# when more than one earlier node in the graph requested the record's
+# referrer url.  With EARLIEST, the earliest such node is picked, and with
+# NEAREST_EARLIER, the latest node requested before the record is picked.
+EARLIEST = "earliest"
+NEAREST_EARLIER = "nearest-earlier"
+
 
 def _timestamp_for_filename(filename):
     """Collections of BroRecordGraphs are are saved with filenames like
@@ -43,128 +57,501 @@ def _graphs_from_file(filename):
     of the given filename.
 
     Args:
-        filename -- a filename, or filepath, to a file on disk containing
+        filename -- a filename, or filepath, to a graph file on disk, either
+                    in the graph container format, or a legacy file of
                     pickled graphs
     """
     log = logging.getLogger("brorecords")
     index = 0
-    with open(filename, 'r') as h:
-        while True:
-            try:
-                index += 1
-                if index % 10000 == 0:
-                    log.info(" * Completed graph: {0}".format(index))
-                yield pickle.load(h)
-            except EOFError:
-                break
-            except:
-                log.info(" * Pickle error, skipping: {0}".format(filename))
-                pass
-
-
-def merge(filelist, time=10):
-    """Attempts to merge BroRecordGraph that represent one logical graph /
-    browsing session, but where the log divisions cause the single session
-    to be split across multiple different graphs.
+    for graph in read_graphs(filename):
+        index += 1
+        if index % 10000 == 0:
+            log.info(" * Completed graph: {0}".format(index))
+        yield graph
+
+
+def client_shard(ip, user_agent, num_shards):
+    """Returns which of a number of shards the graphs for a client belong
+    to.  Graphs are only ever merged with graphs for the same client, so
+    each shard of graphs can be merged independently of the others.
 
     Args:
-        filelist -- a list of filenames, in the format
-                    http-requests.1388592000.log.pickles. This list should be
-                    sorted by the timestamps in the filenames
+        ip         -- the ip of the client
+        user_agent -- the user agent of the client
+        num_shards -- the number of shards graphs are split between
 
-    Keyword Args:
-        time  -- the maximum amount of time that can have passed in
-                 a browsing session before the graph is closed and yielded
-        state -- if set, the iterator also yields back the state of the
-                 generator.  Only really useful for debugging
+    Return:
+        An integer between 0 and num_shards - 1
+    """
+    client_key = u"{0}|{1}".format(ip, user_agent).encode("utf-8")
+    return (zlib.crc32(client_key) & 0xffffffff) % num_shards
+
+
+def shard_loader(shard, num_shards):
+    """Returns a function that reads only the graphs in a given shard out of
+    a graph file, for use as the loader passed to `merge`.  If a file has an
+    index, only the shard's graphs are unpickled, and otherwise every graph
+    in the file is read and checked.
+
+    Args:
+        shard      -- the shard to read graphs for, as returned by
+                      `client_shard`
+        num_shards -- the number of shards graphs are split between
 
     Return:
-        Yields pairs of values.  The first value is a BroRecordGraph, and
-        the second value is a boolean description of whether the graph has been
-        changed (ie if it has absorbed another graph)
+        A function that takes the path to a graph file, and returns an
+        iterator of the BroRecordGraphs in the file that are in the shard
     """
-    log = logging.getLogger("brorecords")
+    def _shard_graphs(filename):
+        index = GraphIndex.load(filename)
+        if index is None:
+            for graph in _graphs_from_file(filename):
+                if client_shard(graph.ip, graph.user_agent,
+                                num_shards) == shard:
+                    yield graph
+            return
+
+        # The shard is checked once per distinct client in the file, using
+        # the client columns of the index.  Missing values are coded as -1,
+        # so None is added to the end of each list of values.
+        ips = index.ips.values + [None]
+        user_agents = index.user_agents.values + [None]
+        client_shards = {}
+        clients = zip(index.ip_codes.tolist(),
+                      index.user_agent_codes.tolist())
+        locations = zip(index.offsets.tolist(), index.slots.tolist())
+        shard_locations = []
+        for client, location in zip(clients, locations):
+            try:
+                graph_shard = client_shards[client]
+            except KeyError:
+                ip_code, ua_code = client
+                graph_shard = client_shard(ips[ip_code], user_agents[ua_code],
+                                           num_shards)
+                client_shards[client] = graph_shard
+            if graph_shard == shard:
+                shard_locations.append(location)
+        for graph in read_graphs_at(filename, shard_locations):
+            yield graph
 
-    state = {
-        # A collection of graphs, keyed by a client specific hash.  Keys
-        # are the client hashes, and values are a set of graph, path pairs
-        "potential_mergers_by_client": {},
-        "graphs_for_client": {},
-        # Keep track of which graphs were altered by having child graphs
-        # merged into them
-        "changed": set()
-    }
+    return _shard_graphs
 
-    log_timestamps = [_timestamp_for_filename(f) for f in filelist]
-    log_merge_ranges = [(t - time, t, t + time) for t in log_timestamps]
 
-    def _client_hash(graph):
-        return graph.ip + "|" + graph.user_agent
+def _could_be_merger(graph, boundaries, time):
+    """Checks to see if the given graph could be a graph that should
+    receive other child graphs which represent the same logical browsing
+    session, but which were stored in a different graph because of how
+    the logs are segmented by time.  This is the case if the graph's last
+    record was made no more than `time` seconds before a log starts.
+
+    Args:
+        graph      -- a BroRecordGraph object
+        boundaries -- a sorted list of the times each log starts at
+        time       -- the maximum amount of time that can have passed in
+                      a browsing session
+
+    Return:
+        A boolean description of whether the graph could possibly have
+        child graphs in another file.
+    """
+    latest_ts = graph.latest_ts
+    i = bisect.bisect_left(boundaries, latest_ts)
+    return i < len(boundaries) and boundaries[i] <= latest_ts + time
+
+
+def _could_be_mergee(graph, boundaries, time):
+    """Checks to see if the graph could possibly be a child of a graph
+    stored in an earlier file, such that both graphs represent the same
+    logical browsing session, but the underlying BroRecords were split
+    into two or more graphs because of log partition.  This is the case if
+    the graph's first record was made no more than `time` seconds after a
+    log starts.
 
-    def _could_be_merger(graph):
-        """Checks to see if the given graph could be a graph that should
-        receive other child graphs which represent the same logical browsing
-        session, but which were stored in a different graph because of how
-        the logs are segmented by time.
+    Args:
+        graph      -- a BroRecordGraph object
+        boundaries -- a sorted list of the times each log starts at
+        time       -- the maximum amount of time that can have passed in
+                      a browsing session
+
+    Returns:
+        A boolean description of whether a graph could be merged into
+        a parent graph.
+    """
+    earliest_ts = graph.earliest_ts
+    i = bisect.bisect_right(boundaries, earliest_ts) - 1
+    return i >= 0 and boundaries[i] >= earliest_ts - time
+
+
+class _PendingGraph(object):
+    """A graph being held by `merge` as a potential merger, which is either
+    in memory, or spilled to disk."""
+
+    __slots__ = ("graph", "path", "client_key", "latest_ts", "changed",
+                 "offset", "removed")
+
+    def __init__(self, graph, path, client_key, changed=False):
+        self.graph = graph
+        self.path = path
+        self.client_key = client_key
+        self.latest_ts = graph.latest_ts
+        self.changed = changed
+        # The position of the pickled graph in the spill file, if the graph
+        # has been spilled to disk
+        self.offset = None
+        self.removed = False
+
+
+def _latest_ts(item):
+    """Returns the time of the latest record in a held graph, which may have
+    grown by absorbing other graphs since it was first held."""
+    return item.latest_ts if item.graph is None else item.graph.latest_ts
+
+
+class _PendingMergers(object):
+    """The graphs `merge` is holding on to, because they could absorb
+    graphs in later logs, grouped by client.  Graphs are also kept in order
+    of their latest record, so that graphs that can no longer be merged with
+    anything are found without checking every graph.
+
+    If a limit on the number of graphs to keep in memory is given, the
+    graphs with the earliest latest records are pickled to a temporary file
+    once the limit is exceeded, and read back in when a graph for the same
+    client needs them.
+    """
+
+    def __init__(self, time, max_in_memory=None):
+        """Creates an empty collection of graphs.
 
         Args:
-            graph -- a BroRecordGraph object
+            time -- the maximum amount of time that can have passed in a
+                    browsing session
+
+        Keyword Args:
+            max_in_memory -- if provided, the most graphs to keep in memory
+                             at once
+        """
+        self.time = time
+        self.max_in_memory = max_in_memory
+        self.num_in_memory = 0
+        self.num_spilled = 0
+        self._by_client = {}
+        self._order = itertools.count()
+        # Heaps of (latest_ts, order, _PendingGraph) tuples, one of every
+        # held graph, for finding graphs that can no longer be merged, and
+        # one of the graphs in memory, for finding graphs to spill.  Graphs
+        # that absorb other graphs have later latest records than they were
+        # pushed with, and are pushed again when they are popped.
+        self._expiry_heap = []
+        self._spill_heap = []
+        self._spill_file = None
+
+    def __len__(self):
+        return self.num_in_memory + self.num_spilled
+
+    def add(self, graph, path, client_key, changed=False):
+        """Holds on to a graph.
+
+        Args:
+            graph      -- a BroRecordGraph
+            path       -- the file path that this graph was extracted from
+            client_key -- the key for the client that made the graph's
+                          requests
+
+        Keyword Args:
+            changed -- whether the graph has already absorbed other graphs
+        """
+        item = _PendingGraph(graph, path, client_key, changed)
+        self._by_client.setdefault(client_key, []).append(item)
+        order = next(self._order)
+        heapq.heappush(self._expiry_heap, (item.latest_ts, order, item))
+        heapq.heappush(self._spill_heap, (item.latest_ts, order, item))
+        self.num_in_memory += 1
+        if (self.max_in_memory is not None and
+                self.num_in_memory > self.max_in_memory):
+            self._spill()
+
+    def _spill(self):
+        log = logging.getLogger("brorecords")
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        h = self._spill_file
+        h.seek(0, os.SEEK_END)
+        num_spilled = 0
+        while self.num_in_memory > self.max_in_memory and self._spill_heap:
+            latest_ts, _, item = heapq.heappop(self._spill_heap)
+            if item.removed or item.graph is None:
+                continue
+            if item.graph.latest_ts != latest_ts:
+                heapq.heappush(self._spill_heap, (item.graph.latest_ts,
+                                                  next(self._order), item))
+                continue
+            item.latest_ts = item.graph.latest_ts
+            item.offset = h.tell()
+            pickle.dump(item.graph, h, pickle.HIGHEST_PROTOCOL)
+            item.graph = None
+            self.num_in_memory -= 1
+            self.num_spilled += 1
+            num_spilled += 1
+        if num_spilled:
+            log.debug(" * Spilled {0} pending graphs to disk".format(
+                      num_spilled))
+
+    def _load(self, item):
+        """Reads a spilled graph back into memory."""
+        h = self._spill_file
+        h.seek(item.offset)
+        item.graph = pickle.load(h)
+        item.offset = None
+        self.num_in_memory += 1
+        self.num_spilled -= 1
+        heapq.heappush(self._spill_heap, (item.graph.latest_ts,
+                                          next(self._order), item))
+
+    def for_client(self, client_key):
+        """Returns the graphs held for a client, reading any that were
+        spilled to disk back into memory.
+
+        Args:
+            client_key -- the key for a client
 
         Return:
-            A boolean description of whether the graph could possibly have
-            child graphs in another file.
+            A list of zero or more _PendingGraph objects
         """
-        latest_ts = graph.latest_ts
+        items = self._by_client.get(client_key, [])
+        for item in items:
+            if item.graph is None:
+                self._load(item)
+        return items
+
+    def _remove(self, item):
+        item.removed = True
+        if item.graph is None:
+            self._load(item)
+        self.num_in_memory -= 1
+        items = self._by_client[item.client_key]
+        items.remove(item)
+        if not items:
+            del self._by_client[item.client_key]
+
+    def prune(self, client_key, start):
+        """Removes the graphs for a client that are too old to be merged with
+        a graph starting at the given time.
 
-        for start, mid, end in log_merge_ranges:
-            # If the current range is strictly later than all records in the
-            # graph, then it means that all possible range comparisons will
-            # be false, so we can stop looking any further
-            if start > latest_ts and end > latest_ts:
-                return False
+        Args:
+            client_key -- the key for a client
+            start      -- the time of the earliest record in a graph
 
-            if latest_ts >= start and latest_ts <= mid:
-                return True
-        return False
+        Return:
+            A list of zero or more _PendingGraph objects that were removed
+        """
+        removed = [item for item in self._by_client.get(client_key, ())
+                   if _latest_ts(item) + self.time < start]
+        for item in removed:
+            self._remove(item)
+        return removed
 
-    def _yield_back_merger(graph, path):
-        try:
-            state['changed'].remove(graph)
-            is_changed = True
-        except KeyError:
-            is_changed = False
-        return path, graph, is_changed
+    def expire(self, start):
+        """Removes every graph that is too old to be merged with any graph
+        starting at, or after, the given time.
 
-    def _all_potential_mergers():
-        """Returns an iterator for all remaining, potential merger graphs
-        still in the collection, to make sure that we return the held over
-        graphs even after we've finished considering all the graphs in
-        all of the files in the workset.
+        Args:
+            start -- a time that every later graph starts at or after
 
         Return:
-            An iterator that returns pairs of BroRecordGraph objects
-            and filepath strings that the graph came from
+            A list of zero or more _PendingGraph objects that were removed,
+            ordered by their latest records
         """
-        for key in state['potential_mergers_by_client']:
-            for record in state['potential_mergers_by_client'][key]:
-                yield record
+        removed = []
+        heap = self._expiry_heap
+        while heap and heap[0][0] + self.time < start:
+            latest_ts, _, item = heapq.heappop(heap)
+            if item.removed:
+                continue
+            if _latest_ts(item) != latest_ts:
+                heapq.heappush(heap, (_latest_ts(item), next(self._order),
+                                      item))
+                continue
+            self._remove(item)
+            removed.append(item)
+        return removed
 
-    def _add_graph_as_potential_merger(graph, path):
-        """Records the given graph and path pair as potential mergers that
-        should be checked as possible parents of graphs found in future
-        files.
+    def remove_all(self):
+        """Removes every graph.
+
+        Return:
+            A list of every _PendingGraph object that was held
+        """
+        removed = [item for items in self._by_client.values()
+                   for item in items]
+        for item in removed:
+            self._remove(item)
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        return removed
+
+
+class MergeCheckpoint(object):
+    """The graphs `merge` was still holding on to when it finished, because
+    they end close enough to the start of the next log (one that wasn't
+    included in the merge) that they could absorb graphs from that log.
+    Passing a checkpoint to a later merge, over the next logs, gives the
+    same graphs as merging all of the logs at once.
+    """
+
+    # Written at the start of every checkpoint file.  This should be changed
+    # any time the layout of the checkpoint changes.
+    MAGIC = "BROMERGECHECKPOINT 1"
+
+    def __init__(self, next_boundary=None, period=None, mergers=None):
+        """Creates a checkpoint.
+
+        Keyword Args:
+            next_boundary -- the time the next log, after the logs that were
+                             merged, starts at
+            period        -- the number of seconds each log covers
+            mergers       -- a list of tuples of three values, a graph that
+                             could absorb graphs in the next log, the path
+                             of the file the graph came from, and whether
+                             the graph has already absorbed another graph
+        """
+        self.next_boundary = next_boundary
+        self.period = period
+        self.mergers = mergers or []
+
+    def __len__(self):
+        return len(self.mergers)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a checkpoint from disk.
 
         Args:
-            graph -- a BroRecordGraph
-            path  -- the file path that this graph was extracted from
+            path -- the path to a checkpoint, written by `save`
+
+        Return:
+            A MergeCheckpoint instance, or None if there is no checkpoint at
+            the given path
         """
-        client_key = _client_hash(graph)
-        record = (graph, path)
-        try:
-            state['potential_mergers_by_client'][client_key].add(record)
-        except KeyError:
-            state['potential_mergers_by_client'][client_key] = set()
-            state['potential_mergers_by_client'][client_key].add(record)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as h:
+            if h.readline()[:-1] != cls.MAGIC:
+                raise ValueError("{0} is not a merge checkpoint".format(path))
+            state = pickle.load(h)
+        return cls(**state)
+
+    def save(self, path):
+        """Writes the checkpoint to disk.  The checkpoint is written to a
+        temporary file first, and then moved into place, so that a partly
+        written checkpoint is never read.
+
+        Args:
+            path -- the path to write the checkpoint to
+        """
+        state = {
+            "next_boundary": self.next_boundary,
+            "period": self.period,
+            "mergers": self.mergers,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as h:
+            h.write(self.MAGIC + "\n")
+            pickle.dump(state, h, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def for_shard(self, shard, num_shards):
+        """Returns a copy of the checkpoint, holding only the graphs for the
+        clients in the given shard (as returned by `client_shard`)."""
+        mergers = [m for m in self.mergers
+                   if client_shard(m[0].ip, m[0].user_agent,
+                                   num_shards) == shard]
+        return MergeCheckpoint(self.next_boundary, self.period, mergers)
+
+    def extend(self, other):
+        """Adds the graphs held in another checkpoint, for the same logs, to
+        this checkpoint."""
+        self.mergers += other.mergers
+
+
+def merge(filelist, time=10, loader=None, checkpoint=None,
+          checkpoint_path=None, period=None, max_pending=None):
+    """Attempts to merge BroRecordGraph that represent one logical graph /
+    browsing session, but where the log divisions cause the single session
+    to be split across multiple different graphs.
+
+    Args:
+        filelist -- a list of filenames, in the format
+                    http-requests.1388592000.log.pickles. This list should be
+                    sorted by the timestamps in the filenames
+
+    Keyword Args:
+        time            -- the maximum amount of time that can have passed
+                           in a browsing session before the graph is closed
+                           and yielded
+        loader          -- if provided, a function that takes the path to a
+                           graph file and returns an iterator of the graphs
+                           to merge from that file (such as one returned by
+                           `shard_loader`).  Defaults to reading every graph
+                           in each file.
+        checkpoint      -- if provided, a MergeCheckpoint from a merge of
+                           the logs before those in `filelist`, holding
+                           graphs that could absorb graphs in these logs
+        checkpoint_path -- if provided, the graphs that could absorb graphs
+                           in the log after those in `filelist` are written
+                           to a MergeCheckpoint at this path, instead of
+                           being yielded
+        period          -- the number of seconds each log covers, used to
+                           find when the log after those in `filelist`
+                           starts when writing a checkpoint.  Defaults to
+                           the time between the last two logs (or the
+                           period of the given checkpoint).
+        max_pending     -- if provided, the most graphs that could absorb
+                           graphs in later files to keep in memory at once.
+                           When there are more, the graphs with the
+                           earliest latest records are spilled to a
+                           temporary file, until a graph for the same
+                           client is found.
+
+    Return:
+        Yields pairs of values.  The first value is a BroRecordGraph, and
+        the second value is a boolean description of whether the graph has been
+        changed (ie if it has absorbed another graph)
+    """
+    log = logging.getLogger("brorecords")
+
+    # The times each log starts at, sorted so that the boundaries near a
+    # graph can be found with a binary search
+    log_boundaries = sorted(_timestamp_for_filename(f) for f in filelist)
+
+    # When writing a checkpoint, graphs near the start of the next log are
+    # held on to as potential mergers, just as if the next log was being
+    # merged too.
+    if period is None and len(log_boundaries) > 1:
+        period = log_boundaries[-1] - log_boundaries[-2]
+    elif period is None and checkpoint is not None:
+        period = checkpoint.period
+    next_boundary = None
+    if checkpoint_path:
+        if log_boundaries and period:
+            next_boundary = log_boundaries[-1] + period
+        elif checkpoint is not None:
+            next_boundary = checkpoint.next_boundary
+        if next_boundary is None:
+            raise ValueError("Unable to determine when the next log " +
+                             "starts, without the period of the logs")
+        log_boundaries.append(next_boundary)
+
+    # The graphs that could receive child graphs from later files, keyed by
+    # client, along with whether each has been altered by having child
+    # graphs merged into it
+    pending = _PendingMergers(time, max_in_memory=max_pending)
+
+    def _client_hash(graph):
+        return graph.ip + "|" + graph.user_agent
+
+    def _yield_back_merger(item):
+        return item.path, item.graph, item.changed
 
     def _parent_merge_graph(graph):
         """Checks to see if the give graph should be merged with a parent
@@ -178,15 +565,10 @@ def merge(filelist, time=10):
             and otherwise the BroRecordGraph object the given graph was
             merged into.
         """
-        client_key = _client_hash(graph)
-        try:
-            client_records = state['potential_mergers_by_client'][client_key]
-            for old_graph, old_path in client_records:
-                if old_graph.add_graph(graph):
-                    state['changed'].add(old_graph)
-                    return old_graph
-        except KeyError:
-            pass
+        for item in pending.for_client(_client_hash(graph)):
+            if item.graph.add_graph(graph):
+                item.changed = True
+                return item.graph
         return None
 
     def _prune_mergers(graph):
@@ -198,70 +580,40 @@ def merge(filelist, time=10):
                      recent graph (by start date) observed so far
 
         Return:
-            A list of zero or more graphs that were pruned out of the
-            collection
+            A list of zero or more held graphs, as _PendingGraph objects,
+            that were pruned out of the collection
         """
-        start = graph.earliest_ts
-        client_key = _client_hash(graph)
-        removed_graphs = []
-
-        try:
-            client_records = state['potential_mergers_by_client'][client_key]
-        except KeyError:
-            return removed_graphs
-
-        # Common case, where there are no possible mergeable graphs
-        # for the client
-        if len(client_records) == 0:
-            return removed_graphs
-
-        for record in client_records:
-            old_graph, old_path = record
-            if old_graph.latest_ts + time < start:
-                removed_graphs.append(record)
-
-        for ex_record in removed_graphs:
-            client_records.remove(ex_record)
-        return removed_graphs
-
-    def _could_be_mergee(graph):
-        """Checks to see if the graph could possibly be a child of a graph
-        stored in an earlier file, such that both graphs represent the same
-        logical browsing session, but the underlying BroRecords were split
-        into two or more graphs because of log partition.
-
-        Args:
-            graph -- a BroRecordGraph object
-
-        Returns:
-            A boolean description of whether a graph could be merged into
-            a parent graph.
-        """
-        earliest_ts = graph.earliest_ts
-        latest_ts = graph.latest_ts
-
-        for start, mid, end in log_merge_ranges:
-            # If the current range is strictly later than all records in the
-            # graph, then it means that all possible range comparisons will
-            # be false, so we can stop looking any further
-            if start > latest_ts and end > latest_ts:
-                return False
-
-            if earliest_ts >= mid and earliest_ts <= end:
-                return True
-        return False
+        return pending.prune(_client_hash(graph), graph.earliest_ts)
 
     # Everything above is just creating closures to ease managing the merging
     # -tracking-data-structures.  Actual code / usage / action starts here...
+    if checkpoint is not None:
+        if log_boundaries and checkpoint.next_boundary != log_boundaries[0]:
+            log.info("Checkpoint is for a log starting at {0}, not {1}".format(
+                     checkpoint.next_boundary, log_boundaries[0]))
+        for old_graph, old_path, is_changed in checkpoint.mergers:
+            pending.add(old_graph, old_path, _client_hash(old_graph),
+                        changed=is_changed)
+
+    loader = loader or _graphs_from_file
     for path in filelist:
-        for graph in _graphs_from_file(path):
+        # The earliest start of any graph in this file.  Bro writes requests
+        # to the log that is open when they're logged, so graphs can start
+        # a little before the log they're in, but not before the graphs in
+        # the previous log.
+        earliest_in_file = None
+
+        for graph in loader(path):
+            if (earliest_in_file is None or
+                    graph.earliest_ts < earliest_in_file):
+                earliest_in_file = graph.earliest_ts
 
             # First check to see if its possible for this graph to
             # be merged into another one (either as a parent or a child).
             # If not, which is the common case, we can just immediatly
             # yield the value back as being unchanged from its source file
-            possible_merger = _could_be_merger(graph)
-            possible_mergee = _could_be_mergee(graph)
+            possible_merger = _could_be_merger(graph, log_boundaries, time)
+            possible_mergee = _could_be_mergee(graph, log_boundaries, time)
             if not possible_merger and not possible_mergee:
                 yield path, graph, False
                 continue
@@ -277,9 +629,8 @@ def merge(filelist, time=10):
             # since the yielded back graphs were already going to be
             # semi out of order, they'd need to be sorted anyway, so no
             # biggie
-            pruned_merger_graphs = _prune_mergers(graph)
-            for old_graph, old_path in pruned_merger_graphs:
-                yield _yield_back_merger(old_graph, old_path)
+            for item in _prune_mergers(graph):
+                yield _yield_back_merger(item)
 
             # Next, we check to see if the graph under consideration
             # occurs late enough in its log to be possibly the parent
@@ -288,7 +639,7 @@ def merge(filelist, time=10):
             # deal with later, when its no longer possible for them to
             # be parents of future graphs.
             if possible_merger:
-                _add_graph_as_potential_merger(graph, path)
+                pending.add(graph, path, _client_hash(graph))
                 continue
 
             # The only remaining option then is that the graph under
@@ -307,11 +658,28 @@ def merge(filelist, time=10):
             yield path, graph, False
             continue
 
-    for old_graph, old_path in _all_potential_mergers():
-        yield _yield_back_merger(old_graph, old_path)
+        # Every graph in later files starts after the earliest graph in this
+        # file, so any held graph that ended more than `time` seconds before
+        # then can't absorb any more graphs
+        if earliest_in_file is not None:
+            for item in pending.expire(earliest_in_file):
+                yield _yield_back_merger(item)
+
+    held_mergers = []
+    for item in pending.remove_all():
+        # Graphs that could still absorb graphs in the next log are
+        # written to the checkpoint, instead of being yielded
+        if checkpoint_path and item.graph.latest_ts + time >= next_boundary:
+            held_mergers.append((item.graph, item.path, item.changed))
+            continue
+        yield _yield_back_merger(item)
+
+    if checkpoint_path:
+        MergeCheckpoint(next_boundary, period, held_mergers).save(
+            checkpoint_path)
 
 
-def graphs(handle, time=10, record_filter=None):
+def graphs(handle, time=10, record_filter=None, referrer_policy=EARLIEST):
     """A generator function yields BroRecordGraph objects that represent
     pages visited in a browsing session.
 
@@ -328,75 +696,315 @@ def graphs(handle, time=10, record_filter=None):
                          Note that this is in addition to the filtering /
                          matching already performed by the
                          `BroRecordChain.add_record` function
+        referrer_policy -- either EARLIEST or NEAREST_EARLIER, describing
+                           which node is picked as the referrer of a record
+                           when more than one node in a graph could be
+
+    Return:
+        An iterator returns BroRecordGraph objects
+    """
+    records = bro_records(handle, record_filter=record_filter)
+    return graphs_from_records(records, time=time,
+                               referrer_policy=referrer_policy)
+
+
+def graphs_from_records(records, time=10, referrer_policy=EARLIEST):
+    """A generator function yields BroRecordGraph objects that represent
+    pages visited in a browsing session, built from an already parsed
+    collection of BroRecords, such as those returned from `bro_records`.
+
+    Args:
+        records -- an iterable of BroRecord objects, sorted by time
+
+    Keyword Args:
+        time            -- the maximum amount of time that can have passed
+                           in a browsing session before the graph is closed
+                           and yielded
+        referrer_policy -- either EARLIEST or NEAREST_EARLIER, describing
+                           which node is picked as the referrer of a record
+                           when more than one node in a graph could be
 
     Return:
         An iterator returns BroRecordGraph objects
     """
     # To avoid needing to iterate over all the graphs, keys in this collection
     # are a simple concatination of IP and user agent, and the values
-    # are all the currently active graphs being tracked for that client
+    # are _ClientGraphs objects, holding all the currently active graphs
+    # being tracked for that client
     all_client_graphs = {}
-    for r in bro_records(handle, record_filter=record_filter):
+
+    # Graphs are closed once the time of the current record is more than
+    # `time` seconds after the most recent record in the graph, regardless
+    # of whether the client has made any more requests.  Each active graph
+    # has one entry in this heap, a tuple of (latest_ts, order, client key,
+    # graph), so that the graph that has gone the longest without a new
+    # record is always at the front.  Since graphs keep growing after
+    # they're pushed, the timestamp in an entry can be out of date, in
+    # which case the entry is pushed back onto the heap with the graph's
+    # current latest timestamp, when it reaches the front.
+    expiry_heap = []
+    order = itertools.count()
+
+    for r in records:
+        while expiry_heap and (r.ts - expiry_heap[0][0]) > time:
+            latest_ts, _, hash_key, g = heapq.heappop(expiry_heap)
+            if g.latest_ts != latest_ts:
+                heapq.heappush(expiry_heap,
+                               (g.latest_ts, next(order), hash_key, g))
+                continue
+
+            # Remove clients from the collection when they no longer have
+            # any active graphs, so that clients that are only seen briefly
+            # don't stay in memory through the entire log
+            client_graphs = all_client_graphs[hash_key]
+            client_graphs.remove(g)
+            if not len(client_graphs):
+                del all_client_graphs[hash_key]
+            yield g
+
         hash_key = r.id_orig_h + "|" + r.user_agent
 
-        # By default, assume that we've seen a request by this client
-        # before, so start looking for a graph we can add this record to
-        # to in the list of all graphs currently tracked for the client
+        # If we've seen a request by this client before, then see if the
+        # record belongs in any of the graphs currently tracked for the
+        # client.  If we haven't seen any requests for this client, or
+        # none of the client's graphs have a referrer for the record,
+        # start a new graph with the record.
         try:
-            graphs = all_client_graphs[hash_key]
-            found_graph_for_record = False
-            dirty_graphs = []
-            for g in graphs:
-                # First make sure that our graphs are not too old.  If they
-                # are, yield them and then remove them from our considered
-                # set
-                if (r.ts - g.latest_ts) > time:
-                    yield g
-                    dirty_graphs.append(g)
-                    continue
-
-                # If the current graph is not too old to represent a valid
-                # browsing session then, see if it is valid for the given
-                # bro record.  If so, then we don't need to consider any other
-                # graphs on this iteration
-                if g.add_node(r):
-                    found_graph_for_record = True
-                    break
-
-            # Last, if we haven't found a graph to add the current record to,
-            # create a new graph and add the record to it
-            if not found_graph_for_record:
-                graphs.append(BroRecordGraph(r))
-
-            for dg in dirty_graphs:
-                graphs.remove(dg)
-
-        # If we've never seen any requests for this client, then
-        # there is no way the request could be part of any graph we're tracking
-        # so create a new collection of graphs to search
+            client_graphs = all_client_graphs[hash_key]
         except KeyError:
-            all_client_graphs[hash_key] = [BroRecordGraph(r)]
+            client_graphs = _ClientGraphs(referrer_policy)
+            all_client_graphs[hash_key] = client_graphs
+
+        g = client_graphs.add_record(r)
+        if g:
+            heapq.heappush(expiry_heap,
+                           (g.latest_ts, next(order), hash_key, g))
 
     # Last, if we've considered every bro record in the collection, we need to
     # yield the remaining graphs to the caller, to make sure they see
     # ever relevant record
-    for graphs in all_client_graphs.values():
-        for g in graphs:
+    for client_graphs in all_client_graphs.values():
+        for g in client_graphs.graphs:
             yield g
 
 
+class _ClientGraphs(object):
+    """The active graphs for a single client (ie IP and user agent) in
+    `graphs_from_records`.  Along with the graphs themselves, this keeps
+    an index of which of the client's graphs have requested each url, so
+    that the graph a new record belongs in can be found without asking each
+    graph in turn.
+    """
+
+    def __init__(self, referrer_policy=EARLIEST):
+        self.referrer_policy = referrer_policy
+
+        # All of the client's active graphs, in the order they were created
+        self.graphs = []
+
+        # Each graph is numbered in the order it was created, so that when
+        # more than one graph could hold a record, the record is added to
+        # the oldest one, the same as if each graph was checked in order
+        self._order = itertools.count()
+        self._graph_orders = {}
+
+        # Keys here are urls, and values are dicts, mapping the number of
+        # each graph with a node requesting the url to a tuple of the graph,
+        # and the timestamp of the earliest node in the graph requesting
+        # the url
+        self._graphs_by_url = {}
+
+    def __len__(self):
+        return len(self.graphs)
+
+    def _index(self, graph_order, graph, node):
+        url = node.url
+        try:
+            graphs_for_url = self._graphs_by_url[url]
+        except KeyError:
+            self._graphs_by_url[url] = {graph_order: (graph, node.ts)}
+            return
+
+        try:
+            _, earliest_ts = graphs_for_url[graph_order]
+            if node.ts < earliest_ts:
+                graphs_for_url[graph_order] = (graph, node.ts)
+        except KeyError:
+            graphs_for_url[graph_order] = (graph, node.ts)
+
+    def add_record(self, br):
+        """Adds a BroRecord to the client's graphs.  The record is added to
+        the oldest graph that has a node that could be the referrer of the
+        record (as a child of the node `BroRecordGraph.referrer_record`
+        picks).  If no graph has a node that could be the record's
+        referrer, a new graph is started with the record.
+
+        Args:
+            br -- a BroRecord object, made by the same client as the other
+                  records in the client's graphs
+
+        Return:
+            A new BroRecordGraph, if one was created for the record, and
+            otherwise None.
+        """
+        best_order = None
+        try:
+            graphs_for_url = self._graphs_by_url[br.referrer]
+            for graph_order, (graph, first_ts) in graphs_for_url.iteritems():
+                if first_ts < br.ts and (best_order is None or
+                                            graph_order < best_order):
+                    best_order = graph_order
+                    best_graph = graph
+        except KeyError:
+            pass
+
+        if best_order is not None:
+            best_graph.add_node(br)
+            self._index(best_order, best_graph, br)
+            return None
+
+        graph = BroRecordGraph(br, referrer_policy=self.referrer_policy)
+        graph_order = next(self._order)
+        self._graph_orders[graph] = graph_order
+        self.graphs.append(graph)
+        self._index(graph_order, graph, br)
+        return graph
+
+    def remove(self, graph):
+        """Removes a graph, and all of its nodes, from the client's
+        active graphs.
+
+        Args:
+            graph -- a BroRecordGraph, previously returned from `add_record`
+        """
+        self.graphs.remove(graph)
+        graph_order = self._graph_orders.pop(graph)
+        for url in graph.urls():
+            graphs_for_url = self._graphs_by_url[url]
+            del graphs_for_url[graph_order]
+            if not graphs_for_url:
+                del self._graphs_by_url[url]
+
+
+def _count_earlier(nodes, ts):
+    """Returns the number of BroRecords in a time sorted list of records that
+    were requested before the given time.
+
+    Args:
+        nodes -- a list of BroRecords, sorted by ts
+        ts    -- a timestamp, as a float
+
+    Return:
+        An integer, the index of the first record in the list that was not
+        requested before the given time
+    """
+    low, high = 0, len(nodes)
+    while low < high:
+        mid = (low + high) // 2
+        if nodes[mid].ts < ts:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def _insert_sorted(nodes, br):
+    """Inserts a BroRecord into a time sorted list of records, after any
+    records in the list with the same timestamp.
+
+    Args:
+        nodes -- a list of BroRecords, sorted by ts
+        br    -- a BroRecord
+    """
+    # Records are almost always added in time order, in which case the
+    # record can just be added to the end of the list.  Otherwise, find
+    # where the record goes with a binary search.
+    if not nodes or br.ts >= nodes[-1].ts:
+        nodes.append(br)
+        return
+    low, high = 0, len(nodes)
+    while low < high:
+        mid = (low + high) // 2
+        if br.ts < nodes[mid].ts:
+            high = mid
+        else:
+            low = mid + 1
+    nodes.insert(low, br)
+
+
+def _merge_sorted_nodes(nodes, other_nodes):
+    """Merges two lists of BroRecords, each sorted by time, into a single
+    sorted list.  Where records in the two lists have the same timestamp,
+    the records in the first list come first.
+
+    Args:
+        nodes       -- a list of BroRecords, sorted by ts
+        other_nodes -- a list of BroRecords, sorted by ts
+
+    Return:
+        A new list of BroRecords, sorted by ts
+    """
+    if not other_nodes:
+        return nodes
+    merged = []
+    i, j = 0, 0
+    num_nodes, num_other_nodes = len(nodes), len(other_nodes)
+    while i < num_nodes and j < num_other_nodes:
+        if other_nodes[j].ts < nodes[i].ts:
+            merged.append(other_nodes[j])
+            j += 1
+        else:
+            merged.append(nodes[i])
+            i += 1
+    merged.extend(nodes[i:])
+    merged.extend(other_nodes[j:])
+    return merged
+
+
 class BroRecordGraph(object):
+    """A tree of BroRecords, all made by the same client, where each record's
+    parent is the record for the page that referred the client to it.
+
+    Each node is numbered (its ordinal) in the order it was added to the
+    graph.  The structure of the tree is stored as the ordinal of each node's
+    parent, and lists of the ordinals of each node's children, instead of
+    as a networkx graph, since millions of these graphs are held in memory
+    and pickled at a time.  A networkx.DiGraph version of the graph can be
+    built with `graph()`.
+    """
 
-    def __init__(self, br):
-        self._g = nx.DiGraph()
+    def __init__(self, br, referrer_policy=EARLIEST):
         self.ip = br.id_orig_h
         self.user_agent = br.user_agent
 
+        # Either EARLIEST or NEAREST_EARLIER, describing which node is
+        # returned from `referrer_record` when more than one node in the
+        # graph could be a record's referrer
+        self.referrer_policy = referrer_policy
+
         # The root element of the graph can either be the referrer of the given
         # bro record, if it exists, or otherwise the record itself.
-        self._g.add_node(br)
         self._root = br
 
+        # All the nodes in the graph, in the order they were added, so that
+        # each node's ordinal is its index in this list.  The values in
+        # `_parents` are the ordinal of the parent of the node at the same
+        # index (or -1 for the root), and the values in `_children` are
+        # lists of the ordinals of the node's children, or None if the node
+        # is a leaf.
+        self._nodes = [br]
+        self._ordinals = {br: 0}
+        self._parents = array('i', [-1])
+        self._children = [None]
+
+        # For each node, the latest timestamp of any node in the sub tree
+        # under the node (including the node itself), and the length of the
+        # longest path from the node to a leaf under it.  These are updated
+        # as nodes are added, so that `remaining_child_time` and
+        # `max_child_depth` don't need to walk the graph.
+        self._latest_ts_below = array('d', [br.ts])
+        self._depth_below = array('i', [0])
+
         # Keep track of what range of time this graph represents
         self.earliest_ts = br.ts
         self.latest_ts = br.ts
@@ -411,7 +1019,7 @@ class BroRecordGraph(object):
         # To make searching for referrers faster, we also keep a referrence
         # to each node by its url.  Here, each record's url is the key
         # and the corresponding value is a list of all records requesting
-        # that url
+        # that url, sorted by time
         self._nodes_by_url = {}
         self._nodes_by_url[br.url] = [br]
 
@@ -421,6 +1029,109 @@ class BroRecordGraph(object):
         self._nodes_by_host = {}
         self._nodes_by_host[br.host] = [br]
 
+    def __getstate__(self):
+        # Everything other than the nodes themselves and the ordinal of
+        # each node's parent can be rebuilt when the graph is unpickled,
+        # so only those are pickled.
+        return {
+            "ip": self.ip,
+            "user_agent": self.user_agent,
+            "earliest_ts": self.earliest_ts,
+            "latest_ts": self.latest_ts,
+            "referrer_policy": self.referrer_policy,
+            "nodes": self._nodes,
+            "parents": self._parents.tolist(),
+        }
+
+    def __setstate__(self, state):
+        # Graphs pickled before the graph was stored as parent / child
+        # ordinals pickled their entire __dict__, including a
+        # networkx.DiGraph of the nodes.
+        if "_g" in state:
+            self._load_networkx_state(state)
+            return
+
+        self.ip = state["ip"]
+        self.user_agent = state["user_agent"]
+        self.earliest_ts = state["earliest_ts"]
+        self.latest_ts = state["latest_ts"]
+        self.referrer_policy = state.get("referrer_policy", EARLIEST)
+        self._load_nodes(state["nodes"], state["parents"])
+
+    def _load_nodes(self, nodes, parents):
+        """Rebuilds the indexes of the graph from a list of nodes, and the
+        ordinal of each node's parent.
+
+        Args:
+            nodes   -- a list of BroRecords, where each node's parent comes
+                       before it in the list
+            parents -- a list of integers, the ordinal of the parent of
+                       each node in `nodes`, or -1 for the root
+        """
+        self._root = nodes[0]
+        self._nodes = nodes
+        self._parents = array('i', parents)
+        self._ordinals = {}
+        self._children = [None] * len(nodes)
+        self._nodes_by_host = {}
+        for ordinal, (node, parent) in enumerate(zip(nodes, parents)):
+            self._ordinals[node] = ordinal
+            if parent != -1:
+                if self._children[parent] is None:
+                    self._children[parent] = [ordinal]
+                else:
+                    self._children[parent].append(ordinal)
+            try:
+                self._nodes_by_host[node.host].append(node)
+            except KeyError:
+                self._nodes_by_host[node.host] = [node]
+        self._nodes_sorted = sorted(nodes, key=lambda x: x.ts)
+
+        self._nodes_by_url = {}
+        for node in self._nodes_sorted:
+            try:
+                self._nodes_by_url[node.url].append(node)
+            except KeyError:
+                self._nodes_by_url[node.url] = [node]
+
+        # Since every node comes after its parent, walking the nodes from
+        # last to first visits every node's children before the node itself
+        self._latest_ts_below = array('d', (n.ts for n in nodes))
+        self._depth_below = array('i', [0] * len(nodes))
+        latest_ts_below = self._latest_ts_below
+        depth_below = self._depth_below
+        for ordinal in xrange(len(nodes) - 1, 0, -1):
+            parent = parents[ordinal]
+            if latest_ts_below[ordinal] > latest_ts_below[parent]:
+                latest_ts_below[parent] = latest_ts_below[ordinal]
+            if depth_below[ordinal] + 1 > depth_below[parent]:
+                depth_below[parent] = depth_below[ordinal] + 1
+
+    def _load_networkx_state(self, state):
+        """Loads a graph pickled when graphs were stored as a
+        networkx.DiGraph.  Since each node's parent is always an earlier
+        request than the node, nodes are numbered in time order, starting
+        from the root.
+
+        Args:
+            state -- the unpickled __dict__ of the graph
+        """
+        g = state["_g"]
+        root = state["_root"]
+        nodes = [root] + [n for n in state["_nodes_sorted"] if n is not root]
+        ordinals = dict((n, i) for i, n in enumerate(nodes))
+        parents = []
+        for n in nodes:
+            predecessors = g.predecessors(n)
+            parents.append(ordinals[predecessors[0]] if predecessors else -1)
+
+        self.ip = state["ip"]
+        self.user_agent = state["user_agent"]
+        self.earliest_ts = state["earliest_ts"]
+        self.latest_ts = state["latest_ts"]
+        self.referrer_policy = EARLIEST
+        self._load_nodes(nodes, parents)
+
     def __str__(self):
         return self.summary()
 
@@ -457,20 +1168,26 @@ class BroRecordGraph(object):
             optionally information about the client and time the initial
             request was made.
         """
-        def _print_sub_tree(node, parent=None, level=0):
-            response = ("  " * level)
-            if parent:
-                dif = node.ts - parent.ts
-                response += "|-" + str(round(dif, 2)) + "-> "
-            response += node.url + "\n"
-
-            children = self.children_of_node(node)
-            # Sort the children by timestamp, so that earlier occuring
-            # requests are printed out first.
-            sorted_children = sorted(children, key=lambda x: x.ts)
-            for c in sorted_children:
-                response += _print_sub_tree(c, parent=node, level=(level + 1))
-            return response
+        def _print_sub_tree(root):
+            # Walk the tree depth first, with an explicit stack, so that
+            # very deep graphs don't hit the recursion limit
+            lines = []
+            stack = [(root, None, 0)]
+            while stack:
+                node, parent, level = stack.pop()
+                response = ("  " * level)
+                if parent:
+                    dif = node.ts - parent.ts
+                    response += "|-" + str(round(dif, 2)) + "-> "
+                lines.append(response + node.url + "\n")
+
+                children = self.children_of_node(node)
+                # Sort the children by timestamp, so that earlier occuring
+                # requests are printed out first.
+                sorted_children = sorted(children, key=lambda x: x.ts)
+                for c in reversed(sorted_children):
+                    stack.append((c, node, level + 1))
+            return "".join(lines)
 
         if detailed:
             output = self.ip + "\n" + self._root.date_str + "\n"
@@ -486,14 +1203,16 @@ class BroRecordGraph(object):
         """Returns the BroRecord that could be the referrer of the given
         record, if one exists, and otherwise returns None.  If there
         are multiple BroRecords in this graph that could be the referrer of
-        the given record, the most recent candidate is returned.
+        the given record, the graph's `referrer_policy` decides which is
+        returned, either the earliest candidate (EARLIEST) or the most
+        recent candidate (NEAREST_EARLIER).
 
         Args:
             candidate_record -- a BroRecord object
 
         Returns:
-            The most recent candidate BroRecord that could be the referrer of
-            the passed BroRecord, or None if there are no possible matches.
+            The candidate BroRecord that could be the referrer of the passed
+            BroRecord, or None if there are no possible matches.
         """
         # We can special case situations where the IP addresses don't match,
         # in order to save ourselves having to walk the entire line of nodes
@@ -509,36 +1228,88 @@ class BroRecordGraph(object):
             return None
 
         try:
-            for n in self._nodes_by_url[candidate_record.referrer]:
-                if n.ts < candidate_record.ts:
-                    return n
+            candidates = self._nodes_by_url[candidate_record.referrer]
         except KeyError:
             return None
 
-    def add_node(self, br):
+        if self.referrer_policy == NEAREST_EARLIER:
+            num_earlier = _count_earlier(candidates, candidate_record.ts)
+            return candidates[num_earlier - 1] if num_earlier else None
+
+        if candidates[0].ts < candidate_record.ts:
+            return candidates[0]
+        return None
+
+    def add_node(self, br, parent=None):
         """Attempts to add the given BroRecord as a child (successor) of its
         referrer in the graph.
 
         Args:
             br -- a BroRecord object
 
+        Keyword Args:
+            parent -- a BroRecord already in the graph, to add the given
+                      record as a child of.  If not provided, the record is
+                      added as a child of the node returned by
+                      `referrer_record`.
+
         Returns:
             True if a referrer of the the BroRecord could be found and the
             given record was added as its child / successor.  Otherwise,
             False is returned, indicating no changes were made.
         """
-        referrer_node = self.referrer_record(br)
+        referrer_node = parent or self.referrer_record(br)
         if not referrer_node:
             return False
 
-        time_difference = br.ts - referrer_node.ts
-        self._g.add_weighted_edges_from([(referrer_node, br, time_difference)])
+        self._attach(br, referrer_node)
+        _insert_sorted(self._nodes_sorted, br)
+        return True
+
+    def _attach(self, br, referrer_node):
+        """Adds the given BroRecord as a child of a node in the graph,
+        updating every index of the graph other than the time sorted list
+        of nodes.
+
+        Args:
+            br            -- a BroRecord object, not already in the graph
+            referrer_node -- a BroRecord object in the graph
+        """
+        parent_ordinal = self._ordinals[referrer_node]
+        ordinal = len(self._nodes)
+        self._nodes.append(br)
+        self._ordinals[br] = ordinal
+        self._parents.append(parent_ordinal)
+        self._children.append(None)
+        if self._children[parent_ordinal] is None:
+            self._children[parent_ordinal] = [ordinal]
+        else:
+            self._children[parent_ordinal].append(ordinal)
+
+        # Update the sub tree aggregates of each of the new node's
+        # ancestors, stopping at the first ancestor that isn't changed by
+        # the new node, since none of its ancestors will be changed either.
+        self._latest_ts_below.append(br.ts)
+        self._depth_below.append(0)
+        parents = self._parents
+        latest_ts_below = self._latest_ts_below
+        ancestor = parent_ordinal
+        while ancestor != -1 and latest_ts_below[ancestor] < br.ts:
+            latest_ts_below[ancestor] = br.ts
+            ancestor = parents[ancestor]
+
+        depth_below = self._depth_below
+        ancestor = parent_ordinal
+        depth = 1
+        while ancestor != -1 and depth_below[ancestor] < depth:
+            depth_below[ancestor] = depth
+            ancestor = parents[ancestor]
+            depth += 1
+
         self.latest_ts = max(br.ts, self.latest_ts)
-        self._nodes_sorted.append(br)
-        self._nodes_sorted.sort(key=lambda x: x.ts)
 
         try:
-            self._nodes_by_url[br.url].append(br)
+            _insert_sorted(self._nodes_by_url[br.url], br)
         except KeyError:
             self._nodes_by_url[br.url] = [br]
 
@@ -547,8 +1318,6 @@ class BroRecordGraph(object):
         except KeyError:
             self._nodes_by_host[br.host] = [br]
 
-        return True
-
     def add_graph(self, child_graph):
         """Attempts to merge in a child group into the current graph.
         This is done by seeing if the head of the child graph can find any
@@ -566,10 +1335,21 @@ class BroRecordGraph(object):
         if not referrer_node:
             return False
 
-        for n in child_graph.nodes():
-            if not self.add_node(n):
-                raise LookupError("Unable to reattach child node when " +
-                                  "merging graphs")
+        # Each of the child graph's nodes are attached to the current graph
+        # one at a time, in time order, but the time sorted list of nodes
+        # is only updated once, by merging in all of the attached nodes.
+        attached = []
+        try:
+            for n in child_graph.nodes():
+                referrer_node = self.referrer_record(n)
+                if not referrer_node:
+                    raise LookupError("Unable to reattach child node when " +
+                                      "merging graphs")
+                self._attach(n, referrer_node)
+                attached.append(n)
+        finally:
+            self._nodes_sorted = _merge_sorted_nodes(self._nodes_sorted,
+                                                     attached)
 
         return True
 
@@ -582,6 +1362,14 @@ class BroRecordGraph(object):
         """
         return self._nodes_sorted
 
+    def urls(self):
+        """Returns a list of all of the urls requested in the graph.
+
+        Return:
+            A list of zero or more strings
+        """
+        return self._nodes_by_url.keys()
+
     def hosts(self):
         """Returns a list of all of the hosts represented in the graph.
 
@@ -631,8 +1419,8 @@ class BroRecordGraph(object):
 
         Returns:
             An iterator of BroRecord nodes"""
-        g = self._g
-        return (n for n in g.nodes_iter() if not g.successors(n))
+        children = self._children
+        return (n for i, n in enumerate(self._nodes) if not children[i])
 
     def node_domains(self):
         """Returns a dict representing a mapping from domain to a list of all
@@ -643,7 +1431,7 @@ class BroRecordGraph(object):
             lists of one or more BroRecord objects
         """
         mapping = {}
-        for n in self._g.nodes_iter():
+        for n in self._nodes:
             try:
                 mapping[n.host].append(n)
             except KeyError:
@@ -661,22 +1449,34 @@ class BroRecordGraph(object):
             A list of zero or more nodes in the current collection that
             represent requests to the given domain
         """
-        g = self._g
-        return [n for n in g.nodes_iter() if n.host == domain]
+        return [n for n in self._nodes if n.host == domain]
 
     def graph(self):
-        """Returns the underlying graph representation for the BroRecords
+        """Returns a networkx representation of the graph, where each edge
+        goes from a record to a record it referred, weighted by the
+        number of seconds between the two requests.  The returned graph is
+        built each time this method is called, so changes made to it
+        don't affect this graph.
 
         Returns:
-            The underlying graph representation, a networkx.DiGraph object
+            A networkx.DiGraph object
         """
-        return self._g
+        import networkx as nx
+        g = nx.DiGraph()
+        g.add_node(self._root)
+        nodes = self._nodes
+        g.add_weighted_edges_from(
+            (nodes[p], n, n.ts - nodes[p].ts)
+            for p, n in zip(self._parents, nodes) if p != -1)
+        return g
 
     def remaining_child_time(self, br):
         """Returns the amount of time that the browsing session - captured
         by this graph - continued under the given node.  This is the same
-        thing, and computed as, the max of times between the given node
-        and all nodes below it.
+        thing as the max of times between the given node and all nodes
+        below it, and since every node is requested after its parent, is
+        computed as the time between the given node and the latest node
+        below it.
 
         Args:
             br -- a BroRecord
@@ -685,34 +1485,11 @@ class BroRecordGraph(object):
             A float, describing a number of seconds, or None if the given
             node is not in the graph.
         """
-        g = self._g
-
-        if not g.has_node(br):
+        try:
+            ordinal = self._ordinals[br]
+        except KeyError:
             return None
-
-        def _time_below(node, parent=None):
-            if parent:
-                cur_time = node.ts - parent.ts
-            else:
-                cur_time = 0
-            cs = self.children_of_node(node)
-
-            if len(cs) == 0:
-                return cur_time
-
-            try:
-                max_time = max([_time_below(n, parent=node) for n in cs])
-                return cur_time + max_time
-            except RuntimeError:
-                msg = ("Infinite recursive loop in `remaining_child_time`\n" +
-                       "\n" +
-                       "Node:\n" +
-                       str(node) + "\n\n" +
-                       "Graph:\n" +
-                       str(self))
-                raise(Exception(msg))
-
-        return _time_below(br)
+        return self._latest_ts_below[ordinal] - br.ts
 
     def max_child_depth(self, br):
         """Returns the count of the longest path from the given node to a leaf
@@ -726,25 +1503,11 @@ class BroRecordGraph(object):
             None if the given record is not in the graph, and otherwise returns
             an integer.
         """
-        g = self._g
-
-        if not g.has_node(br):
+        try:
+            return self._depth_below[self._ordinals[br]]
+        except KeyError:
             return None
 
-        def _max_depth(node, count=0):
-            children = g.successors(node)
-            if len(children) == 0:
-                return count
-            # Occasionally there is a recursion depth error here,
-            # which is baffling at the moment.  So, for now, just escape
-            # our way out of it
-            try:
-                return max([_max_depth(c, (count + 1)) for c in children])
-            except RuntimeError:
-                return count + 1
-
-        return _max_depth(br)
-
     def children_of_node(self, br):
         """Returns a list of BroRecord objects that were directed to from
         the record represented by the given BroRecord.
@@ -756,10 +1519,14 @@ class BroRecordGraph(object):
             A list of zero or more BroRecords, or None if the given BroRecord
             is not in the current graph.
         """
-        g = self._g
-        if not g.has_node(br):
+        try:
+            children = self._children[self._ordinals[br]]
+        except KeyError:
             return None
-        return g.successors(br)
+        if children is None:
+            return []
+        nodes = self._nodes
+        return [nodes[c] for c in children]
 
     def parent_of_node(self, br):
         """Returns a BroRecord object that is the referrer of the given record
@@ -773,14 +1540,13 @@ class BroRecordGraph(object):
             has a parent, or None if the given BroRecord either isn't in
             the graph or has no parent.
         """
-        g = self._g
-        if not g.has_node(br):
+        try:
+            parent = self._parents[self._ordinals[br]]
+        except KeyError:
             return None
-        parents = g.predecessors(br)
-        if len(parents) != 1:
+        if parent == -1:
             return None
-        else:
-            return parents[0]
+        return self._nodes[parent]
 
     def chain_from_node(self, br):
         """Returns a BroRecordChain object, describing the chain of requests
@@ -794,18 +1560,16 @@ class BroRecordGraph(object):
             otherwise a BroRecordChain object describing how the record br
             was arrived at from the root of the graph / DAG.
         """
-        g = self._g
-        if not g.has_node(br):
+        try:
+            ordinal = self._ordinals[br]
+        except KeyError:
             return None
 
         path = [br]
-        node = br
-        while True:
-            parents = g.predecessors(node)
-            if not len(parents):
-                break
-            node = parents[0]
-            path.append(node)
+        parent = self._parents[ordinal]
+        while parent != -1:
+            path.append(self._nodes[parent])
+            parent = self._parents[parent]
 
         chain = BroRecordChain(path[-1])
         for r in path[1::-1]:
@@ -0,0 +1,269 @@
+"""An inverted index from hosts to the graphs, across many graph files,
+that include a request to each host.
+
+The index maps each host to a list of postings, each the path of a graph
+file and the location of a graph in that file (the offset of the graph's
+block and the graph's position in the block, as recorded in the file's
+sidecar index).  Hosts are also grouped by their registrable domain (ie
+"www.example.co.uk" and "shop.example.co.uk" are both grouped under
+"example.co.uk"), so that all the graphs touching a site can be found
+without checking every host in the index.
+
+The index is built from the sidecar index of each graph file, so graphs
+don't need to be unpickled to be indexed, and is updated incrementally,
+only re-indexing graph files that are new or have changed since they were
+last indexed.
+"""
+
+import os
+import logging
+from .graphfile import GraphIndex
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Written at the start of every host index.  This should be changed any
+# time the layout of the index changes, so that older indexes are rebuilt.
+MAGIC = "BROHOSTIDX 1"
+
+# Second level labels that, under a two letter country code top level
+# domain, are part of the registrable suffix (eg "co" in "example.co.uk").
+COUNTRY_SECOND_LEVELS = set(("ac", "co", "com", "edu", "gov", "net", "or",
+                             "org", "ne", "go"))
+
+
+def registrable_domain(host):
+    """Returns the registrable domain of a host, ie the domain a site was
+    registered under, without any subdomains.  This is approximated from
+    the host's labels, without a list of public suffixes.
+
+    Args:
+        host -- a host name, such as www.example.org
+
+    Return:
+        The registrable domain of the host, such as example.org.  Hosts that
+        are IP addresses, or have only one label, are returned unchanged.
+    """
+    host = host.split(":", 1)[0].lower()
+    labels = host.split(".")
+    if len(labels) <= 2 or labels[-1].isdigit():
+        return host
+    if len(labels[-1]) == 2 and labels[-2] in COUNTRY_SECOND_LEVELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+class HostIndex(object):
+    """An inverted index from hosts to the locations of the graphs, in a
+    collection of graph files, with a request to each host.
+    """
+
+    def __init__(self, path=None):
+        """Creates an empty index.
+
+        Keyword Args:
+            path -- the path the index is read from and saved to, if any
+        """
+        self.path = path
+        # The size and modification time of each graph file, when it was
+        # indexed, for finding files that have changed since
+        self._files = {}
+        # The hosts in each indexed file, for removing the file's postings
+        # when it is re-indexed
+        self._file_hosts = {}
+        self._postings = {}
+        self._hosts_by_domain = {}
+        self._changed = False
+
+    def __len__(self):
+        return len(self._postings)
+
+    def __contains__(self, host):
+        return host in self._postings
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index from disk.  If there is no index at the given path,
+        or the index was written in an older format, an empty index is
+        returned, which will be saved to the path.
+
+        Args:
+            path -- the path to a host index on disk
+
+        Return:
+            A HostIndex instance
+        """
+        log = logging.getLogger("brorecords")
+        index = cls(path)
+        if not os.path.isfile(path):
+            return index
+        with open(path, 'rb') as h:
+            if h.readline()[:-1] != MAGIC:
+                log.info("{0}: Ignoring host index in an old format".format(
+                         path))
+                return index
+            state = pickle.load(h)
+        index._files = state["files"]
+        index._file_hosts = state["file_hosts"]
+        index._postings = state["postings"]
+        for host in index._postings:
+            index._add_host(host)
+        return index
+
+    def save(self, path=None):
+        """Writes the index to disk, if it has changed since it was read.
+        The index is written to a temporary file first, and then moved into
+        place, so that a partly written index is never read.
+
+        Keyword Args:
+            path -- the path to write the index to.  Defaults to the path the
+                    index was read from.
+        """
+        path = path or self.path
+        if not self._changed and path == self.path:
+            return
+        state = {
+            "files": self._files,
+            "file_hosts": self._file_hosts,
+            "postings": self._postings,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as h:
+            h.write(MAGIC + "\n")
+            pickle.dump(state, h, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        self.path = path
+        self._changed = False
+
+    def _add_host(self, host):
+        domain = registrable_domain(host)
+        self._hosts_by_domain.setdefault(domain, set()).add(host)
+
+    def _remove_file(self, path):
+        for host in self._file_hosts.pop(path, ()):
+            postings = [p for p in self._postings[host] if p[0] != path]
+            if postings:
+                self._postings[host] = postings
+                continue
+            del self._postings[host]
+            domain = registrable_domain(host)
+            self._hosts_by_domain[domain].discard(host)
+            if not self._hosts_by_domain[domain]:
+                del self._hosts_by_domain[domain]
+        self._files.pop(path, None)
+
+    def add_file(self, path):
+        """Adds the graphs in a graph file to the index, replacing any
+        postings already in the index for the file.  The file's sidecar
+        index is used if it is up to date, and otherwise the file's graphs
+        are read to build one.
+
+        Args:
+            path -- the path to a graph container file
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self._remove_file(path)
+        graph_index = GraphIndex.load(path)
+        if graph_index is None:
+            graph_index = GraphIndex.build(path)
+        file_hosts = set()
+        for offset, slot, hosts in graph_index.locations_and_hosts():
+            # Graphs in legacy files have no location, and so can't be
+            # read individually
+            if offset is None:
+                continue
+            posting = (path, offset, slot)
+            for host in hosts:
+                if host not in self._postings:
+                    self._postings[host] = []
+                    self._add_host(host)
+                self._postings[host].append(posting)
+                file_hosts.add(host)
+        self._file_hosts[path] = file_hosts
+        self._files[path] = (stat.st_size, stat.st_mtime)
+        self._changed = True
+
+    def update(self, paths):
+        """Brings the index up to date for the given graph files, by
+        indexing each file that is new, or that has changed since it was
+        indexed.
+
+        Args:
+            paths -- a list of paths to graph container files
+
+        Return:
+            The number of files that were (re)indexed
+        """
+        log = logging.getLogger("brorecords")
+        num_indexed = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            if self._files.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            log.info("{0}: Indexing hosts".format(path))
+            self.add_file(path)
+            num_indexed += 1
+        return num_indexed
+
+    def hosts_for_domain(self, domain):
+        """Returns the hosts in the index that are under the given
+        registrable domain.
+
+        Args:
+            domain -- a registrable domain, such as example.org
+
+        Return:
+            A set of zero or more hosts
+        """
+        return set(self._hosts_by_domain.get(domain.lower(), ()))
+
+    def hosts_containing(self, fragment):
+        """Returns the hosts in the index that contain the given string.
+        When the fragment is part of a registrable domain, every host under
+        the domain is matched, without checking each host.
+
+        Args:
+            fragment -- a string, such as "godaddy."
+
+        Return:
+            A set of zero or more hosts
+        """
+        hosts = set()
+        for domain, domain_hosts in self._hosts_by_domain.iteritems():
+            if fragment in domain:
+                hosts.update(domain_hosts)
+            else:
+                hosts.update(h for h in domain_hosts if fragment in h)
+        return hosts
+
+    def postings(self, hosts, paths=None):
+        """Returns the locations of the graphs with a request to at least one
+        of the given hosts.
+
+        Args:
+            hosts -- a collection of hosts
+
+        Keyword Args:
+            paths -- if provided, only graphs in these graph files are
+                     returned
+
+        Return:
+            A dict, mapping the path of each graph file with a matching graph
+            to a sorted list of pairs of values, the offset of the block a
+            graph is stored in, and the position of the graph in the block.
+        """
+        allowed = None
+        if paths is not None:
+            allowed = set(os.path.abspath(p) for p in paths)
+        locations = {}
+        for host in hosts:
+            for path, offset, slot in self._postings.get(host, ()):
+                if allowed is not None and path not in allowed:
+                    continue
+                locations.setdefault(path, set()).add((offset, slot))
+        return dict((path, sorted(locs))
+                    for path, locs in locations.iteritems())
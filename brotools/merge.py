@@ -2,7 +2,10 @@
 across multiple files_to_combine"""
 
 import gzip
+import heapq
+import logging
 import os
+import tempfile
 
 def group_records(files):
     """Takes a list of file paths, each referring to a bro record. Its expected
@@ -28,14 +31,224 @@ def group_records(files):
         files_to_combine[combined_file_name].append(f)
     return [(v, os.path.basename(k)) for k, v in files_to_combine.items()]
 
-def merge(files, dest_path):
-    # If the file has already been generated, don't generate it again
-    if os.path.isfile(dest_path) and os.path.getsize(dest_path):
-        return True
+def _seperator(header_lines):
+    """Returns the field seperator declared in the given bro log headers.
+
+    Args:
+        header_lines -- a list of header lines from a bro log
+
+    Return:
+        The seperator declared in a "#separator" header, or a tab if
+        no such header exists.
+    """
+    for line in header_lines:
+        if line[0:10] == "#separator":
+            return line[11:].rstrip("\n").decode('unicode_escape')
+    return "\t"
+
+
+def _line_ts(line, seperator):
+    """Returns the timestamp of a bro log line, which is expected to be the
+    leading field on each line.  Only the leading field is parsed.
+
+    Args:
+        line      -- a non-header line from a bro log
+        seperator -- the field seperator used in the log
+
+    Return:
+        The timestamp of the record, as a float
+
+    Raises:
+        ValueError -- if the line has no seperator, or if the leading field
+                      isn't a number
+    """
+    end = line.find(seperator)
+    if end < 0:
+        raise ValueError("Expected a seperated line, found {0!r}".format(
+                         line[:50]))
+    return float(line[:end])
+
+
+def _header_and_body_lines(compressed_file):
+    """Reads the lines out of a single gziped part of a bro log, and splits
+    them into the header lines (lines starting with "#") and the record lines.
+
+    Args:
+        compressed_file -- a path to a gziped bro log
+
+    Return:
+        A tuple of two values, first a list of the header lines found in the
+        file, and second a generator that yields each non-header line in the
+        file, in the order they appear in the file.  Header lines that
+        appear after the first record (such as "#close") are added to the
+        list of header lines as the generator reaches them.
+    """
+    source_h = gzip.open(compressed_file, 'r')
+    headers = []
+    first_line = None
+    for line in source_h:
+        if line[0] == "#":
+            headers.append(line)
+        else:
+            first_line = line
+            break
+
+    def _body_lines():
+        try:
+            if first_line is None:
+                return
+            yield first_line
+            for line in source_h:
+                if line[0] == "#":
+                    headers.append(line)
+                else:
+                    yield line
+        finally:
+            source_h.close()
+
+    return headers, _body_lines()
+
+
+def _all_header_lines(compressed_file):
+    """Returns all of the header lines in a gziped part of a bro log,
+    including those that come after the records in the file.
+
+    Args:
+        compressed_file -- a path to a gziped bro log
+
+    Return:
+        A list of zero or more header lines.
+    """
+    with gzip.open(compressed_file, 'r') as source_h:
+        return [line for line in source_h if line[0] == "#"]
+
+
+def _keyed_lines(lines, seperator, compressed_file, out_of_order):
+    """Decorates each of the given lines with its timestamp, and counts how
+    many lines appear earlier than a line before them in the file.
+
+    Args:
+        lines           -- an iterable of lines from a bro log
+        seperator       -- the field seperator used in the log
+        compressed_file -- the path of the file the lines were read from
+        out_of_order    -- a dict, mapping file paths to the number of out
+                           of order lines found in them, that is updated
+                           as lines are read
+
+    Return:
+        A generator yielding pairs of values, a line's timestamp (as a float)
+        and the line itself.
+    """
+    latest_ts = None
+    count = 0
+    try:
+        for line in lines:
+            ts = _line_ts(line, seperator)
+            if latest_ts is None or ts >= latest_ts:
+                latest_ts = ts
+            else:
+                count += 1
+            yield ts, line
+    finally:
+        if count:
+            out_of_order[compressed_file] = count
+
+
+def _report_out_of_order(out_of_order):
+    """Logs a warning for each file that had records that were not sorted
+    by time, and so were reordered when merging.
+
+    Args:
+        out_of_order -- a dict, mapping file paths to the number of out of
+                        order lines found in them
+    """
+    log = logging.getLogger("brorecords")
+    for compressed_file, count in sorted(out_of_order.items()):
+        log.warning("{0}: reordered {1} out of order records".format(
+            compressed_file, count))
+
+
+def _sorted_source(keyed_lines, index, compressed_file):
+    """Prepares lines from a part that is expected to already be sorted by
+    time for merging with other parts, raising an error if the lines turn
+    out not to be sorted.
+
+    Args:
+        keyed_lines     -- an iterable of (timestamp, line) pairs
+        index           -- the position of the part in the merge, used
+                           to keep records with the same timestamp in
+                           part order
+        compressed_file -- the path of the file the lines were read from,
+                           used only in the raised error message
+
+    Return:
+        A generator yielding (timestamp, index, position, line) tuples.
+    """
+    last_ts = None
+    for position, (ts, line) in enumerate(keyed_lines):
+        if last_ts is not None and ts < last_ts:
+            raise ValueError("{0} is not sorted".format(compressed_file))
+        last_ts = ts
+        yield ts, index, position, line
+
+
+def _run_source(lines, index, seperator):
+    """Prepares the lines of a sorted run for merging with other runs.
+
+    Args:
+        lines     -- an iterable of lines, sorted by timestamp
+        index     -- the position of the run in the merge, used to keep
+                     records with the same timestamp in the order they
+                     were read
+        seperator -- the field seperator used in the log
+
+    Return:
+        A generator yielding (timestamp, index, position, line) tuples.
+    """
+    for position, line in enumerate(lines):
+        yield _line_ts(line, seperator), index, position, line
+
+
+def _spill_run(keyed_lines, workpath):
+    """Sorts the given lines and writes them to a temporary file in the
+    given directory, so that they can be merged back together with other
+    sorted runs later.
+
+    Args:
+        keyed_lines -- a list of (timestamp, line) pairs.  The list is
+                       sorted in place.
+        workpath    -- a directory to write the sorted run to
+
+    Return:
+        The path to the written, sorted run.
+    """
+    keyed_lines.sort(key=_ts_of_pair)
+    run_h = tempfile.NamedTemporaryFile(mode='w', prefix="merge-run-",
+                                        dir=workpath, delete=False)
+    with run_h:
+        run_h.writelines(line for ts, line in keyed_lines)
+    return run_h.name
+
+
+def _ts_of_pair(keyed_line):
+    return keyed_line[0]
+
+
+def _in_memory_lines(files):
+    """Reads all of the records in the given gziped bro log parts into
+    memory and sorts them by time.
+
+    Args:
+        files -- a list of paths to gziped bro log parts
 
+    Return:
+        A tuple of two values, first the header lines of the first part
+        with headers, as a single string, and second a generator yielding
+        every record line in the parts, sorted by time.
+    """
     read_headers_from_any_file = False
     headers = ""
-    lines = []
+    lines_by_file = []
     for compressed_file in files:
         lines_in_file = []
         try:
@@ -54,19 +267,273 @@ def merge(files, dest_path):
             lines_in_file = []
             raise e
 
-        lines += lines_in_file
-    if len(headers) == 0 or len(lines) == 0:
+        lines_by_file.append((compressed_file, lines_in_file))
+
+    # Pair each line with its timestamp, so that the timestamp only needs
+    # to be parsed once per line
+    seperator = _seperator(headers.splitlines(True))
+    out_of_order = {}
+    lines = []
+    for compressed_file, lines_in_file in lines_by_file:
+        lines += _keyed_lines(lines_in_file, seperator, compressed_file,
+                              out_of_order)
+    del lines_by_file
+
+    # Now sort all the rows by time.  This will be big.  Since the sort is
+    # stable, records with the same timestamp stay in file order
+    lines.sort(key=_ts_of_pair)
+    _report_out_of_order(out_of_order)
+
+    def _lines():
+        for ts, line in lines:
+            yield line
+
+    return headers, _lines()
+
+
+def _external_lines(files, max_memory, workpath, presorted):
+    """Lazily merges the given gziped bro log parts together, sorted by time,
+    without ever holding more than (about) `max_memory` bytes of log lines
+    in memory.  Lines are buffered until the buffer reaches the given
+    budget, and then the buffer is sorted and spilled to disk as a run.
+    All the runs are then lazily merged together.
+
+    If `presorted` is True, each gziped part is expected to already be in
+    sorted order, and the parts are lazily merged directly, without
+    creating any runs.  If a part turns out not to be sorted, a ValueError
+    is raised while merging.
+
+    Args:
+        files      -- a list of paths to gziped bro log parts
+        max_memory -- the approximate number of bytes of log lines to hold
+                      in memory at a time, or None to not limit memory
+        workpath   -- a directory to write sorted runs to
+        presorted  -- whether the given parts are already sorted
+
+    Return:
+        A tuple of two values, first the header lines of the first part
+        with headers, as a single string, and second a generator yielding
+        every record line in the parts, sorted by time.  Any sorted runs
+        are removed once the generator is exhausted or closed.
+    """
+    headers = ""
+    seperator = None
+    sources = []
+    body_sources = []
+    run_paths = []
+    run_handles = []
+    out_of_order = {}
+
+    def _clean_up():
+        # Closing the lines read from each gziped part closes the part
+        for body_lines in body_sources:
+            body_lines.close()
+        for run_h in run_handles:
+            run_h.close()
+        for run_path in run_paths:
+            os.remove(run_path)
+
+    try:
+        if presorted:
+            for index, compressed_file in enumerate(files):
+                if not headers:
+                    header_lines = _all_header_lines(compressed_file)
+                    headers = "".join(header_lines)
+                    seperator = _seperator(header_lines)
+                body_lines = _header_and_body_lines(compressed_file)[1]
+                body_sources.append(body_lines)
+                keyed_lines = _keyed_lines(body_lines, seperator or "\t",
+                                           compressed_file, out_of_order)
+                sources.append(_sorted_source(keyed_lines, index,
+                                              compressed_file))
+        else:
+            buffered_lines = []
+            buffered_bytes = 0
+            for compressed_file in files:
+                file_headers, body_lines = _header_and_body_lines(compressed_file)
+                if seperator is None and file_headers:
+                    seperator = _seperator(file_headers)
+                keyed_lines = _keyed_lines(body_lines, seperator or "\t",
+                                           compressed_file, out_of_order)
+                for keyed_line in keyed_lines:
+                    buffered_lines.append(keyed_line)
+                    buffered_bytes += len(keyed_line[1])
+                    if max_memory and buffered_bytes >= max_memory:
+                        run_paths.append(_spill_run(buffered_lines, workpath))
+                        buffered_lines = []
+                        buffered_bytes = 0
+                if not headers:
+                    headers = "".join(file_headers)
+
+            for index, run_path in enumerate(run_paths):
+                run_h = open(run_path, 'r')
+                run_handles.append(run_h)
+                sources.append(_run_source(run_h, index, seperator or "\t"))
+
+            # The final, partially filled buffer is under the memory budget,
+            # so there is no need to write it out to disk as well.
+            buffered_lines.sort(key=_ts_of_pair)
+            sources.append((ts, len(run_paths), position, line)
+                           for position, (ts, line) in enumerate(buffered_lines))
+    except:
+        _clean_up()
+        raise
+
+    def _lines():
+        try:
+            for ts, index, position, line in heapq.merge(*sources):
+                yield line
+            _report_out_of_order(out_of_order)
+        finally:
+            _clean_up()
+
+    if len(headers) == 0:
+        _clean_up()
+        return headers, iter([])
+    return headers, _lines()
+
+
+def _merged_lines(files, max_memory=None, workpath=None, presorted=False):
+    """Returns the headers and time sorted records of the given gziped bro
+    log parts, either by sorting all the records in memory, or, if
+    `max_memory` or `presorted` are provided, by lazily merging the parts
+    in bounded memory.  Both ways of merging produce identical lines.
+
+    Args:
+        files -- a list of paths to gziped bro log parts
+
+    Keyword Args:
+        max_memory -- if provided, the approximate maximum number of bytes
+                      of log lines to hold in memory at a time.  Lines beyond
+                      this budget are spilled to disk in sorted runs.
+        workpath   -- a directory to write the sorted runs to.
+        presorted  -- if True, each part is expected to already be sorted,
+                      so the parts are lazily merged without being sorted
+                      first.
+
+    Return:
+        A tuple of two values, first the header lines of the first part
+        with headers, as a single string, and second an iterator yielding
+        every record line in the parts, sorted by time.
+    """
+    if max_memory or presorted:
+        return _external_lines(files, max_memory, workpath, presorted)
+    return _in_memory_lines(files)
+
+
+def merge(files, dest_path, max_memory=None, workpath=None, presorted=False):
+    """Merges a collection of gziped bro log parts into a single, plain text
+    bro log, with all the records in the parts sorted by their timestamp.
+    Records with the same timestamp are kept in the order of the parts they
+    were read from.  The headers of the first part are used as the headers
+    of the merged file.  If any part has records that are not in time order,
+    a warning is logged with the number of records that had to be reordered.
+
+    By default all the records are read into memory and sorted at once.  If
+    either `max_memory` or `presorted` is provided, the parts are instead
+    merged lazily, in bounded memory (see `_external_lines`).  Both ways
+    of merging write identical files.
+
+    Args:
+        files     -- a list of paths to gziped bro log parts
+        dest_path -- the path to write the merged, sorted log to
+
+    Keyword Args:
+        max_memory -- if provided, the approximate maximum number of bytes
+                      of log lines to hold in memory at a time.  Lines beyond
+                      this budget are spilled to disk in sorted runs.
+        workpath   -- a directory to write the sorted runs to.  Defaults
+                      to the directory the merged file is written to.
+        presorted  -- if True, each part is expected to already be sorted,
+                      so the parts are lazily merged without being sorted
+                      first.  If a part turns out not to be sorted, the
+                      parts are sorted instead.
+
+    Return:
+        True if a merged file exists at `dest_path` (either because it was
+        just written, or because it was written in a previous run), and
+        otherwise False (ie there were no headers or records to merge).
+    """
+    # If the file has already been generated, don't generate it again
+    if os.path.isfile(dest_path) and os.path.getsize(dest_path):
+        return True
+
+    log = logging.getLogger("brorecords")
+    tmp_path = "{0}.tmp".format(dest_path)
+    workpath = workpath or os.path.dirname(os.path.abspath(dest_path))
+
+    headers, lines = _merged_lines(files, max_memory=max_memory,
+                                   workpath=workpath, presorted=presorted)
+    if len(headers) == 0:
+        return False
+
+    num_lines = 0
+    try:
+        with open(tmp_path, 'w') as dest_h:
+            dest_h.write(headers)
+            for line in lines:
+                dest_h.write(line)
+                num_lines += 1
+    except ValueError, e:
+        if not presorted:
+            raise e
+        # Close the parts being merged before they're read again
+        lines.close()
+        log.info("{0}, sorting parts instead".format(e))
+        return merge(files, dest_path, max_memory=max_memory,
+                     workpath=workpath)
+
+    if num_lines == 0:
+        os.remove(tmp_path)
         return False
 
-    # Now sort all the rows.  This will be big
-    lines.sort()
-    dest_h = open(dest_path, 'w')
-    dest_h.write(headers)
-    for line in lines:
-        dest_h.write(line)
-    dest_h.close()
+    os.rename(tmp_path, dest_path)
     return True
 
+
+class MergedLog(object):
+    """A read only, file handle like view of the merged, time sorted records
+    in a collection of gziped bro log parts.  Iterating over a MergedLog
+    yields the same lines that `merge` would write to disk, but without
+    ever writing the merged log out, so it can be passed directly to
+    `bro_records` or `graphs`.
+    """
+
+    def __init__(self, files, name, max_memory=None, workpath=None,
+                 presorted=False):
+        """
+        Args:
+            files -- a list of paths to gziped bro log parts
+            name  -- the name of the merged log, used in the same way as
+                     the name of a file handle (ie the path the merged log
+                     would otherwise be written to)
+
+        Keyword Args:
+            max_memory -- see `merge`
+            workpath   -- see `merge`.  Defaults to the directory of `name`.
+            presorted  -- see `merge`.  Note that since lines are consumed
+                          as they are merged, a part that turns out to not
+                          be sorted raises a ValueError.
+        """
+        self.name = name
+        self.num_lines = 0
+        self._files = files
+        self._max_memory = max_memory
+        self._workpath = workpath or os.path.dirname(os.path.abspath(name))
+        self._presorted = presorted
+
+    def __iter__(self):
+        headers, lines = _merged_lines(self._files,
+                                       max_memory=self._max_memory,
+                                       workpath=self._workpath,
+                                       presorted=self._presorted)
+        self.num_lines = 0
+        for line in headers.splitlines(True):
+            yield line
+        for line in lines:
+            self.num_lines += 1
+            yield line
+
 if __name__ == "__main__":
     """If we're running as a script directly, read in a list of file names
     from stdin and attempt to merge those together into the given argument
@@ -81,6 +548,10 @@ if __name__ == "__main__":
                         help="If set, lots of information about the merging process will be printed out.")
     parser.add_argument('--test', '-t', action="store_true",
                         help="If set, no files will be written to disk.  Possibly useful in combination with --verbose.")
+    parser.add_argument('--memory', '-m', type=int, default=None,
+                        help="If set, the approximate number of bytes of log lines to keep in memory when merging.  Additional lines are sorted and spilled to the destination directory.")
+    parser.add_argument('--presorted', '-s', action="store_true",
+                        help="If set, each file being merged is expected to already be sorted, and files are merged without being sorted first.")
     args = parser.parse_args()
 
     def info(msg):
@@ -99,4 +570,5 @@ if __name__ == "__main__":
             info("\t - {0}".format(orig_file))
 
         if not args.test:
-            merge(orig_files, os.path.join(args.dest, dest_file))
+            merge(orig_files, os.path.join(args.dest, dest_file),
+                  max_memory=args.memory, presorted=args.presorted)
@@ -1,13 +1,101 @@
 import datetime
-from cached_property import cached_property
-import urlparse
+import numpy
+import operator
 import os.path
 
+# The columns read out of each line of a bro log, in the order they are
+# decoded, paired with the names the column can have in a log's "#fields"
+# header.
+COLUMNS = (
+    ("ts", ("ts",)),
+    ("id_orig_h", ("id.orig_h",)),
+    ("id_resp_h", ("id.resp_h",)),
+    ("method", ("method",)),
+    ("host", ("host",)),
+    ("uri", ("uri",)),
+    ("referrer", ("referrer",)),
+    ("user_agent", ("user_agent",)),
+    ("status_code", ("status_code",)),
+    ("content_type", ("content_type",)),
+    ("location", ("location",)),
+    ("cookies", ("cookies", "cookie")),
+)
+
+# Columns that don't need to appear in a log.  Records read from logs
+# missing these columns will have None for these values
+OPTIONAL_COLUMNS = ("cookies",)
+
+# Columns whose values are repeated across many records (ie the same
+# clients, hosts, etc. show up again and again in a log), so that records
+# from the same log should share a single copy of each value
+INTERNED_COLUMNS = ("id_orig_h", "id_resp_h", "method", "host",
+                    "user_agent", "status_code", "content_type")
+
+
+# The dictionary encoded columns included in the structured arrays yielded
+# by `bro_record_batches`, along with the record's timestamp
+BATCH_COLUMNS = ("id_orig_h", "host", "user_agent", "status_code",
+                 "content_type")
+
+BATCH_DTYPE = numpy.dtype([("ts", numpy.float64)] +
+                          [(name, numpy.int32) for name in BATCH_COLUMNS])
+
+
+def _log_rows(handle):
+    """A generator function that reads the headers out of a bro log, and
+    yields each of the non-header lines in the log, along with a RowDecoder
+    built from the headers that precede the line.
+
+    Args:
+        handle -- a file handle like object to read lines of bro data off of.
+
+    Return:
+        An iterator returning tuples of three values, the line number of
+        the row in the log, the row itself (without a trailing new line),
+        and a RowDecoder for the row.
+    """
+    seperator = None
+    unset_field = "-"
+    fields = None
+    types = None
+    decoder = None
+    num_lines = 0
+    for raw_row in handle:
+        num_lines += 1
+        row = raw_row[:-1]  # Strip off line end
+        if row[0] == "#":
+            if not seperator and row[0:10] == "#separator":
+                seperator = row[11:].decode('unicode_escape')
+            elif seperator and row[0:12] == "#unset_field":
+                unset_field = row.split(seperator)[1]
+            elif seperator and row[0:7] == "#fields":
+                fields = row.split(seperator)[1:]
+            elif seperator and row[0:6] == "#types":
+                types = row.split(seperator)[1:]
+            # Any change in the headers means the lines that follow may be
+            # laid out differently
+            decoder = None
+            continue
+
+        if decoder is None:
+            decoder = RowDecoder(fields=fields, types=types,
+                                 seperator=seperator or "\t",
+                                 unset_field=unset_field)
+        yield num_lines, row, decoder
+
+
+def _bad_line(handle, row, decoder):
+    print "Bad line entry"
+    print "File: {0}".format(handle.name)
+    print "Values: {0}".format(row.split(decoder.seperator))
+
 
 def bro_records(handle, record_filter=None):
     """A generator function for iterating over a a collection of bro records.
     The iterator returns BroRecord objects (named tuples) for each record
-    in the given file
+    in the given file.  The "#separator", "#unset_field", "#fields" and
+    "#types" headers of the log are used to decode each line, so logs
+    with extra or reordered columns are read correctly.
 
     Args:
         handle -- a file handle like object to read lines of bro data off of.
@@ -16,38 +104,478 @@ def bro_records(handle, record_filter=None):
         record_filter -- an optional function that, if provided, should take
                          two arguments of bro records, and should provide True
                          if they should be included in the same chain or not.
+                         If the filter is a ColumnFilter, it is evaluated
+                         against the columns of each line before a BroRecord
+                         is built for the line.
 
     Return:
         An iterator returning BroRecord objects
     """
-    seperator = None
-    num_lines = 0
-    for raw_row in handle:
-        num_lines += 1
-        row = raw_row[:-1]  # Strip off line end
-        if not seperator and row[0:10] == "#separator":
-            seperator = row[11:].decode('unicode_escape')
-        elif row[0] != "#":
-            try:
-                logname = os.path.basename(handle.name)
-                rec_loc = "{0}:{1}".format(num_lines, logname)
-                r = BroRecord(row, seperator, name=rec_loc)
-            except Exception, e:
-                print "Bad line entry"
-                print "File: {0}".format(handle.name)
-                print "Values: {0}".format(row.split(seperator))
-                raise e
-
-            if record_filter and not record_filter(r):
-                continue
-            yield r
+    logname = os.path.basename(handle.name)
+
+    # Filters that only look at some columns of each record can be checked
+    # against the raw columns of each line, before building a BroRecord,
+    # since most lines are usually filtered out.
+    is_column_filter = isinstance(record_filter, ColumnFilter)
+    line_filter = None
+    line_filter_decoder = None
+
+    for num_lines, row, decoder in _log_rows(handle):
+        try:
+            values = decoder.split(row)
+            if is_column_filter:
+                if line_filter_decoder is not decoder:
+                    line_filter = decoder.column_filter(record_filter)
+                    line_filter_decoder = decoder
+                if not line_filter(values):
+                    continue
+
+            rec_loc = "{0}:{1}".format(num_lines, logname)
+            r = BroRecord.from_values(decoder.decode_values(values),
+                                      name=rec_loc)
+        except Exception, e:
+            _bad_line(handle, row, decoder)
+            raise e
+
+        if record_filter and not is_column_filter and not record_filter(r):
+            continue
+        yield r
+
+
+def bro_record_batches(handle, batch_size=65536, tables=None):
+    """A generator function for iterating over the records in a bro log in
+    batches, as structured numpy arrays, instead of as BroRecord objects.
+    This is useful for computing statistics over large numbers of records,
+    where there is no need for a python object per request.
+
+    Each batch is an array of `BATCH_DTYPE`, with the timestamp of each
+    record as a float64, and each of the `BATCH_COLUMNS` dictionary encoded
+    as an integer code into a StringTable.  The same tables are used for
+    every batch, so codes can be compared across batches.
+
+    Args:
+        handle -- a file handle like object to read lines of bro data off of.
+
+    Keyword Args:
+        batch_size -- the maximum number of records in each batch
+        tables     -- an optional dict, mapping each of the `BATCH_COLUMNS`
+                      to a StringTable, to encode values with.  This is
+                      useful for sharing codes across multiple logs.  If
+                      not provided, a new set of tables is created.
+
+    Return:
+        An iterator returning pairs of values, a numpy array of records,
+        and the dict of StringTables used to encode the array.
+    """
+    if tables is None:
+        tables = dict((name, StringTable()) for name in BATCH_COLUMNS)
+
+    column_names = [name for name, aliases in COLUMNS]
+    positions = [column_names.index(name) for name in BATCH_COLUMNS]
+    encoders = [tables[name].code for name in BATCH_COLUMNS]
+    coded_columns = zip(positions, encoders)
+
+    rows = []
+    for num_lines, row, decoder in _log_rows(handle):
+        try:
+            values = decoder.decode(row)
+        except Exception, e:
+            _bad_line(handle, row, decoder)
+            raise e
+
+        rows.append((values[0],) + tuple(encode(values[i])
+                                         for i, encode in coded_columns))
+        if len(rows) == batch_size:
+            yield numpy.array(rows, dtype=BATCH_DTYPE), tables
+            rows = []
+
+    if rows:
+        yield numpy.array(rows, dtype=BATCH_DTYPE), tables
+
+
+class StringTable(object):
+    """Dictionary encodes the string values of a column, mapping each
+    distinct value to a small integer code, in the order the values are
+    first seen.
+    """
+
+    def __init__(self):
+        # A list of each distinct value, where each value's code is its
+        # index in the list
+        self.values = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def code(self, value):
+        """Returns the integer code for the given value, adding the value
+        to the table if it hasn't been seen before.
+
+        Args:
+            value -- a string
+
+        Return:
+            An integer code for the value
+        """
+        try:
+            return self._codes[value]
+        except KeyError:
+            code = len(self.values)
+            self._codes[value] = code
+            self.values.append(value)
+            return code
+
+    def matches(self, predicate):
+        """Evaluates the given function once per distinct value in the table.
+
+        Args:
+            predicate -- a function that takes a single string, and returns
+                         a boolean
+
+        Return:
+            A numpy boolean array, with the result of the predicate for each
+            value at the position of the value's code.  So, indexing the
+            result with an array of codes gives the predicate's result
+            for each code.
+        """
+        return numpy.array([bool(predicate(v)) for v in self.values],
+                           dtype=bool)
+
+
+class ColumnFilter(object):
+    """A filter over bro records that only looks at some of each record's
+    columns.  A ColumnFilter can be called with a BroRecord, like any other
+    record filter, and can also be evaluated over a batch of records
+    returned from `bro_record_batches`, as a vectorized mask.
+    """
+
+    def __init__(self, columns, predicate):
+        """
+        Args:
+            columns   -- a list of the names of the columns (as named in
+                         `COLUMNS`) that the filter looks at
+            predicate -- a function that takes the values of the given
+                         columns, in the same order, and returns True if a
+                         record with those values should be included.
+        """
+        self.columns = tuple(columns)
+        self.predicate = predicate
+
+    def __call__(self, record):
+        return self.predicate(*[getattr(record, c) for c in self.columns])
+
+    def mask(self, batch, tables):
+        """Evaluates the filter over a batch of records.  The predicate is
+        only called once per distinct combination of values in the batch.
+
+        Args:
+            batch  -- a numpy array of records, returned from
+                      `bro_record_batches`
+            tables -- the dict of StringTables used to encode the batch
+
+        Return:
+            A numpy boolean array, True for each record in the batch that
+            passes the filter.
+
+        Raises:
+            KeyError -- if the filter looks at a column that isn't included
+                        in batches.
+        """
+        # Only a single column is needed, so the filter can be evaluated
+        # once per value in the column's table
+        if len(self.columns) == 1:
+            name = self.columns[0]
+            return tables[name].matches(self.predicate)[batch[name]]
+
+        # Otherwise, combine the codes of each column into a single key, and
+        # evaluate the filter once per distinct key in the batch
+        keys = numpy.zeros(len(batch), dtype=numpy.int64)
+        for name in self.columns:
+            keys = keys * len(tables[name]) + batch[name]
+        distinct_keys, inverse = numpy.unique(keys, return_inverse=True)
+
+        results = []
+        for key in distinct_keys:
+            values = []
+            for name in reversed(self.columns):
+                key, code = divmod(int(key), len(tables[name]))
+                values.append(tables[name][code])
+            results.append(bool(self.predicate(*reversed(values))))
+        return numpy.array(results, dtype=bool)[inverse]
+
+
+class RowDecoder(object):
+    """Decodes lines from a bro log into the values stored in a BroRecord.
+    Each decoder is built once per log, from the log's headers, and only
+    extracts the columns listed in `COLUMNS`.
+    """
+
+    def __init__(self, fields=None, types=None, seperator="\t",
+                 unset_field="-"):
+        """
+        Keyword Args:
+            fields      -- a list of the column names in the log, as given in
+                           the log's "#fields" header.  If not provided, the
+                           columns are expected in the order given in
+                           `COLUMNS`.
+            types       -- a list of the column types in the log, as given in
+                           the log's "#types" header, if available.
+            seperator   -- the string used to seperate columns in the log
+            unset_field -- the value used in the log for unset columns
+
+        Raises:
+            ValueError -- if the given fields are missing a required column,
+                          or if the timestamp column isn't a time.
+        """
+        self.seperator = seperator
+        self.unset_field = unset_field
+
+        if fields is None:
+            # Without a "#fields" header, the columns are expected in the
+            # order given in `COLUMNS`, though the optional trailing
+            # columns may or may not be on each line
+            indexes = range(len(COLUMNS))
+            self.num_fields = None
+        else:
+            indexes = []
+            for name, aliases in COLUMNS:
+                index = None
+                for alias in aliases:
+                    if alias in fields:
+                        index = fields.index(alias)
+                        break
+                if index is None and name not in OPTIONAL_COLUMNS:
+                    raise ValueError("Log is missing the `{0}` column".format(
+                                     aliases[0]))
+                indexes.append(index)
+            self.num_fields = len(fields)
+
+        if types is not None and indexes[0] < len(types):
+            ts_type = types[indexes[0]]
+            if ts_type not in ("time", "double"):
+                raise ValueError("Log has a `ts` column of type " +
+                                 "`{0}`".format(ts_type))
+
+        # Optional columns missing from the log are always the trailing
+        # columns, and are filled in with None for every line
+        self._column_indexes = dict(zip([name for name, aliases in COLUMNS],
+                                        indexes))
+        self._indexes = [i for i in indexes if i is not None]
+        self._num_missing = len(indexes) - len(self._indexes)
+        self._getter = operator.itemgetter(*self._indexes)
+        self._num_required = len(COLUMNS) - len(OPTIONAL_COLUMNS)
+
+        # Values for the `INTERNED_COLUMNS` seen so far in the log, so
+        # that each distinct value is only stored once
+        column_names = [name for name, aliases in COLUMNS]
+        self._interned_positions = [column_names.index(name)
+                                    for name in INTERNED_COLUMNS]
+        self._strings = {}
+
+    def decode(self, line):
+        """Extracts the values for a BroRecord out of a line of a bro log.
+
+        Args:
+            line -- a single line from a bro log, without a trailing new line
+
+        Return:
+            A list of values, in the order given in `COLUMNS`.  The first value
+            is the timestamp of the record as a float, unset values are
+            replaced with empty strings, and optional columns that are not
+            in the log are given as None.  Values in `INTERNED_COLUMNS`
+            are shared with the values of earlier lines decoded by this
+            decoder.
+
+        Raises:
+            ValueError -- if the line doesn't have the number of columns
+                          described in the log's headers
+            IndexError -- if the log has no "#fields" header, and the line
+                          is missing required columns
+        """
+        return self.decode_values(self.split(line))
+
+    def split(self, line):
+        """Splits a line of a bro log into its columns, and checks that the
+        line has the expected number of columns.
+
+        Args:
+            line -- a single line from a bro log, without a trailing new line
+
+        Return:
+            A list of the raw values in each column of the line.
+
+        Raises:
+            See `decode`
+        """
+        values = line.split(self.seperator)
+        if len(values) != self.num_fields:
+            values = self._check_columns(values)
+        return values
+
+    def decode_values(self, values):
+        """Extracts the values for a BroRecord out of a line of a bro log
+        that has already been split into columns with `split`.
+
+        Args:
+            values -- a list of the raw values in each column of the line
+
+        Return:
+            See `decode`
+        """
+        unset_field = self.unset_field
+        decoded = [v if v != unset_field else "" for v in self._getter(values)]
+        decoded[0] = float(decoded[0])
+        if self._num_missing:
+            decoded += [None] * self._num_missing
+
+        shared_value = self._strings.setdefault
+        for i in self._interned_positions:
+            value = decoded[i]
+            decoded[i] = shared_value(value, value)
+        return decoded
+
+    def column_filter(self, record_filter):
+        """Builds a function that evaluates a ColumnFilter directly against
+        the raw values of a line split with `split`, so that lines can be
+        filtered out before a BroRecord is built for them.
+
+        Args:
+            record_filter -- a ColumnFilter instance
+
+        Return:
+            A function that takes a list of raw values, and returns True if
+            the line passes the filter.
+        """
+        unset_field = self.unset_field
+        predicate = record_filter.predicate
+        positions = [self._column_indexes[name]
+                     for name in record_filter.columns]
+
+        # Columns the filter needs that aren't in the log are always None,
+        # so if none of them are in the log, the filter is the same for
+        # every line
+        if all(i is None for i in positions):
+            result = bool(predicate(*positions))
+            return lambda values: result
+
+        if None in positions:
+            def _filter(values):
+                return predicate(*[None if i is None else
+                                   (values[i] if values[i] != unset_field
+                                    else "")
+                                   for i in positions])
+            return _filter
+
+        if len(positions) == 1:
+            position = positions[0]
+
+            def _filter(values):
+                value = values[position]
+                return predicate(value if value != unset_field else "")
+            return _filter
+
+        getter = operator.itemgetter(*positions)
+
+        def _filter(values):
+            return predicate(*[v if v != unset_field else ""
+                               for v in getter(values)])
+        return _filter
+
+    def _check_columns(self, values):
+        """Checks that a split line from a log has the expected number of
+        columns, padding out any optional trailing columns not on the line
+        for logs without a "#fields" header.
+
+        Args:
+            values -- a list of the values on a line from a bro log
+
+        Return:
+            A list of values with at least as many values as there are
+            columns to decode.
+        """
+        num_values = len(values)
+        if self.num_fields is not None:
+            raise ValueError("Expected {0} columns, found {1}".format(
+                             self.num_fields, num_values))
+
+        if num_values < self._num_required:
+            raise IndexError("Expected at least {0} columns, found {1}".format(
+                             self._num_required, num_values))
+
+        if num_values < len(self._indexes):
+            values += [None] * (len(self._indexes) - num_values)
+        return values
+
+
+def parse_query(uri):
+    """Parses the query string of a requested uri into a dict.  Parameters
+    are split on "&", and names and values are left as they appear in the
+    uri, without being url decoded.
+
+    Args:
+        uri -- a requested uri, such as "/path?name=value&other=value"
+
+    Return:
+        A dict mapping the name of each parameter in the query string to a
+        list of one or more values, in the order they appear in the uri.
+        Parameters without a "=" are left out.
+    """
+    params = {}
+    query = uri.partition("?")[2]
+    if not query:
+        return params
+    for pair in query.split("&"):
+        name, sep, value = pair.partition("=")
+        if sep:
+            params.setdefault(name, []).append(value)
+    return params
 
 
 class BroRecord(object):
+    """A single request from a bro log.  Records use slots, instead of a
+    per-instance dict, since millions of them are held in memory (and
+    pickled) at a time.  Values derived from the record's columns (`url`,
+    `query_params` and `date_str`) are computed the first time they're
+    requested, and are not pickled.
+    """
 
-    def __init__(self, line, seperator="\t", name=None):
-        values = [a if a != "-" else "" for a in line.split(seperator)]
-        self.ts = float(values[0])
+    # The attributes of a record that are pickled, in the order they are
+    # stored in a pickled record's state
+    _STATE_ATTRS = ("ts", "id_orig_h", "id_resp_h", "method", "host", "uri",
+                    "referrer", "user_agent", "status_code", "content_type",
+                    "location", "cookies", "line", "name")
+
+    __slots__ = _STATE_ATTRS + ("_url", "_query_params", "_date_str")
+
+    def __init__(self, line, seperator="\t", name=None, decoder=None):
+        if decoder is None:
+            decoder = RowDecoder(seperator=seperator)
+        self._load(decoder.decode(line), name)
+
+    @classmethod
+    def from_values(cls, values, name=None):
+        """Creates a BroRecord from the values decoded from a line of a
+        bro log.
+
+        Args:
+            values -- a list of values, as returned by `RowDecoder.decode`
+
+        Keyword Args:
+            name -- a description of where the record came from
+
+        Return:
+            A BroRecord instance
+        """
+        record = cls.__new__(cls)
+        record._load(values, name)
+        return record
+
+    def _load(self, values, name):
+        self.ts = values[0]
         self.id_orig_h = values[1]
         self.id_resp_h = values[2]
         self.method = values[3]
@@ -65,29 +593,58 @@ class BroRecord(object):
         self.status_code = values[8]
         self.content_type = values[9]
         self.location = values[10]
-        try:
-            self.cookies = values[11]
-        except IndexError:
-            self.cookies = None
+        self.cookies = values[11]
         self.line = None
         self.name = name
 
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self._STATE_ATTRS)
+
+    def __setstate__(self, state):
+        # Records pickled before BroRecord used slots were pickled as the
+        # record's __dict__, which may also include cached, derived values
+        if isinstance(state, dict):
+            state = tuple(state.get(attr) for attr in self._STATE_ATTRS)
+        for attr, value in zip(self._STATE_ATTRS, state):
+            setattr(self, attr, value)
+
+        # Since the same hosts, clients, etc. are repeated across all
+        # the records in a collection of graphs, share a single copy of
+        # these strings between unpickled records
+        for attr in INTERNED_COLUMNS:
+            value = getattr(self, attr)
+            if type(value) is str:
+                setattr(self, attr, intern(value))
+
     def __str__(self):
         return u"{url} in {name}".format(url=self.url, name=self.name)
 
-    @cached_property
+    @property
     def url(self):
-        return u"{host}{uri}".format(host=self.host, uri=self.uri)
+        try:
+            return self._url
+        except AttributeError:
+            self._url = u"{host}{uri}".format(host=self.host, uri=self.uri)
+            return self._url
 
-    @cached_property
+    @property
     def query_params(self):
-        return urlparse.parse_qs(self.url)
+        """A dict of the parameters in the record's query string, as
+        returned by `parse_query`."""
+        try:
+            return self._query_params
+        except AttributeError:
+            self._query_params = parse_query(self.uri)
+            return self._query_params
 
-    @cached_property
+    @property
     def date_str(self):
-        date = datetime.datetime.fromtimestamp(int(self.ts))
-        human_date = date.strftime('%Y-%m-%d %H:%M:%S')
-        return human_date
+        try:
+            return self._date_str
+        except AttributeError:
+            date = datetime.datetime.fromtimestamp(int(self.ts))
+            self._date_str = date.strftime('%Y-%m-%d %H:%M:%S')
+            return self._date_str
 
     def is_referrer_of(self, r):
         """Returns a boolean response of whether it looks like the current
@@ -6,85 +6,279 @@ import logging
 import multiprocessing
 import sys
 import argparse
-from .graphs import graphs
+from . import cache as record_cache
+from . import graphs as record_graphs
+from .graphfile import GraphFileWriter, GraphFileWriters, is_graph_file
+from .graphfile import move_graph_file, read_graphs, read_graphs_at
+from .graphfile import remove_graph_file
+from .hostindex import HostIndex
+from .graphs import graphs_from_records
+from .records import bro_records, ColumnFilter
+
+
+def _is_html_or_redirect(content_type, status_code):
+    short_content_type = content_type[:9]
+    return (short_content_type in ('text/plai', 'text/html') or
+            (status_code[:1] == "3" and len(status_code) == 3))
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+# Common filter expression, used for reducing bro records extracted from
+# log files down to only those that carry HTML content (or redirections
+# to the same).  Called with a BroRecord, the filter returns True if it
+# looks like the bro record referrs to a request for HTML or a 3xx redirect
+# to the same, otherwise False.  The filter can also be evaluated over
+# batches of records from `bro_record_batches`, with `record_filter.mask`.
+record_filter = ColumnFilter(("content_type", "status_code"),
+                             _is_html_or_redirect)
 
+# Helpers for extracting chains from bro data
+def _read_params(path):
+    """Returns the settings recorded next to a collection of extracted
+    graphs, or None if no settings were recorded."""
+    try:
+        with open(path, 'r') as h:
+            return h.read()
+    except IOError:
+        return None
 
-def record_filter(record):
-    """Common filter expression, used for reducing bro records extracted from
-    log files down to only those that carry HTML content (or redirections
-    to the same).
 
-    Args:
-        record -- a BroRecord object
+def _write_params(path, params):
+    """Records the settings a collection of graphs was extracted with, by
+    writing to a temporary file and moving it into place."""
+    tmp_path = "{0}.tmp".format(path)
+    with open(tmp_path, 'w') as h:
+        h.write(params)
+    os.rename(tmp_path, path)
 
-    Return:
-        True if it looks like the bro record referrs to a request for HTML or
-        a 3xx redirect to the same, otherwise False.
-    """
-    short_content_type = record.content_type[:9]
-    return (short_content_type in ('text/plai', 'text/html') or
-            (record.status_code[0] == "3" and len(record.status_code) == 3))
 
-# Helpers for extracting chains from bro data
 def _find_graphs_helper(args):
-    merge_rules, time, min_length, lite = args
+    (merge_rules, time, min_length, lite, max_memory, presorted, stream,
+     use_cache) = args
     files, dest = merge_rules
     log = logging.getLogger("brorecords")
 
+    # If we're caching parsed records, the key of the files in this work
+    # set is used both to check the cache, and to check that any graphs
+    # already extracted from the work set came from the same versions of
+    # the files.
+    if use_cache:
+        cache_path = "{0}.records".format(dest)
+        cache_key = record_cache.source_key(files)
+    else:
+        cache_key = None
+
     # First check and see if there is already a pickled version of
-    # extracted graphs from this given work set.  If so, we can quick out
-    # here.  For simplicty sake, we just append .pickle to the name of the
-    # path for the combined bro records
+    # extracted graphs from this given work set, extracted with the same
+    # settings.  If so, we can quick out here.  For simplicty sake, we just
+    # append .pickle to the name of the path for the combined bro records,
+    # and record the settings the graphs were extracted with next to them,
+    # in a .params file.
     tmp_path = "{0}.pickles.tmp".format(dest)
     final_path = "{0}.pickles".format(dest)
+    params_path = "{0}.params".format(final_path)
+    params = "time={0!r}\tmin_length={1!r}\tkey={2}\n".format(
+        time, min_length, cache_key or "-")
     if os.path.isfile(final_path):
-        log.info("Found picked records already at {0}".format(final_path))
-        return final_path
-
-    log.info("Merging {0} files into {1}".format(len(files), dest))
+        if _read_params(params_path) == params:
+            log.info("Found picked records already at {0}".format(final_path))
+            return final_path
+        log.info("{0}: Ignoring graphs extracted with other settings".format(
+                 final_path))
+
+    # If we're caching parsed records, check to see if the records in this
+    # work set have already been parsed, from the same versions of the
+    # files.  If so, we can read the records from there, and skip merging
+    # and parsing the logs.
+    records = None
+    source_h = None
+    if use_cache:
+        records = record_cache.read_records(cache_path, cache_key)
+        if records is not None:
+            log.info("{0}: Read {1} records from cache".format(
+                     dest, len(records)))
+            if not records:
+                return None
+
+    # If we're streaming, the merged records are read directly out of the
+    # gziped parts, and the merged log is never written to disk.  Otherwise,
+    # the merged log is written to disk first, and then read back in.
+    if records is None:
+        if stream:
+            log.info("Streaming {0} files into {1}".format(len(files), dest))
+            source_h = merge.MergedLog(files, dest, max_memory=max_memory,
+                                       presorted=presorted)
+        else:
+            log.info("Merging {0} files into {1}".format(len(files), dest))
+            if not merge.merge(files, dest, max_memory=max_memory,
+                               presorted=presorted):
+                return None
+            source_h = open(dest, 'r')
+
+        log.info("{0}: Begining parsing".format(dest))
+        records = bro_records(source_h, record_filter=record_filter)
+        if use_cache:
+            records = record_cache.cached_records(records, cache_path,
+                                                  cache_key)
 
-    if not merge.merge(files, dest):
-        return None
-
-    log.info("{0}: Begining parsing".format(dest))
     graph_count = 0
-    with open(dest, 'r') as source_h, open(tmp_path, 'w') as dest_h:
+    with GraphFileWriter(tmp_path) as dest_h:
         try:
-            for g in graphs(source_h, time=time, record_filter=record_filter):
+            for g in graphs_from_records(records, time=time):
                 graph_count += 1
                 if len(g) < min_length:
                     continue
-                pickle.dump(g, dest_h)
+                dest_h.write(g)
         except Exception, e:
             err = "Ignoring {0}: formatting errors in the log".format(dest)
             log.error(err)
             raise e
             return None
+        finally:
+            if source_h and not stream:
+                source_h.close()
+
+    if source_h and stream and source_h.num_lines == 0:
+        remove_graph_file(tmp_path)
+        return None
 
     log.info("{0}: Found {1} graphs".format(dest, graph_count))
 
-    if lite:
+    if lite and source_h and not stream:
         os.remove(dest)
 
-    # Now write the resulting collection of graphs to disk as a pickled
-    # collection.
-    os.rename(tmp_path, final_path)
+    # Now move the resulting collection of graphs, written as a graph
+    # file, and its index, into place.
+    move_graph_file(tmp_path, final_path)
+    _write_params(params_path, params)
     log.info("{0}: Successfully completed work".format(dest))
     return final_path
 
 
-def find_graphs(file_sets, workers=8, time=.5, min_length=3, lite=True):
+def find_graphs(file_sets, workers=8, time=.5, min_length=3, lite=True,
+                max_memory=None, presorted=False, stream=False, cache=False,
+                host_index=None):
     p = multiprocessing.Pool(workers, maxtasksperchild=1)
-    work_sets = [(f, time, min_length, lite) for f in file_sets]
+    work_sets = [(f, time, min_length, lite, max_memory, presorted, stream,
+                  cache) for f in file_sets]
     graphs = p.map(_find_graphs_helper, work_sets)
+
+    # The host index is shared by all the graph files, so it's only updated
+    # here, once all the workers are done, from each file's own index
+    if host_index:
+        index = HostIndex.load(host_index)
+        index.update([g for g in graphs if g])
+        index.save()
     return graphs
 
 
+def _merge_shard_helper(args):
+    (filelist, time, shard, num_shards, checkpoint_path, period,
+     max_pending) = args
+    log = logging.getLogger("brorecords")
+    shard_suffix = ".shard{0}".format(shard)
+    changed_count = 0
+
+    checkpoint = None
+    shard_checkpoint_path = None
+    if checkpoint_path:
+        checkpoint = record_graphs.MergeCheckpoint.load(checkpoint_path)
+        if checkpoint is not None:
+            checkpoint = checkpoint.for_shard(shard, num_shards)
+        shard_checkpoint_path = checkpoint_path + shard_suffix
+
+    with GraphFileWriters() as writers:
+        loader = record_graphs.shard_loader(shard, num_shards)
+        merged = record_graphs.merge(filelist, time=time, loader=loader,
+                                     checkpoint=checkpoint,
+                                     checkpoint_path=shard_checkpoint_path,
+                                     period=period, max_pending=max_pending)
+        for path, graph, is_changed in merged:
+            changed_count += is_changed
+            dst_path = path + (".changed" if is_changed else ".unchanged")
+            writers.write(dst_path + shard_suffix, graph)
+    log.info("Shard {0}: Found {1} changed graphs".format(shard,
+                                                         changed_count))
+    return [p[:-len(shard_suffix)] for p in writers.paths]
+
+
+def merge_shards(filelist, workers=8, time=10, checkpoint_path=None,
+                 period=None, max_pending=None):
+    """Merges the graphs in a collection of graph files, the same way
+    `brotools.graphs.merge` does, but in parallel.  Graphs are split into
+    shards by client (since graphs are only merged with graphs for the same
+    client), and each shard is merged in its own process.  Each merged
+    graph is written to a ".changed" file if it absorbed other graphs, and
+    otherwise to an ".unchanged" file, next to the file the graph was read
+    from.  Each process writes its own copy of these files, which are then
+    combined (without unpickling the graphs again) once all shards are done.
+
+    Args:
+        filelist -- a list of paths to graph files, sorted by the timestamps
+                    in the filenames
+
+    Keyword Args:
+        workers         -- the number of shards, and processes, to merge
+                           graphs with
+        time            -- the maximum amount of time that can have passed
+                           in a browsing session before the graph is closed
+        checkpoint_path -- if provided, the path to a merge checkpoint.  If
+                           a checkpoint exists at the path (from merging the
+                           logs before these), its graphs are merged with
+                           these logs, and then the checkpoint is replaced
+                           with the graphs that could be merged with the
+                           next log.  See `brotools.graphs.merge`.
+        period          -- the number of seconds each log covers, used when
+                           writing a checkpoint.  See
+                           `brotools.graphs.merge`.
+        max_pending     -- if provided, the most graphs each worker keeps in
+                           memory while waiting to see if they absorb
+                           graphs in later files.  See
+                           `brotools.graphs.merge`.
+
+    Return:
+        A sorted list of the paths of the ".changed" and ".unchanged" files
+        that were written to
+    """
+    work_sets = [(filelist, time, shard, workers, checkpoint_path, period,
+                  max_pending) for shard in range(workers)]
+    shard_suffixes = [".shard{0}".format(shard) for shard in range(workers)]
+
+    # Remove any shard files left behind by an earlier, interrupted merge,
+    # since the shard files are appended to
+    for path in filelist:
+        for dst_path in (path + ".changed", path + ".unchanged"):
+            for suffix in shard_suffixes:
+                if os.path.isfile(dst_path + suffix):
+                    remove_graph_file(dst_path + suffix)
+
+    p = multiprocessing.Pool(workers, maxtasksperchild=1)
+    dst_paths = set(path for paths in p.map(_merge_shard_helper, work_sets)
+                    for path in paths)
+    p.close()
+
+    for dst_path in sorted(dst_paths):
+        with GraphFileWriter(dst_path, append=True) as writer:
+            for suffix in shard_suffixes:
+                if os.path.isfile(dst_path + suffix):
+                    writer.write_file(dst_path + suffix)
+                    remove_graph_file(dst_path + suffix)
+
+    # Each worker writes a checkpoint for its own clients, which are
+    # combined into a single checkpoint, so that the next merge can be run
+    # with any number of workers
+    if checkpoint_path:
+        checkpoint = None
+        for suffix in shard_suffixes:
+            shard_checkpoint = record_graphs.MergeCheckpoint.load(
+                checkpoint_path + suffix)
+            if checkpoint is None:
+                checkpoint = shard_checkpoint
+            else:
+                checkpoint.extend(shard_checkpoint)
+            os.remove(checkpoint_path + suffix)
+        checkpoint.save(checkpoint_path)
+    return sorted(dst_paths)
+
+
 def default_cli_parser(description=None):
     """Returns a default command line parser argument, to reduce the number of
     times we need to have initilize the same parser.
@@ -139,6 +333,12 @@ def marketing_cli_parser(description=None):
     parser.add_argument('--moreniche', action="store_true",
                         help="Whether to look for MoreNitch affiliate " +
                         "marketing cookie stuffing.")
+    parser.add_argument('--host-index', default=None,
+                        help="If provided, the path to an index of the " +
+                        "hosts in each input graph file (created if it " +
+                        "doesn't exist, and updated for any new or changed " +
+                        "inputs).  Only graphs with a request to one of the " +
+                        "selected marketers' domains are read.")
     return parser
 
 
@@ -156,11 +356,14 @@ def parse_default_cli_args(parser):
             - an iterator for reading unpickled data from
             - a file handle for writing output to
             - a function that should be used for writing error messages
-            - the `Namespace` object returned from calling `parser.parse_args()`
+            - the `Namespace` object returned from calling
+              `parser.parse_args()`, with `inputs` set to the list of paths
+              to read from (whether given on the commandline, or on STDIN)
     """
     args = parser.parse_args()
 
-    num_inputs, inputs = unpickled_inputs(args.inputs or sys.stdin.read())
+    args.inputs = input_paths(args.inputs or sys.stdin.read())
+    num_inputs, inputs = unpickled_inputs(args.inputs)
 
     output_h = open(args.output, 'w') if args.output else sys.stdout
 
@@ -224,24 +427,83 @@ def parse_marketing_cli_args(parser):
         import stuffing.moreniche
         marketers += stuffing.moreniche.CLASSES
 
+    if args.host_index:
+        inputs = marketer_inputs(args.inputs, marketers, args.host_index)
+
     return num_inputs, inputs, output_h, debug, marketers, args
 
 
-def unpickled_inputs(paths):
-    """Returns the count of files that will try to be unpickled, along with
-    a iterator function that returns the contents of those unpickled files.
+def marketer_inputs(paths, marketers, host_index_path):
+    """Returns an iterator function, like the one returned by
+    `unpickled_inputs`, that only returns the graphs with a request to a
+    domain watched by at least one of the given marketers, using an index of
+    the hosts in each graph file to only read those graphs from disk.
 
     Args:
-        paths -- a list of paths to pickled objects on disk
+        paths           -- a list of paths to graph files on disk
+        marketers       -- a list of AffiliateHistory subclasses
+        host_index_path -- the path to a host index, which is created if it
+                           doesn't exist, and updated to include each of the
+                           given paths
 
-    Returns:
-        Two values, first an integer count of the number of values it will
-        parse and return, and second, a generator function that returns
-        pairs of values, the first being the path on disk, as a string, that
-        was unpickled, and the second being the object that was unpickled.
+    Return:
+        A generator function that returns pairs of values, the path of a
+        graph file, and a graph read from the file
     """
+    from stuffing.affiliate import FULL_DOMAIN
+    from stuffing.dispatch import MarketerDispatcher
+
     log = logging.getLogger("brorecords")
+    host_index = HostIndex.load(host_index_path)
+    indexed_paths = [p for p in paths if is_graph_file(p)]
+    host_index.update(indexed_paths)
+    host_index.save()
+
+    hosts = set()
+    for marketer in marketers:
+        for domain_name, match_type in marketer.domains():
+            if match_type is FULL_DOMAIN:
+                if domain_name in host_index:
+                    hosts.add(domain_name)
+            else:
+                hosts.update(host_index.hosts_containing(domain_name))
+    log.info("Found {0} hosts watched by the selected marketers".format(
+             len(hosts)))
+
+    dispatcher = MarketerDispatcher(marketers)
+
+    def _watched(graph):
+        return any(dispatcher.watches_host(h) for h in graph.hosts())
+
+    def _marketer_graphs():
+        locations = host_index.postings(hosts, paths=indexed_paths)
+        for p in paths:
+            # Legacy files of concatenated pickles can't have individual
+            # graphs read out of them, so they're read whole and filtered
+            if not is_graph_file(p):
+                for graph in read_graphs(p):
+                    if _watched(graph):
+                        yield p, graph
+                continue
+            file_locations = locations.get(os.path.abspath(p))
+            if file_locations:
+                for graph in read_graphs_at(p, file_locations):
+                    yield p, graph
+
+    return _marketer_graphs
+
+
+def input_paths(paths):
+    """Returns a sorted list of paths to read from, out of either a string
+    of paths, one per line, or a list of paths.
+
+    Args:
+        paths -- either a string of paths, separated by new lines, or a list
+                 of paths
 
+    Return:
+        A sorted list of paths, with empty paths removed
+    """
     # First try assuming we've gotten a single string of file paths, and if
     # that doesn't seem right, assume we've gotten a list of file paths
     try:
@@ -253,21 +515,33 @@ def unpickled_inputs(paths):
     # like a trailing empty string in a list, etc.
     processed_in_paths = [p.strip() for p in in_paths if len(p.strip()) > 0]
     processed_in_paths.sort()
+    return processed_in_paths
+
+
+def unpickled_inputs(paths):
+    """Returns the count of files that will try to be unpickled, along with
+    a iterator function that returns the contents of those unpickled files.
+
+    Args:
+        paths -- a list of paths to graph files on disk, either in the graph
+                 container format, or legacy files of pickled objects
+
+    Returns:
+        Two values, first an integer count of the number of values it will
+        parse and return, and second, a generator function that returns
+        pairs of values, the first being the path on disk, as a string, that
+        was unpickled, and the second being the object that was unpickled.
+    """
+    log = logging.getLogger("brorecords")
+    processed_in_paths = input_paths(paths)
 
     def _unpickled_files():
         index = 0
         for p in processed_in_paths:
-            with open(p, 'r') as h:
-                while True:
-                    try:
-                        index += 1
-                        if index % 10000 == 0:
-                            log.info(" * Completed graph: {0}".format(index))
-                        yield p, pickle.load(h)
-                    except EOFError:
-                        break
-                    except:
-                        log.info(" * Pickle error, skipping: {0}".format(p))
-                        pass
+            for graph in read_graphs(p):
+                index += 1
+                if index % 10000 == 0:
+                    log.info(" * Completed graph: {0}".format(index))
+                yield p, graph
 
     return len(processed_in_paths), _unpickled_files
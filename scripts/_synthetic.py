@@ -0,0 +1,127 @@
+"""Fixtures shared by the benchmark scripts, for generating synthetic bro
+logs, and for measuring and reporting results."""
+
+import random
+import resource
+import StringIO
+import sys
+import stuffing.amazon
+import stuffing.godaddy
+import stuffing.moreniche
+import stuffing.pussycash
+import stuffing.sextronics
+from stuffing.affiliate import FULL_DOMAIN
+
+HEADERS = (
+    "#separator \\x09\n"
+    "#unset_field\t-\n"
+    "#fields\tts\tid.orig_h\tid.resp_h\tmethod\thost\turi\treferrer\t"
+    "user_agent\tstatus_code\tcontent_type\tlocation\tcookies\n"
+)
+
+AGENTS = (
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:26.0) Gecko/20100101 Firefox/26.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_1) AppleWebKit/537.73.11 " +
+    "(KHTML, like Gecko) Version/7.0.1 Safari/537.73.11",
+    "Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; Trident/6.0)",
+)
+
+# The time the synthetic logs start at
+FIRST_TS = 1388592000.0
+
+# Every marketer class, for sessions on marketers' sites
+MARKETERS = (stuffing.pussycash.CLASSES + stuffing.sextronics.CLASSES +
+             [stuffing.amazon.AmazonAffiliateHistory,
+              stuffing.godaddy.GodaddyAffiliateHistory] +
+             stuffing.moreniche.CLASSES)
+
+
+def client_ip(i):
+    """Returns a distinct client IP address for each given integer."""
+    return "10.{0}.{1}.{2}".format(i // 65536, (i // 256) % 256, i % 256)
+
+
+def marketer_host(marketer):
+    """Returns a host that the given marketer watches."""
+    domain_name, match_type = marketer.domains()[0]
+    if match_type is FULL_DOMAIN:
+        return domain_name
+    return "www." + domain_name.strip(".") + "com"
+
+
+def log_line(ts, ip, host, uri, referrer="-", user_agent="Mozilla/5.0",
+             status_code="200", content_type="text/html", cookies="-",
+             resp_h="93.184.216.34"):
+    """Returns a single line of a bro log, with the columns in HEADERS,
+    without a trailing new line."""
+    return "\t".join(("{0:.6f}".format(ts), ip, resp_h, "GET", host, uri,
+                      referrer, user_agent, status_code, content_type, "-",
+                      cookies))
+
+
+def log_text(lines):
+    """Returns the text of a bro log with the given lines, after HEADERS."""
+    return HEADERS + "".join(l + "\n" for l in lines)
+
+
+def session_log(count, session_requests):
+    """Returns the text of a bro log of browsing sessions, each from its own
+    client, where each request after the first in a session was referred by
+    a random earlier request in the session.
+
+    Args:
+        count            -- the number of browsing sessions in the log
+        session_requests -- a function called with a random.Random instance
+                            and the index of each session, that returns a
+                            list of the requests made in the session, each
+                            as a tuple of a host, a uri and a cookie header
+
+    Return:
+        The text of a bro log, with the requests sorted by time.
+    """
+    rand = random.Random(1)
+    lines = []
+    for i in xrange(count):
+        ip = client_ip(i)
+        ts = FIRST_TS + rand.random() * 3600
+        urls = []
+        for host, uri, cookies in session_requests(rand, i):
+            referrer = "http://" + rand.choice(urls) if urls else "-"
+            urls.append(host + uri)
+            lines.append((ts, log_line(ts, ip, host, uri, referrer=referrer,
+                                       cookies=cookies)))
+            ts += rand.random()
+    lines.sort()
+    return log_text(l for _, l in lines)
+
+
+def log_handle(text, name="synthetic.log"):
+    """Returns a named, file like handle to read the given log text from."""
+    handle = StringIO.StringIO(text)
+    handle.name = name
+    return handle
+
+
+def rss():
+    """Returns the current resident memory of the process, in bytes."""
+    with open("/proc/self/statm", 'r') as h:
+        pages = int(h.read().split()[1])
+    return pages * resource.getpagesize()
+
+
+def report(title, rows):
+    """Prints a titled block of measurements.
+
+    Args:
+        title -- the name of what was measured
+        rows  -- a list of pairs of values, the name of a measurement and
+                 its value.  Floats are printed to two decimal places, and
+                 other values as is, so values that need another precision
+                 should be given already formatted.
+    """
+    print "{0}".format(title)
+    for name, value in rows:
+        if isinstance(value, float):
+            value = "{0:.2f}".format(value)
+        print "  {0:20}{1:>10}".format(name + ":", value)
+    sys.stdout.flush()
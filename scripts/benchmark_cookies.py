@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Measures the time taken, per graph, to find each marketer's session
+cookie in a graph, the work `cookie_counts.py` does for every graph it
+reads.  Graphs are built from a synthetic log of browsing sessions on
+marketers' sites, where every request sends a long cookie header.  For
+comparison, session cookies are also found by searching each record's
+cookie header with a regular expression per marketer, the way marketers
+found their session cookies before they searched for the cookie's whole
+name, which is also used to check the cookies found.  Each pass examines
+each graph once with each method, as `cookie_counts.py` does."""
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import re
+import time
+from brotools.graphs import graphs_from_records
+from brotools.records import bro_records
+from stuffing.dispatch import MarketerDispatcher
+from _synthetic import MARKETERS, log_handle, marketer_host, report
+from _synthetic import session_log
+
+parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+parser.add_argument('--count', '-c', type=int, default=5000,
+                    help="The number of synthetic browsing sessions to " +
+                    "generate.")
+parser.add_argument('--cookies', '-k', type=int, default=30,
+                    help="The number of cookies sent with each request.")
+args = parser.parse_args()
+
+
+def cookie_header(rand, count, session_cookie, session_id):
+    """Returns a cookie header with the given number of tracking and
+    preference cookies, with the given session cookie (if any) placed at a
+    random position among them."""
+    cookies = ["__utm{0}={1:x}.{2}".format(i, rand.getrandbits(64),
+                                           rand.randint(0, 10 ** 9))
+               for i in xrange(count)]
+    if session_cookie:
+        cookies.insert(rand.randint(0, count),
+                       "{0}={1}".format(session_cookie, session_id))
+    return "; ".join(cookies)
+
+
+def synthetic_log(count, num_cookies):
+    """Returns the text of a bro log with the given number of browsing
+    sessions, each a chain of between one and twenty requests to the site
+    of a random marketer.  Most requests in a session carry the marketer's
+    session cookie."""
+    def session_requests(rand, i):
+        marketer = rand.choice(MARKETERS)
+        host = marketer_host(marketer)
+        session_cookie = marketer.session_cookie_names()[0]
+        session_id = "{0:x}".format(rand.getrandbits(64))
+        return [(host, "/page/{0}".format(rand.randint(0, 50)),
+                 cookie_header(rand, num_cookies,
+                               session_cookie if j else None, session_id))
+                for j in xrange(rand.randint(1, 20))]
+    return session_log(count, session_requests)
+
+
+def regex_session_id_for_graph(marketer, patterns, graph):
+    """Finds the first session id for a marketer in a graph by searching
+    the cookie header of each of the marketer's nodes with a regular
+    expression."""
+    pattern = patterns[marketer]
+    for n in marketer.nodes_for_domains(graph):
+        if not n.cookies:
+            continue
+        match = pattern.search(n.cookies)
+        if match:
+            return match.group(1)
+    return None
+
+
+def measure(methods, graphs, passes=20):
+    """Reports the time taken, per graph, by each of the given methods to
+    find the session id of each marketer interested in each graph, and
+    returns the session ids each method found.  Each pass examines every
+    graph once with each method in turn, so that every method is measured
+    under the same conditions, and the fastest pass of each is reported."""
+    pairs = [(m, g) for g in graphs for m in dispatcher.marketers_for_graph(g)]
+    times = [[] for _ in methods]
+    found = [None for _ in methods]
+    for _ in xrange(passes):
+        for i, (_, find_session_id) in enumerate(methods):
+            start = time.time()
+            found[i] = [find_session_id(m, g) for m, g in pairs]
+            times[i].append(time.time() - start)
+    for (label, _), method_times in zip(methods, times):
+        fastest = min(method_times)
+        report(label, [("graphs", len(graphs)),
+                       ("passes", passes),
+                       ("fastest seconds", "{0:.3f}".format(fastest)),
+                       ("usecs / graph", "{0:.1f}".format(
+                           fastest * 1000000 / len(graphs)))])
+    return found
+
+
+log_text = synthetic_log(args.count, args.cookies)
+dispatcher = MarketerDispatcher(MARKETERS)
+patterns = dict((m, re.compile(re.escape(m.session_cookie_names()[0]) +
+                               r'=([^\;]+)'))
+                for m in MARKETERS)
+graphs = list(graphs_from_records(bro_records(log_handle(log_text))))
+
+expected, found = measure([
+    ("Regex search per marketer",
+     lambda m, g: regex_session_id_for_graph(m, patterns, g)),
+    ("Cookie search per marketer",
+     lambda m, g: m.session_id_for_graph(g))], graphs)
+report("Checked against regex search", [("correct", str(found == expected))])
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""Measures the time taken to build the BroRecordGraphs in a bro log, and
+the memory used by, and the pickled size of, the built graphs.  Graphs are
+built from a synthetic log, or from plain text bro logs if any are given.
+For comparison, the same graphs are also built with the networkx.DiGraph
+backed graphs that were used before graphs were stored as arrays of
+parent and child ordinals.  Last, the time taken to build, and merge,
+single very long browsing sessions is measured, against graphs that
+resort their nodes on every insertion, the way graphs did before nodes
+were inserted in order, and the time taken to find referrers in a graph
+where one url is requested thousands of times is measured against a
+linear scan, which is also used to check the referrers found."""
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import gc
+import random
+import time
+import networkx as nx
+import brotools.graphs
+from brotools.graphs import BroRecordGraph, graphs_from_records
+from brotools.graphs import EARLIEST, NEAREST_EARLIER
+from brotools.records import bro_records
+from _synthetic import FIRST_TS, log_handle, log_line, log_text, report
+from _synthetic import rss, session_log
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+parser.add_argument('--inputs', '-i', nargs='*',
+                    help="Plain text bro logs to read records from.  If not " +
+                    "provided, a synthetic log is used.")
+parser.add_argument('--count', '-c', type=int, default=20000,
+                    help="The number of synthetic browsing sessions to " +
+                    "generate.")
+parser.add_argument('--time', '-t', type=float, default=10,
+                    help="The maximum time between requests in a graph.")
+parser.add_argument('--session-size', '-s', type=int, default=10000,
+                    help="The number of requests in the long synthetic " +
+                    "browsing session.")
+args = parser.parse_args()
+
+def synthetic_log(count):
+    """Returns the text of a bro log with the given number of browsing
+    sessions, each a chain of between one and twenty requests, where each
+    request was referred by an earlier request in the session."""
+    def session_requests(rand, i):
+        return [("www.site{0}.com".format(rand.randint(0, 300)),
+                 "/page/{0}".format(rand.randint(0, 50)), "-")
+                for _ in xrange(rand.randint(1, 20))]
+    return session_log(count, session_requests)
+
+
+class NetworkxGraph(BroRecordGraph):
+    """A graph laid out like BroRecordGraphs were before they were stored
+    as arrays of ordinals, with the edges of the graph held in a
+    networkx.DiGraph, and the entire instance dict pickled."""
+
+    def __init__(self, br, referrer_policy=EARLIEST):
+        self._g = nx.DiGraph()
+        self.referrer_policy = referrer_policy
+        self.ip = br.id_orig_h
+        self.user_agent = br.user_agent
+        self._g.add_node(br)
+        self._root = br
+        self.earliest_ts = br.ts
+        self.latest_ts = br.ts
+        self._nodes_sorted = [br]
+        self._nodes_by_url = {br.url: [br]}
+        self._nodes_by_host = {br.host: [br]}
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def add_node(self, br, parent=None):
+        referrer_node = parent or self.referrer_record(br)
+        if not referrer_node:
+            return False
+
+        time_difference = br.ts - referrer_node.ts
+        self._g.add_weighted_edges_from([(referrer_node, br, time_difference)])
+        self.latest_ts = max(br.ts, self.latest_ts)
+        self._nodes_sorted.append(br)
+        self._nodes_sorted.sort(key=lambda x: x.ts)
+        self._nodes_by_url.setdefault(br.url, []).append(br)
+        self._nodes_by_host.setdefault(br.host, []).append(br)
+        return True
+
+
+class ResortingGraph(BroRecordGraph):
+    """A graph that resorts all of its nodes each time a node is added,
+    and merges in other graphs one node at a time, the way graphs did before
+    nodes were inserted in order."""
+
+    def add_node(self, br, parent=None):
+        if not BroRecordGraph.add_node(self, br, parent=parent):
+            return False
+        self._nodes_sorted.sort(key=lambda x: x.ts)
+        return True
+
+    def add_graph(self, child_graph):
+        if not self.referrer_record(child_graph._root):
+            return False
+        for n in child_graph.nodes():
+            if not self.add_node(n):
+                raise LookupError("Unable to reattach child node when " +
+                                  "merging graphs")
+        return True
+
+
+def long_session(count):
+    """Returns a list of BroRecords making up a single, crawler like,
+    browsing session, where each request was referred by a random earlier
+    request."""
+    rand = random.Random(1)
+    lines = []
+    ts = FIRST_TS
+    uris = []
+    for i in xrange(count):
+        uri = "/page/{0}".format(i)
+        referrer = "http://www.site.com" + rand.choice(uris) if uris else "-"
+        uris.append(uri)
+        lines.append(log_line(ts, "10.0.0.1", "www.site.com", uri,
+                              referrer=referrer))
+        ts += rand.random()
+    return list(bro_records(log_handle(log_text(lines), "session.log")))
+
+
+def measure_session(label, graph_class, records):
+    """Reports the time taken to build a single graph out of the given
+    records, and the time taken to build the same graph by merging a graph
+    of the second half of the records into a graph of the first half."""
+    start = time.time()
+    graph = graph_class(records[0])
+    for r in records[1:]:
+        graph.add_node(r)
+    build_elapsed = time.time() - start
+
+    half = len(records) // 2
+    first = graph_class(records[0])
+    for r in records[1:half]:
+        first.add_node(r)
+    # The second half of the session is built as a graph where the first
+    # request of the half is the root, by ignoring the referrers of the
+    # other requests that point into the first half.
+    second = graph_class(records[half])
+    for r in records[half + 1:]:
+        parent = second.referrer_record(r) or second._root
+        second.add_node(r, parent=parent)
+    start = time.time()
+    first.add_graph(second)
+    merge_elapsed = time.time() - start
+
+    report(label, [("nodes", len(graph)),
+                   ("build seconds", build_elapsed),
+                   ("merge seconds", merge_elapsed)])
+
+
+def hot_url_session(count):
+    """Returns a list of BroRecords making up a single browsing session,
+    where the client keeps returning to the same page, and a list of
+    records for pages referred by that page at random times during the
+    session."""
+    rand = random.Random(1)
+    lines = []
+    ts = FIRST_TS
+    for i in xrange(count):
+        referrer = "http://www.site.com/" if i else "-"
+        lines.append(log_line(ts, "10.0.0.1", "www.site.com", "/",
+                              referrer=referrer))
+        ts += rand.random()
+    end_ts = ts
+    for i in xrange(count):
+        ts = FIRST_TS + rand.random() * (end_ts - FIRST_TS)
+        lines.append(log_line(ts, "10.0.0.1", "www.other.com",
+                              "/{0}".format(i),
+                              referrer="http://www.site.com/"))
+    records = list(bro_records(log_handle(log_text(lines), "hot.log")))
+    return records[:count], records[count:]
+
+
+def linear_referrer_record(graph, record):
+    """Finds the referrer of the given record in the graph by checking
+    every node in the graph, using the graph's referrer policy."""
+    candidates = [n for n in graph.nodes()
+                  if n.url == record.referrer and n.ts < record.ts]
+    if not candidates:
+        return None
+    return candidates[0 if graph.referrer_policy == EARLIEST else -1]
+
+
+def measure_referrers(label, policy, session, lookups):
+    """Reports the time taken to find the referrer of each of the given
+    lookup records in a graph of the given session, and checks that each
+    referrer is the same one found by a linear scan."""
+    graph = BroRecordGraph(session[0], referrer_policy=policy)
+    for r in session[1:]:
+        graph.add_node(r)
+
+    start = time.time()
+    found = [graph.referrer_record(r) for r in lookups]
+    elapsed = time.time() - start
+
+    start = time.time()
+    expected = [linear_referrer_record(graph, r) for r in lookups]
+    linear_elapsed = time.time() - start
+
+    report(label, [
+        ("nodes for url", len(graph)),
+        ("lookups", len(lookups)),
+        ("indexed seconds", "{0:.4f}".format(elapsed)),
+        ("linear seconds", "{0:.4f}".format(linear_elapsed)),
+        ("correct", str(all(a is b for a, b in zip(found, expected))))])
+
+
+def measure(label, graph_class, records):
+    """Builds the graphs for the given records with the given graph class,
+    and reports the time taken, and the growth in memory and pickled
+    size, per node.  Each measurement is taken in its own, forked process,
+    so that memory freed by one measurement can't be reused by the next."""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    brotools.graphs.BroRecordGraph = graph_class
+    gc.collect()
+    start_rss = rss()
+    start = time.time()
+    graphs = list(graphs_from_records(records, time=args.time))
+    elapsed = time.time() - start
+    gc.collect()
+    growth = rss() - start_rss
+    num_nodes = sum(len(g) for g in graphs)
+    pickled = len(pickle.dumps(graphs, pickle.HIGHEST_PROTOCOL))
+    pickled -= len(pickle.dumps([n for g in graphs for n in g.nodes()],
+                                pickle.HIGHEST_PROTOCOL))
+    report(label, [
+        ("graphs", len(graphs)),
+        ("nodes", num_nodes),
+        ("build seconds", elapsed),
+        ("bytes / node", "{0:.1f}".format(growth / float(num_nodes))),
+        ("pickled / node", "{0:.1f}".format(pickled / float(num_nodes)))])
+    os._exit(0)
+
+
+if args.inputs:
+    handles = [open(p, 'r') for p in args.inputs]
+else:
+    handles = [log_handle(synthetic_log(args.count))]
+
+records = [r for h in handles for r in bro_records(h)]
+
+measure("networkx graphs", NetworkxGraph, records)
+measure("BroRecordGraphs", BroRecordGraph, records)
+
+session_records = long_session(args.session_size)
+measure_session("Resorting session graph", ResortingGraph, session_records)
+measure_session("BroRecordGraph session graph", BroRecordGraph,
+                session_records)
+
+hot_session, hot_lookups = hot_url_session(args.session_size)
+measure_referrers("Earliest referrers", EARLIEST, hot_session, hot_lookups)
+measure_referrers("Nearest earlier referrers", NEAREST_EARLIER, hot_session,
+                  hot_lookups)
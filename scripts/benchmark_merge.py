@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Measures the time taken to check whether graphs fall near the boundary
+between two logs, the check `brotools.graphs.merge` makes for every graph
+to find the few that could be merged with graphs in other logs.  Graphs are
+generated at random times over a synthetic month of hourly logs.  For
+comparison, the same checks are also made by scanning every boundary, the
+way merge did before it used a binary search, which is also used to check
+the results of the binary search."""
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import collections
+import random
+import time
+from brotools.graphs import _could_be_merger, _could_be_mergee
+from _synthetic import report
+
+parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+parser.add_argument('--count', '-c', type=int, default=200000,
+                    help="The number of synthetic graphs to check.")
+parser.add_argument('--days', '-d', type=int, default=30,
+                    help="The number of days of hourly logs to generate " +
+                    "boundaries for.")
+parser.add_argument('--time', '-t', type=float, default=10,
+                    help="The maximum time between requests in a graph.")
+args = parser.parse_args()
+
+Graph = collections.namedtuple("Graph", ["earliest_ts", "latest_ts"])
+
+
+def linear_could_be_merger(graph, log_merge_ranges):
+    latest_ts = graph.latest_ts
+    for start, mid, end in log_merge_ranges:
+        if start > latest_ts and end > latest_ts:
+            return False
+        if latest_ts >= start and latest_ts <= mid:
+            return True
+    return False
+
+
+def linear_could_be_mergee(graph, log_merge_ranges):
+    earliest_ts = graph.earliest_ts
+    latest_ts = graph.latest_ts
+    for start, mid, end in log_merge_ranges:
+        if start > latest_ts and end > latest_ts:
+            return False
+        if earliest_ts >= mid and earliest_ts <= end:
+            return True
+    return False
+
+
+def synthetic_graphs(count, first_ts, last_ts):
+    """Returns a list of graphs, each starting at a random time between the
+    given times, and lasting up to ten minutes.  One in ten graphs starts
+    within a few seconds of an hour boundary."""
+    rand = random.Random(1)
+    graphs = []
+    for i in xrange(count):
+        if i % 10 == 0:
+            hour = rand.randint(0, int(last_ts - first_ts) // 3600)
+            earliest_ts = first_ts + hour * 3600 + rand.uniform(-20, 20)
+        else:
+            earliest_ts = rand.uniform(first_ts, last_ts)
+        graphs.append(Graph(earliest_ts, earliest_ts + rand.random() * 600))
+    return graphs
+
+
+first_ts = 1388534400
+boundaries = [first_ts + h * 3600 for h in xrange(args.days * 24)]
+log_merge_ranges = [(t - args.time, t, t + args.time) for t in boundaries]
+graphs = synthetic_graphs(args.count, first_ts, boundaries[-1] + 3600)
+
+start = time.time()
+found = [(_could_be_merger(g, boundaries, args.time),
+          _could_be_mergee(g, boundaries, args.time)) for g in graphs]
+elapsed = time.time() - start
+
+start = time.time()
+expected = [(linear_could_be_merger(g, log_merge_ranges),
+             linear_could_be_mergee(g, log_merge_ranges)) for g in graphs]
+linear_elapsed = time.time() - start
+
+report("Log boundary checks", [
+    ("boundaries", len(boundaries)),
+    ("graphs", len(graphs)),
+    ("near a boundary", sum(1 for f in found if any(f))),
+    ("bisect seconds", elapsed),
+    ("linear seconds", linear_elapsed),
+    ("correct", str(found == expected))])
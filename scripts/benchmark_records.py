@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Measures the memory used by, and the pickled size of, each BroRecord
+parsed from a bro log.  Records are parsed out of a synthetic log, or out
+of plain text bro logs if any are given.  For comparison, the same lines
+are also loaded into plain, dict backed objects holding their own copy
+of every column, the way BroRecords were stored before they used slots."""
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import gc
+import random
+from brotools.records import bro_records
+from _synthetic import AGENTS, FIRST_TS, log_handle, log_line, log_text
+from _synthetic import report, rss
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+parser.add_argument('--inputs', '-i', nargs='*',
+                    help="Plain text bro logs to read records from.  If not " +
+                    "provided, a synthetic log is used.")
+parser.add_argument('--count', '-c', type=int, default=200000,
+                    help="The number of synthetic records to generate.")
+args = parser.parse_args()
+
+def synthetic_log(count):
+    """Returns the text of a bro log with the given number of records,
+    drawn from a few hundred clients and hosts."""
+    rand = random.Random(1)
+    lines = []
+    ts = FIRST_TS
+    for i in xrange(count):
+        ts += rand.random() / 100
+        host = "www.site{0}.com".format(rand.randint(0, 300))
+        lines.append(log_line(
+            ts,
+            "10.0.{0}.{1}".format(rand.randint(0, 3), rand.randint(0, 250)),
+            host,
+            "/page/{0}?id={1}".format(rand.randint(0, 50), i),
+            referrer="http://{0}/".format(host),
+            user_agent=rand.choice(AGENTS),
+            status_code=rand.choice(("200", "200", "200", "302", "404")),
+            content_type=rand.choice(("text/html", "image/png", "-")),
+            resp_h="93.184.216.{0}".format(rand.randint(0, 300) % 256)))
+    return log_text(lines)
+
+
+class DictRecord(object):
+    """A record laid out like BroRecords were before they used slots, with
+    an instance dict and an unshared copy of every column."""
+
+    def __init__(self, line):
+        values = [a if a != "-" else "" for a in line.split("\t")]
+        self.ts = float(values[0])
+        self.id_orig_h = values[1]
+        self.id_resp_h = values[2]
+        self.method = values[3]
+        self.host = values[4]
+        self.uri = values[5]
+        self.referrer = values[6]
+        self.user_agent = values[7]
+        self.status_code = values[8]
+        self.content_type = values[9]
+        self.location = values[10]
+        self.cookies = values[11]
+        self.line = None
+        self.name = None
+
+
+def measure(label, load):
+    """Loads a collection of records with the given function, and reports
+    the growth in memory, per record.  Each measurement is taken in its own,
+    forked process, so that memory freed by one measurement can't be reused
+    by the next."""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    gc.collect()
+    start_rss = rss()
+    records = load()
+    gc.collect()
+    growth = rss() - start_rss
+    sample = records[:10000]
+    pickled = sum(len(pickle.dumps(r, pickle.HIGHEST_PROTOCOL))
+                  for r in sample)
+    report(label, [
+        ("records", len(records)),
+        ("bytes / record", "{0:.1f}".format(growth / float(len(records)))),
+        ("pickled / record", "{0:.1f}".format(pickled / float(len(sample))))])
+    os._exit(0)
+
+
+if args.inputs:
+    log_texts = [(p, open(p, 'r').read()) for p in args.inputs]
+else:
+    log_texts = [("synthetic.log", synthetic_log(args.count))]
+
+
+def handles():
+    for name, text in log_texts:
+        yield log_handle(text, name)
+
+source_lines = [l for name, text in log_texts
+                for l in text.split("\n") if l and l[0] != "#"]
+
+measure("Dict records", lambda: [DictRecord(l) for l in source_lines])
+measure("BroRecords", lambda: [r for h in handles() for r in bro_records(h)])
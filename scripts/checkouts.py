@@ -9,6 +9,7 @@ import os.path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import brotools.reports
+from stuffing.dispatch import MarketerDispatcher
 
 parser = brotools.reports.marketing_cli_parser(sys.modules[__name__].__doc__)
 parser.add_argument('--ttl', type=int, default=84600,
@@ -21,6 +22,7 @@ parser.add_argument('--secs', type=int, default=3600,
                     "for those requests to be treated as a seperate checkout")
 cli_params = brotools.reports.parse_marketing_cli_args(parser)
 count, ins, out, debug, marketers, args = cli_params
+dispatcher = MarketerDispatcher(marketers)
 
 # Multi indexed dict, in the following format:
 #
@@ -39,7 +41,7 @@ for path, graphs in ins():
     debug("{0}-{1}. Considering {2}".format(index, count, path))
     debug("{0}-{1}. Found {2} graphs".format(index, count, len(graphs)))
     for g in graphs:
-        for marketer in marketers:
+        for marketer in dispatcher.marketers_for_graph(g):
 
             # See if we can find a session tracking cookie for this visitor
             # in this graph.  If not, then we know there are no cookie stuffs,
@@ -7,6 +7,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import brotools.reports
 import brotools.records
+from brotools.graphfile import query_graphs
 import dateutil.parser
 import time
 
@@ -32,26 +33,16 @@ end_ts = None
 if args.end:
     end_ts = time.mktime(dateutil.parser.parse(args.end).timetuple())
 
-debug("Getting ready to start reading {0} graphs".format(count))
+debug("Getting ready to start reading {0} graph files".format(count))
 index = 0
-for path, graphs in ins():
+for path in args.inputs:
     index += 1
     debug("{0}-{1}. Considering {2}".format(index, count, path))
-    debug("{0}-{1}. Found {2} graphs".format(index, count, len(graphs)))
+    # Only the graphs matching the client and time range are read out of
+    # each file, using the file's index when it has one
+    graphs = query_graphs(path, ip=args.ip, user_agent=args.agent,
+                          start=start_ts, end=end_ts)
     for g in graphs:
-
-        if args.ip and args.ip != g.ip:
-            continue
-
-        if args.agent and args.agent != g.user_agent:
-            continue
-
-        if start_ts and g.latest_ts < start_ts:
-            break
-
-        if end_ts and g.earliest_ts > end_ts:
-            break
-
         debug(" * Found matching graph with root {0}".format(g._root.url))
         out.write(str(g))
         out.write("\n\n")
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Converts files of pickled BroRecordGraphs, written one after another,
+into the graph container format.  Each file is converted in place, and
+files that are already in the container format are skipped."""
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import os
+import brotools.reports
+from brotools.graphfile import GraphFileWriter, is_graph_file, read_graphs
+from brotools.graphfile import move_graph_file
+
+parser = brotools.reports.default_cli_parser(sys.modules[__name__].__doc__)
+parser.add_argument('--uncompressed', '-u', action="store_true",
+                    help="If set, blocks of graphs are not compressed.")
+args = parser.parse_args()
+
+input_paths = args.inputs or sys.stdin.read().strip().split("\n")
+input_files = [p.strip() for p in input_paths if len(p.strip()) > 0]
+
+out = open(args.output, 'w') if args.output else sys.stdout
+
+for path in input_files:
+    if is_graph_file(path):
+        if args.verbose:
+            out.write("Skipping {0}, already converted\n".format(path))
+        continue
+
+    tmp_path = path + ".tmp"
+    with GraphFileWriter(tmp_path, compress=not args.uncompressed) as writer:
+        for graph in read_graphs(path):
+            writer.write(graph)
+
+    old_size = os.path.getsize(path)
+    new_size = os.path.getsize(tmp_path)
+    move_graph_file(tmp_path, path)
+    if args.verbose:
+        out.write("Converted {0}: {1} graphs, {2} -> {3} bytes\n".format(
+                  path, writer.count, old_size, new_size))
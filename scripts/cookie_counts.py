@@ -11,9 +11,11 @@ import sys
 import os.path
 sys.path.append(os.path.join('..'))
 import brotools.reports
+from stuffing.dispatch import MarketerDispatcher
 
 parser = brotools.reports.marketing_cli_parser(sys.modules[__name__].__doc__)
 count, ins, out, debug, marketers, args = brotools.reports.parse_marketing_cli_args(parser)
+dispatcher = MarketerDispatcher(marketers)
 
 # This dictionary has keys of marketer names.  Values are dicts, and the keys
 # of those dicts are session cookies found for the given marketer.  Values
@@ -27,7 +29,7 @@ for path, graphs in ins():
     debug("{0}. Considering {1}".format(index, path))
     debug("{0}. Found {1} graphs".format(index, len(graphs)))
     for g in graphs:
-        for marketer in marketers:
+        for marketer in dispatcher.marketers_for_graph(g):
             marketer_name = marketer.name()
             session_id = marketer.session_id_for_graph(g)
             if not session_id:
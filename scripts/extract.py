@@ -17,6 +17,16 @@ parser.add_argument('--workpath', '-p', default="/tmp", type=str,
                     help="A path on disk to write intermediate work files to.")
 parser.add_argument('--lite', '-l', action="store_true",
                     help="If true, merged files won't be saved, and will be deleted from disk right after they are used.")
+parser.add_argument('--memory', '-m', type=int, default=None,
+                    help="If set, the approximate number of bytes of log lines each worker will keep in memory when merging logs.  Additional lines are sorted and spilled to the workpath.")
+parser.add_argument('--presorted', action="store_true",
+                    help="If set, each gzip file is expected to already be sorted, and files are merged without being sorted first.")
+parser.add_argument('--stream', '-S', action="store_true",
+                    help="If set, merged records are parsed as they are merged, and the merged logs are never written to disk. Otherwise, merged logs are written to the workpath, which can be useful for debugging.")
+parser.add_argument('--cache', '-c', action="store_true",
+                    help="If set, the parsed records from each merged log are cached in the workpath, and later runs over the same (unchanged) logs read the cached records instead of parsing the logs again.")
+parser.add_argument('--host-index', default=None,
+                    help="If provided, the path to an index of the hosts requested in each graph file.  The index is created if it doesn't exist, and the graph files written are added to it.")
 parser.add_argument('--inputs', '-i', nargs='*',
                     help='A list of gzip files to parse bro data from. If not provided, reads a list of files from stdin')
 parser.add_argument('--time', '-t', type=float, default=.5,
@@ -46,7 +56,8 @@ else:
 paths = [(k, os.path.join(args.workpath, v)) for k, v in brotools.merge.group_records(input_files)]
 relevant_graph_pickles = brotools.reports.find_graphs(
     paths, workers=args.workers, time=args.time, min_length=args.steps,
-    lite=args.lite)
+    lite=args.lite, max_memory=args.memory, presorted=args.presorted,
+    stream=args.stream, cache=args.cache, host_index=args.host_index)
 
 output_h = open(args.output, 'w') if args.output else sys.stdout
 
@@ -8,26 +8,29 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import brotools.reports
 import brotools.records
-
-try:
-    import cPickle as pickle
-except:
-    import pickle
+from brotools.graphfile import GraphFileWriter, query_graphs
+from stuffing.dispatch import MarketerDispatcher
 
 parser = brotools.reports.marketing_cli_parser(sys.modules[__name__].__doc__)
 cli_params = brotools.reports.parse_marketing_cli_args(parser)
 count, ins, out, debug, marketers, args = cli_params
+dispatcher = MarketerDispatcher(marketers)
 
+# Inputs are read one file after another, so only the output file for the
+# current input needs to be open at once.  Only graphs with a request to a
+# watched host are read out of each input, using the input's index when it
+# has one.
 index = 0
-for path, g in ins():
-
-    index += 1
-    # debug("{0}. Found {1} graphs".format(index, len(graphs)))
-    for marketer in marketers:
-        if len(marketer.nodes_for_domains(g)) == 0:
+for path in args.inputs:
+    writer = None
+    for g in query_graphs(path, host_filter=dispatcher.watches_host):
+        index += 1
+        interested = dispatcher.marketers_for_graph(g)
+        if not interested:
             continue
-        debug("{0}. Found graph for {1}".format(index, marketer.name()))
-        dst_path = path + ".important"
-        with open(dst_path, 'a') as h:
-            pickle.dump(g, h)
-        break
+        debug("{0}. Found graph for {1}".format(index, interested[0].name()))
+        if not writer:
+            writer = GraphFileWriter(path + ".important", append=True)
+        writer.write(g)
+    if writer:
+        writer.close()
@@ -9,6 +9,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import brotools.reports
 import csv
+from stuffing.dispatch import MarketerDispatcher
 
 parser = brotools.reports.marketing_cli_parser(sys.modules[__name__].__doc__)
 parser.add_argument('--ttl', type=int, default=84600,
@@ -21,6 +22,7 @@ parser.add_argument('--secs', type=int, default=3600,
                     "for those requests to be treated as a seperate checkout")
 cli_params = brotools.reports.parse_marketing_cli_args(parser)
 count, ins, out, debug, marketers, args = cli_params
+dispatcher = MarketerDispatcher(marketers)
 
 # Multi indexed dict, in the following format:
 #
@@ -68,27 +70,30 @@ old_path = None
 debug("Preparing to start reading {0} pickled data".format(count))
 marketer_lookup = {}
 
+# Every marketer is counted, even those that aren't interested in any graph,
+# since only the marketers interested in each graph are considered below
+for marketer in marketers:
+    if marketer.name() not in marketer_lookup:
+        marketer_lookup[marketer.name()] = marketer
+        session_cookies[marketer.name()] = set()
+        cookie_set_counts[marketer.name()] = 0
+        cookie_stuff_counts[marketer.name()] = 0
+        checkout_counts[marketer.name()] = 0
+        stuffed_purchase_counts[marketer.name()] = 0
+        valid_purchase_counts[marketer.name()] = 0
+        stolen_purchase_counts[marketer.name()] = 0
+        request_counts[marketer.name()] = 0
+        partner_tags[marketer.name()] = set()
+        stuffing_tags[marketer.name()] = set()
+
 for path, g in ins():
     if not old_path or old_path != path:
         index += 1
         old_path = path
         debug("{0}-{1}. Considering {2}".format(index, count, path))
-    for marketer in marketers:
-
-        if marketer.name() not in marketer_lookup:
-            marketer_lookup[marketer.name()] = marketer
-            session_cookies[marketer.name()] = set()
-            cookie_set_counts[marketer.name()] = 0
-            cookie_stuff_counts[marketer.name()] = 0
-            checkout_counts[marketer.name()] = 0
-            stuffed_purchase_counts[marketer.name()] = 0
-            valid_purchase_counts[marketer.name()] = 0
-            stolen_purchase_counts[marketer.name()] = 0
-            request_counts[marketer.name()] = 0
-            partner_tags[marketer.name()] = set()
-            stuffing_tags[marketer.name()] = set()
-
-        request_counts[marketer.name()] += len(marketer.nodes_for_domains(g))
+    for marketer, nodes in dispatcher.nodes_by_marketer(g):
+
+        request_counts[marketer.name()] += len(nodes)
 
         stuffs_records = marketer.stuffs_in_graph(g)
         if len(stuffs_records) > 0:
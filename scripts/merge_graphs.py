@@ -15,12 +15,8 @@ import os
 import brotools.reports
 import brotools.records
 import datetime
-from brotools.graphs import merge
-
-try:
-    import cPickle as pickle
-except:
-    import pickle
+from brotools.graphs import merge, MergeCheckpoint
+from brotools.graphfile import GraphFileWriters, remove_graph_file
 
 parser = brotools.reports.default_cli_parser(sys.modules[__name__].__doc__)
 parser.add_argument('--time', '-t', type=float, default=10,
@@ -29,8 +25,35 @@ parser.add_argument('--time', '-t', type=float, default=10,
 parser.add_argument('--light', '-l', action="store_true",
                     help="If this argument is passed, the input files will " +
                     "be deleted after the merge operation.")
+parser.add_argument('--workers', '-w', type=int, default=1,
+                    help="The number of processes to merge graphs with.  " +
+                    "Each process merges the graphs of a share of the " +
+                    "clients.")
+parser.add_argument('--checkpoint', '-c', default=None,
+                    help="If provided, the path to a file of graphs that " +
+                    "could still be merged with graphs in the logs after " +
+                    "the inputs.  If the file exists (ie from merging the " +
+                    "previous inputs), its graphs are merged with the " +
+                    "inputs, and it is then replaced with the graphs that " +
+                    "could be merged with the next inputs.")
+parser.add_argument('--period', '-p', type=float, default=None,
+                    help="The number of seconds each input log covers, " +
+                    "used to find when the next log starts when writing a " +
+                    "checkpoint.  Defaults to the time between the last " +
+                    "two inputs.")
+parser.add_argument('--max-pending', '-m', type=int, default=None,
+                    help="If provided, the most graphs (per worker) to keep " +
+                    "in memory while waiting to see if they can absorb " +
+                    "graphs in later inputs.  Additional graphs are " +
+                    "spilled to a temporary file.")
 count, ins, out, debug, args = brotools.reports.parse_default_cli_args(parser)
 
+# The most graph files that will be held open for writing at once.  Graphs
+# are mostly written to the files for the few most recently read inputs,
+# so writers for older files are closed (and reopened to append to,
+# if needed).
+MAX_OPEN_WRITERS = 32
+
 debug("Preparing to read {0} collections of graphs".format(count))
 
 input_paths = args.inputs
@@ -44,43 +67,59 @@ except AttributeError:  # Catch if we're calling split on a list of files
 input_files = [p.strip() for p in in_paths if len(p.strip()) > 0]
 input_files.sort()
 
-written_files = set()
 parsed_files = []
 removed_files = []
-for path, graph, is_changed in merge(input_files, args.time):
 
-    if path not in parsed_files:
-        parsed_files.append(path)
-        now = datetime.datetime.now()
-        out.write("{0}: Moving onto file {1}\n".format(str(now), path))
+if args.workers > 1:
+    # Graphs are only merged with graphs for the same client, so clients
+    # are split between the workers, which each read and merge only their
+    # own clients' graphs out of every file
+    written_files = brotools.reports.merge_shards(
+        input_files, workers=args.workers, time=args.time,
+        checkpoint_path=args.checkpoint, period=args.period,
+        max_pending=args.max_pending)
+    parsed_files = input_files
+else:
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = MergeCheckpoint.load(args.checkpoint)
+    writers = GraphFileWriters(max_open=MAX_OPEN_WRITERS)
+    merged = merge(input_files, args.time, checkpoint=checkpoint,
+                   checkpoint_path=args.checkpoint, period=args.period,
+                   max_pending=args.max_pending)
+    for path, graph, is_changed in merged:
 
-    # If we've been passed the `light` flag (meaning we should try and
-    # limit use of the filesystem), delete each source file once we're
-    # done processing it (ie its not the current one we're reading from)
-    if args.light and path != parsed_files[-1] and path not in removed_files:
-        try:
-            removed_files.append(path)
-            os.remove(path)
-        except OSError:
-            pass
+        # Graphs held over in a checkpoint come from the previous inputs,
+        # which aren't tracked here
+        if path not in parsed_files and path in input_files:
+            parsed_files.append(path)
+            now = datetime.datetime.now()
+            out.write("{0}: Moving onto file {1}\n".format(str(now), path))
+
+        # If we've been passed the `light` flag (meaning we should try and
+        # limit use of the filesystem), delete each source file once we're
+        # done processing it (ie its not the current one we're reading from).
+        # Files from previous inputs are left alone.
+        if (args.light and path in input_files and parsed_files and
+                path != parsed_files[-1] and path not in removed_files):
+            try:
+                removed_files.append(path)
+                remove_graph_file(path)
+            except OSError:
+                pass
 
-    if is_changed:
-        dst_path = path + ".changed"
-        written_files.add(dst_path)
-        with open(dst_path, 'a') as h:
-            pickle.dump(graph, h)
-    else:
-        dst_path = path + ".unchanged"
-        written_files.add(dst_path)
-        with open(dst_path, 'a') as h:
-            pickle.dump(graph, h)
-    if path not in parsed_files:
-        parsed_files.append(parsed_files)
+        if is_changed:
+            dst_path = path + ".changed"
+        else:
+            dst_path = path + ".unchanged"
+        writers.write(dst_path, graph)
+    writers.close()
+    written_files = writers.paths
 
 if args.light:
     for prev_path in parsed_files:
         try:
-            os.remove(prev_path)
+            remove_graph_file(prev_path)
         except OSError:
             pass
 
@@ -7,11 +7,13 @@ import os.path
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 import brotools.reports
+from stuffing.dispatch import MarketerDispatcher
 import brotools.records
 
 parser = brotools.reports.marketing_cli_parser(sys.modules[__name__].__doc__)
 cli_params = brotools.reports.parse_marketing_cli_args(parser)
 count, ins, out, debug, marketers, args = cli_params
+dispatcher = MarketerDispatcher(marketers)
 
 debug("Preparing to start reading pickled data.")
 index = 0
@@ -20,7 +22,7 @@ for path, graphs in ins():
     debug("{0}. Considering {1}".format(index, path))
     debug("{0}. Found {1} graphs".format(index, len(graphs)))
     for g in graphs:
-        for marketer in marketers:
+        for marketer in dispatcher.marketers_for_graph(g):
             # Iterate over all nodes in the graph until we hit one that has
             # a cookie stuffing attempt in it.  But no need to iterate further
             # after we hit the first stuffing node
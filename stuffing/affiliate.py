@@ -17,6 +17,9 @@ CART = 2
 PARTIAL_DOMAIN = 0
 FULL_DOMAIN = 1
 
+# Compiled patterns for finding cookies by name, see `cookie_pattern`
+_COOKIE_PATTERNS = {}
+
 
 def domain_to_class_name(name):
     """Some affiliates have a large number of individually, but identically
@@ -33,20 +36,85 @@ def domain_to_class_name(name):
     return string.capwords(name.replace(".", " ")).replace(" ", "")
 
 
+def cookie_pattern(name):
+    """Returns a regex object that finds the value of the cookie with the
+    given name in the cookie header of a request.  Only the given cookie is
+    looked for, instead of every cookie in the header being parsed, since
+    most requests send many cookies.
+
+    Args:
+        name -- the name of a cookie
+
+    Return:
+        A re.RegexObject instance, where the first group of a match is the
+        first non-empty value of the cookie
+    """
+    try:
+        return _COOKIE_PATTERNS[name]
+    except KeyError:
+        # The name must be the whole name of a cookie, ie it must start the
+        # header or follow a ";" or whitespace.  This is checked with a
+        # lookbehind after the name, instead of before it, so that the
+        # header can still be scanned for the name as a literal prefix.
+        pattern = re.compile(re.escape(name) + r"=(?<![^;\s]" +
+                             "." * (len(name) + 1) + ")([^;]+)", re.S)
+        _COOKIE_PATTERNS[name] = pattern
+        return pattern
+
+
+def find_cookie(header, name):
+    """Returns the value of the cookie with the given name sent with a
+    request.
+
+    Args:
+        header -- the value of a request's Cookie header, or None
+        name   -- the name of a cookie
+
+    Return:
+        The first non-empty value of a cookie with the given name, or None
+        if there is no such cookie.
+    """
+    if not header:
+        return None
+    match = cookie_pattern(name).search(header)
+    return match.group(1) if match else None
+
+
 class AffiliateHistory(object):
     """Stores a history of a clients interactions with a site we
     track affiliate marketing for.  Well, not all interactions, just affiliate
     marketing cookie sets (and stuffs), and hitting the shopping cart.
     """
 
+    # The class that built the patterns for its session cookies, and the
+    # patterns, see `_session_cookie_patterns`
+    _session_cookie_cache = (None, None)
+
     """
     Required class methods for all subclasses
     """
 
+    @classmethod
+    def session_cookie_names(cls):
+        """Returns the names of the cookies this marketer uses to track
+        visitors, in the order they should be looked for.  Subclasses
+        that don't track visitors with a cookie can instead override
+        `session_id`.
+
+        Return:
+            A tuple or list of one or more strings
+        """
+        raise NotImplementedError("Subclasses of stuffing.AffiliateHistory " +
+                                  "must implement either a " +
+                                  "`session_cookie_names` or a " +
+                                  "`session_id` class method.")
+
     @classmethod
     def session_id(cls, record):
         """Returns a value that can be used for tracking someone visiting
-        this affiliate marketer across subsequent requests.
+        this affiliate marketer across subsequent requests.  By default,
+        this is the value of the first of the marketer's session cookies
+        sent with the request.
 
         Args:
             record -- a BroRecord instance
@@ -56,9 +124,32 @@ class AffiliateHistory(object):
             subsequent visits to this affiliate marketer, or None if
             the given request does not contain such an identifier.
         """
-        raise NotImplementedError("Subclasses of stuffing.AffiliateHistory " +
-                                  "must implement a `session_id` class " +
-                                  "method.")
+        header = record.cookies
+        if not header:
+            return None
+        for name in cls.session_cookie_names():
+            match = cookie_pattern(name).search(header)
+            if match:
+                return match.group(1)
+        return None
+
+    @classmethod
+    def _session_cookie_patterns(cls):
+        """Returns a list of patterns (from `cookie_pattern`) for each of
+        the marketer's session cookies, or None if the marketer overrides
+        `session_id` instead.  The result is kept in
+        `_session_cookie_cache`, along with the class, since subclasses
+        would otherwise find the result kept for the class they inherit
+        from."""
+        owner, patterns = cls._session_cookie_cache
+        if owner is not cls:
+            if cls.session_id.im_func is AffiliateHistory.session_id.im_func:
+                patterns = [cookie_pattern(n)
+                            for n in cls.session_cookie_names()]
+            else:
+                patterns = None
+            cls._session_cookie_cache = (cls, patterns)
+        return patterns
 
     @classmethod
     def checkout_urls(cls):
@@ -152,10 +243,31 @@ class AffiliateHistory(object):
             None if no session id was found.
         """
         nodes = cls.nodes_for_domains(graph)
-        for n in nodes:
-            token = cls.session_id(n)
-            if token:
-                return token
+        # The cached patterns are read here directly, instead of through
+        # `_session_cookie_patterns`, since this is done for every graph
+        owner, patterns = cls._session_cookie_cache
+        if owner is not cls:
+            patterns = cls._session_cookie_patterns()
+        if patterns is None:
+            for n in nodes:
+                token = cls.session_id(n)
+                if token:
+                    return token
+            return None
+
+        # Marketers that track visitors with session cookies have each
+        # node's cookie header searched here, instead of through
+        # `session_id`, one session cookie at a time, so that nodes are
+        # checked in the same loop whether the marketer has one session
+        # cookie or several
+        for pattern in patterns:
+            for n in nodes:
+                header = n.cookies
+                if not header:
+                    continue
+                match = pattern.search(header)
+                if match:
+                    return match.group(1)
         return None
 
     @classmethod
@@ -184,6 +296,26 @@ class AffiliateHistory(object):
         """
         return [n for n in cls.nodes_for_domains(graph) if cls.is_cookie_set(n)]
 
+    @classmethod
+    def watches_host(cls, host):
+        """Returns whether the given host is one of the domains the current
+        marketer watches, using the same matching as `nodes_for_domains`.
+
+        Args:
+            host -- a host name, such as www.example.org
+
+        Return:
+            True if requests to the host would be matched by
+            `nodes_for_domains`, and otherwise False.
+        """
+        for domain_name, match_type in cls.domains():
+            if match_type is FULL_DOMAIN:
+                if host == domain_name:
+                    return True
+            elif domain_name in host:
+                return True
+        return False
+
     @classmethod
     def nodes_for_domains(cls, graph):
         """Returns a list of all nodes in the given graph that match
@@ -259,11 +391,39 @@ class AffiliateHistory(object):
             record, and otherwise the tag as a string.
         """
         tag = cls.referrer_tag(record)
-        matches = re.search(tag + "=(.*?)(?:&|$)", record.url)
+        url = record.url
+        num_tags = url.count(tag + "=")
+        if num_tags == 0:
+            return None
+
+        # In the common case, the tag only appears once in the url, as a
+        # parameter in the query string, and can be read from the record's
+        # parsed query.  Otherwise (eg the tag is also the end of another
+        # parameter's name, or appears outside the query string), the url
+        # is searched, to find the same, first match as always.
+        if num_tags == 1:
+            values = record.query_params.get(tag)
+            if values:
+                return values[0]
+
+        matches = cls._referrer_tag_pattern(tag).search(url)
         if not matches:
             return None
         return matches.group(1)
 
+    @classmethod
+    def _referrer_tag_pattern(cls, tag):
+        try:
+            patterns = cls.__dict__["_referrer_tag_patterns"]
+        except KeyError:
+            patterns = {}
+            cls._referrer_tag_patterns = patterns
+        try:
+            return patterns[tag]
+        except KeyError:
+            patterns[tag] = re.compile(tag + "=(.*?)(?:&|$)")
+            return patterns[tag]
+
     @classmethod
     def stuffs_in_graph(cls, graph, time=2, sub_time=2):
         """Returns a list of all nodes in a given BroRecordGraph that are
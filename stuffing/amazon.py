@@ -2,9 +2,10 @@
 and collections of BroRecords."""
 
 import re
-from .affiliate import AffiliateHistory, FULL_DOMAIN
+from .affiliate import AffiliateHistory, find_cookie, FULL_DOMAIN
 
-AMZ_TOKEN_PATTERN = re.compile('session-token=([^\;]+)')
+# The name of the cookie amazon uses to track visitors
+SESSION_COOKIE = "session-token"
 
 
 def session_token(record):
@@ -18,14 +19,7 @@ def session_token(record):
         Either the amazon session token, as a string, or None if there
         was no token cookie provided in the response.
     """
-    if not record.cookies:
-        return None
-
-    match = AMZ_TOKEN_PATTERN.search(record.cookies)
-    if not match:
-        return None
-
-    return match.group(1)
+    return find_cookie(record.cookies, SESSION_COOKIE)
 
 
 class AmazonAffiliateHistory(AffiliateHistory):
@@ -34,8 +28,8 @@ class AmazonAffiliateHistory(AffiliateHistory):
     """
 
     @classmethod
-    def session_id(cls, record):
-        return session_token(record)
+    def session_cookie_names(cls):
+        return (SESSION_COOKIE,)
 
     @classmethod
     def checkout_urls(cls):
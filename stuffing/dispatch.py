@@ -0,0 +1,199 @@
+"""Finds which affiliate marketers are interested in the requests in a
+graph, without asking every marketer about every graph.
+
+The domains of every marketer are compiled, once, into a single index.
+Full domains are looked up in a dict, and partial domains are found with
+an Aho-Corasick automaton, which finds every partial domain contained in a
+host in a single pass over the host.  The marketers interested in each
+host are remembered, since the same hosts are requested in many graphs.
+"""
+
+from .affiliate import FULL_DOMAIN
+
+
+class SubstringMatcher(object):
+    """An Aho-Corasick automaton, for finding which of a collection of
+    strings occur in a given string, in time proportional to the length of
+    the given string (plus the number of matches), no matter how many
+    strings are being looked for.
+    """
+
+    def __init__(self, patterns):
+        """Builds the automaton.
+
+        Args:
+            patterns -- an iterable of strings to look for
+        """
+        # Each state of the automaton is an index into these lists.  State
+        # 0 is the root, which matches the empty string.
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+        self.patterns = []
+
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                try:
+                    state = self._goto[state][char]
+                except KeyError:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                    state = len(self._goto) - 1
+            self._outputs[state].append(len(self.patterns))
+            self.patterns.append(pattern)
+
+        # Breadth first, point each state at the state for the longest
+        # proper suffix of its string that is also in the trie, and inherit
+        # that state's matches
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].iteritems():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._outputs[next_state] += self._outputs[fail]
+
+    def matches(self, text):
+        """Finds which patterns occur in the given string.
+
+        Args:
+            text -- a string to search
+
+        Return:
+            A set of the indexes (in `patterns`) of each pattern that occurs
+            at least once in the given string
+        """
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+class MarketerDispatcher(object):
+    """An index of the domains watched by a collection of AffiliateHistory
+    subclasses, for finding the marketers interested in a graph, and the
+    nodes in the graph each one is interested in.
+    """
+
+    def __init__(self, marketers):
+        """Compiles the domains of the given marketers.
+
+        Args:
+            marketers -- a list of AffiliateHistory subclasses
+        """
+        self.marketers = list(marketers)
+        # The position of each marketer in the given list, for returning
+        # marketers in the order they were given in
+        self._order = dict((m, i) for i, m in enumerate(self.marketers))
+        self._by_host = {}
+        partial_domains = {}
+        for marketer in self.marketers:
+            for i, (domain_name, match_type) in enumerate(marketer.domains()):
+                if match_type is FULL_DOMAIN:
+                    self._by_host.setdefault(domain_name, []).append(
+                        (marketer, i))
+                else:
+                    partial_domains.setdefault(domain_name, []).append(
+                        (marketer, i))
+        self._partial_matcher = SubstringMatcher(partial_domains.keys())
+        self._by_partial = [partial_domains[p]
+                            for p in self._partial_matcher.patterns]
+        self._host_cache = {}
+
+    def domains_for_host(self, host):
+        """Returns which domains, of which marketers, match a host.
+
+        Args:
+            host -- a host name, such as www.example.org
+
+        Return:
+            A list of zero or more pairs of values, an AffiliateHistory
+            subclass, and the index of the matching domain in the list
+            returned by the subclass's `domains` method.
+        """
+        try:
+            return self._host_cache[host]
+        except KeyError:
+            pass
+        domains = list(self._by_host.get(host, ()))
+        for pattern_index in sorted(self._partial_matcher.matches(host)):
+            domains += self._by_partial[pattern_index]
+        self._host_cache[host] = domains
+        return domains
+
+    def marketers_for_host(self, host):
+        """Returns the marketers that watch a host.
+
+        Args:
+            host -- a host name, such as www.example.org
+
+        Return:
+            A list of zero or more AffiliateHistory subclasses
+        """
+        marketers = set(m for m, _ in self.domains_for_host(host))
+        return sorted(marketers, key=self._order.get)
+
+    def watches_host(self, host):
+        """Returns whether any marketer watches a host."""
+        return len(self.domains_for_host(host)) > 0
+
+    def marketers_for_graph(self, graph):
+        """Returns the marketers that watch at least one host in a graph, in
+        the order the marketers were given in.
+
+        Args:
+            graph -- a BroRecordGraph instance
+
+        Return:
+            A list of zero or more AffiliateHistory subclasses
+        """
+        marketers = set()
+        for host in graph.hosts():
+            marketers.update(m for m, _ in self.domains_for_host(host))
+        return sorted(marketers, key=self._order.get)
+
+    def nodes_by_marketer(self, graph):
+        """Finds the nodes in a graph that each marketer watches, in a single
+        pass over the graph's hosts.  The nodes for each marketer are the
+        same nodes, in the same order, as returned by the marketer's
+        `nodes_for_domains` method.
+
+        Args:
+            graph -- a BroRecordGraph instance
+
+        Return:
+            A list of pairs of values, an AffiliateHistory subclass, and a
+            list of one or more BroRecords in the graph, for each marketer
+            that watches at least one host in the graph, in the order the
+            marketers were given in.
+        """
+        matches = {}
+        for position, host in enumerate(graph.hosts()):
+            for marketer, domain_index in self.domains_for_host(host):
+                matches.setdefault(marketer, []).append(
+                    (domain_index, position, host))
+
+        results = []
+        for marketer in sorted(matches, key=self._order.get):
+            nodes = []
+            # Domains are matched in the order the marketer lists them, and
+            # hosts in the order the graph lists them
+            for _, _, host in sorted(matches[marketer]):
+                nodes += graph.nodes_for_host(host)
+            if nodes:
+                results.append((marketer, nodes))
+        return results
@@ -4,21 +4,14 @@ and collections of BroRecords."""
 import re
 from .affiliate import AffiliateHistory, PARTIAL_DOMAIN
 
-TOKEN_PATTERN = re.compile('visitor=([^\;]+)')
+SESSION_COOKIE = "visitor"
 
 
 class GodaddyAffiliateHistory(AffiliateHistory):
 
     @classmethod
-    def session_id(cls, record):
-        if not record.cookies:
-            return None
-
-        match = TOKEN_PATTERN.search(record.cookies)
-        if not match:
-            return None
-
-        return match.group(1)
+    def session_cookie_names(cls):
+        return (SESSION_COOKIE,)
 
     @classmethod
     def checkout_urls(cls):
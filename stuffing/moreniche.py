@@ -6,15 +6,15 @@ import new
 from .affiliate import AffiliateHistory, domain_to_class_name, FULL_DOMAIN
 
 DOMAINS = (
-    ('www.bauernutrition.com', 'checkout/cart', 242, r'frontend=([^\;]+)'),
-    ('www.capsiplex.com', 'checkout/cart', 178, r'frontend=([^\;]+)'),
-    ('www.crazymass.com', 'cart.php', 240, r'SHOP_SESSION_TOKEN=([^\;]+)'),
-    ('www.evolution-slimming.com', 'store/index.php?_g=co&_a=cart', 171, r'ccUser=([^\;]+)'),
-    ('www.facelift-gym.co.uk', 'shopping_cart.php', 245, r'XTCsid=([^\;]+)'),
-    ('www.hgh.com', 'cart/newfrontend/begincheckout.aspx', 258, r'buySAFEUID=([^\;]+)'),
-    ('www.meratol.com', 'checkout/cart', 195, r'frontend=([^\;]+)'),
-    ('www.pharmamuscle.com', 'shoppingcart.aspx', 259, r'\.ASPXANONYMOUS=([^\;]+)'),
-    ('www.slimming.com', 'checkout/cart', 149, r'frontend=([^\;]+)'),
+    ('www.bauernutrition.com', 'checkout/cart', 242, 'frontend'),
+    ('www.capsiplex.com', 'checkout/cart', 178, 'frontend'),
+    ('www.crazymass.com', 'cart.php', 240, 'SHOP_SESSION_TOKEN'),
+    ('www.evolution-slimming.com', 'store/index.php?_g=co&_a=cart', 171, 'ccUser'),
+    ('www.facelift-gym.co.uk', 'shopping_cart.php', 245, 'XTCsid'),
+    ('www.hgh.com', 'cart/newfrontend/begincheckout.aspx', 258, 'buySAFEUID'),
+    ('www.meratol.com', 'checkout/cart', 195, 'frontend'),
+    ('www.pharmamuscle.com', 'shoppingcart.aspx', 259, '.ASPXANONYMOUS'),
+    ('www.slimming.com', 'checkout/cart', 149, 'frontend'),
 )
 
 # Below are included because cart page is SSL
@@ -28,22 +28,15 @@ DOMAINS = (
 
 class MoreNicheAffiliateHistory(AffiliateHistory):
 
-    _TOKEN_PATTERN = None
+    _SESSION_COOKIE = None
     _CHECKOUT_URL = None
     _AFFILIATE_ID = None
     _DOMAIN = None
     _NAME = None
 
     @classmethod
-    def session_id(cls, record):
-        if not record.cookies:
-            return None
-
-        match = cls._TOKEN_PATTERN.search(record.cookies)
-        if not match:
-            return None
-
-        return match.group(1)
+    def session_cookie_names(cls):
+        return (cls._SESSION_COOKIE,)
 
     @classmethod
     def checkout_urls(cls):
@@ -82,7 +75,7 @@ class MoreNicheAffiliateHistory(AffiliateHistory):
 
 CLASSES = []
 
-for domain, url, affiliate_id, pattern in DOMAINS:
+for domain, url, affiliate_id, cookie in DOMAINS:
     domain_class_name = domain_to_class_name(domain)
     a_class_name = "MoreNitch{0}AffiliateHistory".format(domain_class_name)
     a_class = new.classobj(a_class_name, (MoreNicheAffiliateHistory,), {})
@@ -90,5 +83,5 @@ for domain, url, affiliate_id, pattern in DOMAINS:
     a_class._NAME = "MoreNitch Affiliate: {0}".format(domain)
     a_class._CHECKOUT_URL = url
     a_class._AFFILIATE_ID = affiliate_id
-    a_class._TOKEN_PATTERN = re.compile(pattern)
+    a_class._SESSION_COOKIE = cookie
     CLASSES.append(a_class)
@@ -6,14 +6,14 @@ import new
 from .affiliate import AffiliateHistory, FULL_DOMAIN, domain_to_class_name
 
 DOMAINS = (
-    ("imlive.com", "savebillclickout.ashx", r'spvdr=([^\;]+)'),
-    ("sexier.com", "buycredit", r'vi=([^\;]+)'),
-    ("www.fetishgalaxy.com", "buycredit", r'vi=([^\;]+)'),
-    ("www.shemale.com", "buycredit", r'vi=([^\;]+)'),
-    ("www.supermen.com", "buycredit", r'vi=([^\;]+)'),
-    ("phonemates.com", "Services/ControlLoader.ashx", r'vi=([^\;]+)'),
-    ("wildmatch.com", "join", r'vi=([^\;]+)'),
-    ("bangmatch.com", "join", r'vi=([^\;]+)'),
+    ("imlive.com", "savebillclickout.ashx", 'spvdr'),
+    ("sexier.com", "buycredit", 'vi'),
+    ("www.fetishgalaxy.com", "buycredit", 'vi'),
+    ("www.shemale.com", "buycredit", 'vi'),
+    ("www.supermen.com", "buycredit", 'vi'),
+    ("phonemates.com", "Services/ControlLoader.ashx", 'vi'),
+    ("wildmatch.com", "join", 'vi'),
+    ("bangmatch.com", "join", 'vi'),
 )
 
 SHARED_PATTERN = re.compile(r'(?:&|\?|^|;)wid=', re.I)
@@ -22,21 +22,14 @@ SHARED_PATTERN = re.compile(r'(?:&|\?|^|;)wid=', re.I)
 class PussyCashAffiliateHistory(AffiliateHistory):
 
     # Set by the dynamically created sublcasses
-    _TOKEN_PATTERN = None
+    _SESSION_COOKIE = None
     _CHECKOUT_URL = None
     _DOMAIN = None
     _NAME = None
 
     @classmethod
-    def session_id(cls, record):
-        if not record.cookies:
-            return None
-
-        match = cls._TOKEN_PATTERN.search(record.cookies)
-        if not match:
-            return None
-
-        return match.group(1)
+    def session_cookie_names(cls):
+        return (cls._SESSION_COOKIE,)
 
     @classmethod
     def checkout_urls(cls):
@@ -68,12 +61,12 @@ class PussyCashAffiliateHistory(AffiliateHistory):
         return cls._NAME
 
 CLASSES = []
-for domain, url, pattern in DOMAINS:
+for domain, url, cookie in DOMAINS:
     domain_class_name = domain_to_class_name(domain)
     a_class_name = "PussyCash{0}AffiliateHistory".format(domain_class_name)
     a_class = new.classobj(a_class_name, (PussyCashAffiliateHistory,), {})
     a_class._DOMAIN = [(domain, FULL_DOMAIN)]
     a_class._NAME = "PussyCash Affiliate: {0}".format(domain)
     a_class._CHECKOUT_URL = url
-    a_class._TOKEN_PATTERN = re.compile(pattern)
+    a_class._SESSION_COOKIE = cookie
     CLASSES.append(a_class)
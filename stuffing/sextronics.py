@@ -4,8 +4,9 @@ and collections of BroRecords."""
 import re
 import new
 from .affiliate import AffiliateHistory, domain_to_class_name, PARTIAL_DOMAIN
+from .affiliate import find_cookie
 
-TOKEN_PATTERN = re.compile('ntc=([^\;]+)')
+SESSION_COOKIE = "ntc"
 
 
 def session_token(record):
@@ -19,14 +20,7 @@ def session_token(record):
         Either the amazon session token, as a string, or None if there
         was no token cookie provided in the response.
     """
-    if not record.cookies:
-        return None
-
-    match = TOKEN_PATTERN.search(record.cookies)
-    if not match:
-        return None
-
-    return match.group(1)
+    return find_cookie(record.cookies, SESSION_COOKIE)
 
 DOMAINS = (
     '18passwort.com',
@@ -176,8 +170,8 @@ DOMAINS = (
 class SexTronicsAffiliateHistory(AffiliateHistory):
 
     @classmethod
-    def session_id(cls, record):
-        return session_token(record)
+    def session_cookie_names(cls):
+        return (SESSION_COOKIE,)
 
     @classmethod
     def checkout_urls(cls):